@@ -0,0 +1,720 @@
+from collections import defaultdict
+from decimal import Decimal
+from django.db import transaction
+from django.utils import timezone
+from django.db.models import Case, When, F, Q, Sum, Value, IntegerField, DecimalField
+from django.db.models.functions import Greatest
+from rest_framework import serializers
+from .functions import client_category_price_map, bill_unit_prices
+from .models import (Enterprise, Product, Variant, Packaging, SellPrice, SellPriceHistory, Client, SalesPoint, Bill, ProductBill,
+                     PackageProductBill, PackagingHistory, StockMovement, SalesHeatmapCell, ClientLedgerEntry,
+                     ClientPackagingBalance)
+
+
+class StockConflict(Exception):
+    # Raised inside a transaction when stock changed under a set-based update
+    pass
+
+
+def apply_quantity_deltas(model, deltas, field='quantity', batch_size=200):
+    # Applies {pk: delta} with one UPDATE per batch of distinct deltas (SQLite
+    # caps the depth of the WHERE tree). Decrements only apply where enough is
+    # left, so a short row count means another request got there first.
+    groups = defaultdict(list)
+    for pk, delta in deltas.items():
+        if delta:
+            groups[delta].append(pk)
+    groups = list(groups.items())
+    updated = 0
+    for start in range(0, len(groups), batch_size):
+        batch = groups[start:start + batch_size]
+        guard = Q()
+        for delta, pks in batch:
+            guard |= Q(pk__in=pks, **{f'{field}__gte': -delta}) if delta < 0 else Q(pk__in=pks)
+        updated += model.objects.filter(guard).update(**{
+            field: Case(*[When(pk__in=pks, then=F(field) + delta) for delta, pks in batch], default=F(field),
+                        output_field=IntegerField())
+        })
+    if updated != sum(len(pks) for _, pks in groups):
+        raise StockConflict()
+
+def apply_packaging_deltas(full_deltas, empty_deltas):
+    # Crates never go below zero, as in BillSerializer.create and Bill.delete
+    pks = set(full_deltas) | set(empty_deltas)
+    if not pks:
+        return
+    Packaging.objects.filter(pk__in=pks).update(
+        full_quantity=Case(*[When(pk=pk, then=Greatest(F('full_quantity') + delta, Value(0), output_field=IntegerField()))
+                             for pk, delta in full_deltas.items()],
+                           default=F('full_quantity'), output_field=IntegerField()),
+        empty_quantity=Case(*[When(pk=pk, then=Greatest(F('empty_quantity') + delta, Value(0), output_field=IntegerField()))
+                              for pk, delta in empty_deltas.items()],
+                            default=F('empty_quantity'), output_field=IntegerField()),
+    )
+
+class PackagingHistoryLog:
+    """Packaging history of one request, written with a single bulk_create.
+
+    move() changes the crates of a packaging instance, locked by the caller,
+    the way apply_packaging_deltas() does (never below zero) and records the
+    exact before and after values; consecutive moves of a packaging chain
+    on the same instance. The caller writes the net change of each packaging
+    (net_deltas()) and then flush()es, in the same transaction.
+    """
+    def __init__(self, user, action):
+        self.user = user
+        self.action = action
+        self.entries = []
+        self.initial = {}
+        self.packagings = {}
+
+    def move(self, packaging, full_delta, empty_delta, quantity, product_id=None, variant_id=None, bill=None,
+             bill_id=None, sales_point_id=None):
+        self.initial.setdefault(packaging.pk, (packaging.full_quantity, packaging.empty_quantity))
+        self.packagings[packaging.pk] = packaging
+        full_before, empty_before = packaging.full_quantity, packaging.empty_quantity
+        packaging.full_quantity = max(full_before + full_delta, 0)
+        packaging.empty_quantity = max(empty_before + empty_delta, 0)
+        self.entries.append(PackagingHistory(
+            packaging=packaging, product_id=product_id, variant_id=variant_id, action=self.action,
+            quantity_changed=quantity, full_quantity_before=full_before, empty_quantity_before=empty_before,
+            full_quantity_after=packaging.full_quantity, empty_quantity_after=packaging.empty_quantity,
+            performed_by=self.user, bill_id=bill.pk if bill else bill_id,
+            sales_point_id=sales_point_id or packaging.sales_point_id))
+        return packaging.full_quantity - full_before, packaging.empty_quantity - empty_before
+
+    def net_deltas(self):
+        # ({pk: full delta}, {pk: empty delta}) since the first move
+        full_deltas = {}
+        empty_deltas = {}
+        for pk, (full, empty) in self.initial.items():
+            full_deltas[pk] = self.packagings[pk].full_quantity - full
+            empty_deltas[pk] = self.packagings[pk].empty_quantity - empty
+        return full_deltas, empty_deltas
+
+    def flush(self):
+        PackagingHistory.objects.bulk_create(self.entries)
+        self.entries = []
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+class BillCatalogue:
+    """Everything a batch of bills refers to, loaded with one query per model.
+
+    Stock levels are tracked in memory as bills are accepted, so a batch that
+    oversells a product fails on the bill that runs out.
+    """
+    def __init__(self, enterprise, bills_data):
+        ids = defaultdict(set)
+        for bill_data in bills_data:
+            if not isinstance(bill_data, dict):
+                continue
+            ids['client'].add(_as_int(bill_data.get('customer')))
+            ids['sales_point'].add(_as_int(bill_data.get('sales_point')))
+            for line in bill_data.get('product_bills') or []:
+                if isinstance(line, dict):
+                    ids['product'].add(_as_int(line.get('product')))
+                    ids['variant'].add(_as_int(line.get('variant_id')))
+                    ids['sell_price'].add(_as_int(line.get('sell_price')))
+        ids = {key: [pk for pk in values if pk is not None] for key, values in ids.items()}
+
+        self.enterprise = enterprise
+        self.variants = Variant.objects.filter(product__enterprise=enterprise).in_bulk(ids.get('variant', []))
+        product_ids = ids.get('product', []) + [variant.product_id for variant in self.variants.values()]
+        self.products = Product.objects.filter(enterprise=enterprise).select_related('package').in_bulk(product_ids)
+        self.sell_prices = SellPrice.objects.filter(product__enterprise=enterprise).in_bulk(ids.get('sell_price', []))
+        self.clients = Client.objects.filter(enterprise=enterprise).in_bulk(ids.get('client', []))
+        self.sales_points = SalesPoint.objects.filter(enterprise=enterprise).in_bulk(ids.get('sales_point', []))
+        # Bills of the batch are dated now
+        self.unit_prices = SellPriceHistory.prices_at(list(self.sell_prices), timezone.now())
+
+        self.product_stock = {pk: product.quantity for pk, product in self.products.items()}
+        self.variant_stock = {pk: variant.quantity for pk, variant in self.variants.items()}
+        self.price_maps = {}
+
+    def category_prices(self, sales_point_id, client_category_id):
+        if sales_point_id not in self.price_maps:
+            self.price_maps[sales_point_id] = client_category_price_map(sales_point_id)
+        return self.price_maps[sales_point_id].get(client_category_id, {})
+
+
+class BatchBillPlanner:
+    # Validates bills the way BillSerializer does, against a BillCatalogue
+    delivery_date_field = serializers.DateTimeField()
+    paid_field = serializers.DecimalField(max_digits=20, decimal_places=2, allow_null=True)
+
+    def __init__(self, user, catalogue):
+        self.user = user
+        self.catalogue = catalogue
+
+    def plan(self, bill_data):
+        if not isinstance(bill_data, dict):
+            raise serializers.ValidationError({'non_field_errors': 'Expected a bill object.'})
+        catalogue = self.catalogue
+        bill = Bill(enterprise=catalogue.enterprise, customer_name=bill_data.get('customer_name') or None)
+
+        customer_id = bill_data.get('customer')
+        if customer_id:
+            bill.customer = catalogue.clients.get(_as_int(customer_id))
+            if bill.customer is None:
+                raise serializers.ValidationError({'customer': 'Client does not exist.'})
+        if self.user.user_type == 'admin':
+            if bill.customer is None:
+                bill.sales_point = catalogue.sales_points.get(_as_int(bill_data.get('sales_point')))
+                if bill.sales_point is None:
+                    raise serializers.ValidationError({'sales_point': 'This field is required for admin users when customer is 0.'})
+                if not bill.customer_name:
+                    raise serializers.ValidationError({'customer_name': 'Customer name is required if customer is 0.'})
+            else:
+                bill.sales_point = bill.customer.sales_point
+                bill.customer_name = f"{bill.customer.name} {bill.customer.surname}"
+        else:
+            bill.sales_point = self.user.sales_point
+        if bill.customer is None:
+            bill.customer_name = bill.customer_name or "Anonymous"
+
+        if bill_data.get('delivery_date'):
+            bill.delivery_date = self.delivery_date_field.run_validation(bill_data['delivery_date'])
+        if bill_data.get('paid') is not None:
+            bill.paid = self.paid_field.run_validation(bill_data['paid'])
+
+        lines_data = bill_data.get('product_bills')
+        if not lines_data or not isinstance(lines_data, list):
+            raise serializers.ValidationError({'product_bills': 'At least one product is required.'})
+
+        lines = []
+        product_needs = defaultdict(int)
+        variant_needs = defaultdict(int)
+        for line_data in lines_data:
+            lines.append(self._plan_line(line_data, product_needs, variant_needs))
+        if bill.customer and bill.sales_point:
+            category_prices = catalogue.category_prices(bill.sales_point.pk, bill.customer.client_category_id)
+            for line in lines:
+                line['unit_price'] = category_prices.get(line['sell_price'].pk, line['unit_price'])
+        for pk, quantity in product_needs.items():
+            if catalogue.product_stock[pk] < quantity:
+                raise serializers.ValidationError({'quantity': f"Not enough quantity for product {catalogue.products[pk].name}."})
+        for pk, quantity in variant_needs.items():
+            if catalogue.variant_stock[pk] < quantity:
+                raise serializers.ValidationError({'quantity': f"Not enough quantity for the variant product. {catalogue.variants[pk].name}"})
+
+        # The bill is accepted: reserve its stock for the rest of the batch
+        for pk, quantity in product_needs.items():
+            catalogue.product_stock[pk] -= quantity
+        for pk, quantity in variant_needs.items():
+            catalogue.variant_stock[pk] -= quantity
+
+        bill.total_amount = sum((line['unit_price'] * line['quantity'] for line in lines), Decimal('0'))
+        bill.package_amount = sum((line['packaging'].price * line['record_package'] for line in lines if line['packaging']),
+                                  Decimal('0'))
+        return bill, lines
+
+    def _plan_line(self, line_data, product_needs, variant_needs):
+        catalogue = self.catalogue
+        if not isinstance(line_data, dict):
+            raise serializers.ValidationError({'product_bills': 'Expected a product object.'})
+        quantity = _as_int(line_data.get('quantity'))
+        if quantity is None or quantity <= 0:
+            raise serializers.ValidationError({'quantity': 'A positive quantity is required.'})
+        record_package = _as_int(line_data.get('record_package', 0) or 0)
+        if record_package is None or record_package < 0:
+            raise serializers.ValidationError({'record_package': 'A valid integer is required.'})
+
+        is_variant = bool(line_data.get('is_variant'))
+        variant = None
+        if is_variant:
+            variant = catalogue.variants.get(_as_int(line_data.get('variant_id')))
+            if variant is None:
+                raise serializers.ValidationError({'variant_id': 'Product variant does not exist.'})
+            product = catalogue.products.get(variant.product_id)
+            if product is None:
+                raise serializers.ValidationError({'product': 'Product does not exist.'})
+            variant_needs[variant.pk] += quantity
+        else:
+            product = catalogue.products.get(_as_int(line_data.get('product')))
+            if product is None:
+                raise serializers.ValidationError({'product': 'Product does not exist.'})
+            product_needs[product.pk] += quantity
+
+        sell_price = catalogue.sell_prices.get(_as_int(line_data.get('sell_price')))
+        if sell_price is None or sell_price.product_id != product.pk:
+            raise serializers.ValidationError({'sell_price': f"Invalid sell price for product {product.name}."})
+
+        packaging = product.package if product.is_beer else None
+        if packaging and record_package > quantity:
+            raise serializers.ValidationError({'record_package': f"Packaging to record can't be greater than needed packaging for product {product.name}"})
+        return {'product': product, 'variant': variant, 'sell_price': sell_price, 'quantity': quantity,
+                'unit_price': catalogue.unit_prices.get(sell_price.pk, sell_price.price),
+                'record_package': record_package if packaging else 0, 'packaging': packaging}
+
+
+def lock_bill_numbers(enterprise_id):
+    # Bill numbers are max()+1 per enterprise: concurrent writers wait on the
+    # enterprise row instead of computing the same numbers. Needs a transaction.
+    list(Enterprise.objects.select_for_update().filter(pk=enterprise_id).values_list('pk', flat=True))
+
+def _next_bill_numbers(enterprise, count):
+    lock_bill_numbers(enterprise.pk)
+    last_bill = Bill.objects.filter(enterprise=enterprise).order_by('id').last()
+    last_number = int(last_bill.bill_number.split('-')[1]) if last_bill else 0
+    return [f'BILL-{last_number + offset:04d}' for offset in range(1, count + 1)]
+
+def write_planned_bills(enterprise, planned, user=None):
+    """Writes validated (bill, lines) pairs with a fixed number of queries.
+
+    Must run inside a transaction: stock is taken with guarded set-based
+    updates and StockConflict is raised if any of them comes up short.
+    """
+    bills = [bill for bill, _ in planned]
+    for bill, number in zip(bills, _next_bill_numbers(enterprise, len(bills))):
+        bill.bill_number = number
+    Bill.objects.bulk_create(bills)
+
+    product_bills = []
+    for bill, lines in planned:
+        for line in lines:
+            line['product_bill'] = ProductBill(bill=bill, product=line['product'], sell_price=line['sell_price'],
+                                               unit_price=line['unit_price'],
+                                               quantity=line['quantity'], is_variant=line['variant'] is not None,
+                                               variant_id=line['variant'].pk if line['variant'] else None)
+            product_bills.append(line['product_bill'])
+    ProductBill.objects.bulk_create(product_bills)
+
+    product_deltas = defaultdict(int)
+    variant_deltas = defaultdict(int)
+    packagings = Packaging.objects.select_for_update().in_bulk(
+        {line['packaging'].pk for _, lines in planned for line in lines if line['packaging']})
+    history = PackagingHistoryLog(user, 'sale')
+    deposits = defaultdict(int)
+    package_product_bills = []
+    movements = []
+    for bill, lines in planned:
+        for line in lines:
+            if line['variant']:
+                variant_deltas[line['variant'].pk] -= line['quantity']
+            else:
+                product_deltas[line['product'].pk] -= line['quantity']
+            movements.append(StockMovement(sales_point=bill.sales_point, product=line['product'], variant=line['variant'],
+                                           quantity=-line['quantity'], reason='sale', bill=bill))
+            if line['packaging']:
+                packaging = packagings[line['packaging'].pk]
+                # Crates not kept by the client come back empty
+                full_delta, empty_delta = history.move(
+                    packaging, -line['quantity'], line['quantity'] - line['record_package'], line['quantity'],
+                    product_id=line['product'].pk, variant_id=line['variant'].pk if line['variant'] else None,
+                    bill=bill, sales_point_id=bill.sales_point_id)
+                deposits[(bill.customer_id, packaging.pk)] += line['record_package']
+                package_product_bills.append(PackageProductBill(product_bill=line['product_bill'], packaging=packaging,
+                                                                quantity=line['quantity'], record=line['record_package']))
+                movements.append(StockMovement(sales_point=bill.sales_point, packaging=packaging, quantity=full_delta,
+                                               empty_quantity=empty_delta, reason='sale', bill=bill))
+
+    apply_quantity_deltas(Product, product_deltas)
+    apply_quantity_deltas(Variant, variant_deltas)
+    apply_packaging_deltas(*history.net_deltas())
+    ClientPackagingBalance.apply(deposits)
+    PackageProductBill.objects.bulk_create(package_product_bills)
+    StockMovement.objects.bulk_create(movements)
+    history.flush()
+
+    heatmap = defaultdict(lambda: [0, Decimal('0')])
+    for bill in bills:
+        heatmap[bill.sales_point_id][0] += 1
+        heatmap[bill.sales_point_id][1] += bill.total_amount
+    for sales_point_id, (count, revenue) in heatmap.items():
+        SalesHeatmapCell.record(sales_point_id, bills[0].created_at, count, revenue)
+    return bills
+
+def _reset_planned_bill(plan):
+    # Forget the primary key handed out by a rolled back bulk_create
+    bill, _ = plan
+    bill.pk = None
+    bill._state.adding = True
+
+def submit_bill_batch(user, bills_data, chunk_size=50):
+    """Validates a batch of bills against one catalogue and commits the valid
+    ones in chunks of chunk_size bills per transaction.
+
+    Returns one result per submitted bill, in order. When a chunk hits a stock
+    conflict its bills are retried one transaction each, so only the bills
+    that really ran out fail.
+    """
+    catalogue = BillCatalogue(user.enterprise, bills_data)
+    planner = BatchBillPlanner(user, catalogue)
+    results = []
+    planned = []
+    for index, bill_data in enumerate(bills_data):
+        result = {'index': index}
+        if isinstance(bill_data, dict) and bill_data.get('reference') is not None:
+            result['reference'] = bill_data['reference']
+        try:
+            planned.append((result, planner.plan(bill_data)))
+        except serializers.ValidationError as exc:
+            result.update(status='failed', errors=exc.detail)
+        results.append(result)
+
+    for start in range(0, len(planned), chunk_size):
+        chunk = planned[start:start + chunk_size]
+        try:
+            with transaction.atomic():
+                write_planned_bills(user.enterprise, [plan for _, plan in chunk], user)
+        except StockConflict:
+            for result, plan in chunk:
+                _reset_planned_bill(plan)
+                try:
+                    with transaction.atomic():
+                        write_planned_bills(user.enterprise, [plan], user)
+                except StockConflict:
+                    _reset_planned_bill(plan)
+                    result.update(status='failed', errors={'quantity': 'Stock changed while the batch was processed.'})
+        for result, (bill, _) in chunk:
+            if 'status' not in result:
+                result.update(status='created', id=bill.pk, bill_number=bill.bill_number)
+    return results
+
+
+def _line_state(product, variant, quantity, record):
+    # What a bill line takes out of stock: (product, variant, quantity,
+    # packaging or None, crates kept by the client)
+    packaging = product.package if product.is_beer and product.package_id else None
+    return product, variant, quantity, packaging, record if packaging else 0
+
+def update_bill_lines(bill, lines_data, user=None):
+    """Brings the lines of a bill to lines_data, touching only what changed.
+
+    Lines carrying the id of an existing line update it, lines without id
+    are added and existing lines left out are removed. The stored lines are
+    read once and diffed against the payload; only the net stock, packaging
+    and line changes are written, with bulk and set-based statements, and
+    the packaging history gets one entry per packaging changed. Must run
+    inside a transaction.
+    """
+    existing = {product_bill.pk: product_bill for product_bill in bill.product_bills.select_related(
+        'product__package', 'sell_price', 'package_product_bill')}
+    variant_ids = {line.get('variant_id') for line in lines_data if line.get('is_variant')}
+    variant_ids |= {product_bill.variant_id for product_bill in existing.values() if product_bill.is_variant}
+    variants = Variant.objects.select_related('product__package').in_bulk(variant_ids - {None})
+    products = Product.objects.select_related('package').in_bulk(
+        {line['product'].pk for line in lines_data if not line.get('is_variant')})
+
+    def old_state(product_bill):
+        package = getattr(product_bill, 'package_product_bill', None)
+        variant = variants.get(product_bill.variant_id) if product_bill.is_variant else None
+        product = variant.product if variant else product_bill.product
+        return product, variant, product_bill.quantity, package.packaging if package else None, package.record if package else 0
+
+    errors = []
+    kept = {}
+    added = []
+    for index, line in enumerate(lines_data):
+        if line.get('id') is not None and line['id'] not in existing:
+            errors.append(f"Line {line['id']} is not part of bill {bill.bill_number}.")
+            continue
+        if line.get('is_variant'):
+            variant = variants.get(line.get('variant_id'))
+            if variant is None:
+                errors.append('Product variant does not exist.')
+                continue
+            product = variant.product
+        else:
+            variant, product = None, products[line['product'].pk]
+        record = line.get('record_package', 0)
+        if record > line['quantity']:
+            errors.append(f"Packaging to record can't be greater than needed packaging for product {product.name}")
+            continue
+        state = _line_state(product, variant, line['quantity'], record)
+        if line.get('id') is not None:
+            kept[line['id']] = (line, state)
+        else:
+            added.append((line, state))
+    if errors:
+        raise serializers.ValidationError({'product_bills': errors})
+    removed = [product_bill for pk, product_bill in existing.items() if pk not in kept]
+
+    # Net effect on stock: what the old lines took comes back, what the new
+    # ones take goes out. Unchanged lines cancel out and are never written.
+    product_deltas = defaultdict(int)
+    variant_deltas = defaultdict(int)
+    full_deltas = defaultdict(int)
+    empty_deltas = defaultdict(int)
+    crate_products = defaultdict(set)
+    deposits = defaultdict(int)
+    changes = [(old_state(product_bill), None) for product_bill in removed]
+    changes += [(None, state) for _, state in added]
+    changes += [(old_state(existing[pk]), state) for pk, (_, state) in kept.items()
+                if old_state(existing[pk]) != state]
+    for before, after in changes:
+        for state, sign in ((before, 1), (after, -1)):
+            if state is None:
+                continue
+            product, variant, quantity, packaging, record = state
+            if variant:
+                variant_deltas[variant.pk] += sign * quantity
+            else:
+                product_deltas[product.pk] += sign * quantity
+            if packaging:
+                # Crates not kept by the client come back empty
+                full_deltas[packaging.pk] += sign * quantity
+                empty_deltas[packaging.pk] -= sign * (quantity - record)
+                crate_products[packaging.pk].add((product.pk, variant.pk if variant else None))
+                deposits[(bill.customer_id, packaging.pk)] -= sign * record
+
+    movements = []
+    for model, deltas in ((Product, product_deltas), (Variant, variant_deltas)):
+        deltas = {pk: delta for pk, delta in deltas.items() if delta}
+        try:
+            apply_quantity_deltas(model, deltas)
+        except StockConflict:
+            short = model.objects.filter(pk__in=[pk for pk, delta in deltas.items() if delta < 0])
+            raise serializers.ValidationError({'quantity': [
+                f"Insufficient quantity for {item.name}. Available: {item.quantity}"
+                for item in short if item.quantity < -deltas[item.pk]]})
+        for pk, delta in deltas.items():
+            item = variants[pk] if model is Variant else None
+            movements.append(StockMovement(sales_point_id=bill.sales_point_id, product_id=item.product_id if item else pk,
+                                           variant=item, quantity=delta, reason='sale_update', bill=bill))
+
+    packagings = Packaging.objects.select_for_update().in_bulk(set(full_deltas) | set(empty_deltas))
+    history = PackagingHistoryLog(user, 'sale_update')
+    for pk, packaging in packagings.items():
+        if packaging.full_quantity + full_deltas[pk] < 0:
+            raise serializers.ValidationError({'quantity': f"Insufficient quantity for packaging {packaging.name}. Available: {packaging.full_quantity}"})
+        if packaging.empty_quantity + empty_deltas[pk] < 0:
+            raise serializers.ValidationError({'record_package': f"Not enough empty {packaging.name} crates. Available: {packaging.empty_quantity}"})
+        if full_deltas[pk] or empty_deltas[pk]:
+            movements.append(StockMovement(sales_point_id=bill.sales_point_id, packaging=packaging,
+                                           quantity=full_deltas[pk], empty_quantity=empty_deltas[pk],
+                                           reason='sale_update', bill=bill))
+            # Net change of the packaging, naming the product when only one is involved
+            product_id, variant_id = next(iter(crate_products[pk])) if len(crate_products[pk]) == 1 else (None, None)
+            history.move(packaging, full_deltas[pk], empty_deltas[pk], abs(full_deltas[pk]) + abs(empty_deltas[pk]),
+                         product_id=product_id, variant_id=variant_id, bill=bill, sales_point_id=bill.sales_point_id)
+    apply_packaging_deltas(full_deltas, empty_deltas)
+    ClientPackagingBalance.apply(deposits)
+
+    # Lines: removed ones go with a single DELETE (their stock is already
+    # back, so ProductBill.delete() must not run), changed ones are updated in
+    # bulk and new ones inserted in bulk along with their packaging rows.
+    ProductBill.objects.filter(pk__in=[product_bill.pk for product_bill in removed]).delete()
+    sell_price_ids = [line['sell_price'].pk for line, _ in added if line.get('sell_price')]
+    sell_price_ids += [line['sell_price'].pk for line, _ in kept.values()
+                       if line.get('sell_price') and line['sell_price'].pk != existing[line['id']].sell_price_id]
+    unit_prices = bill_unit_prices(bill, sell_price_ids)
+
+    changed_lines = []
+    package_rows = {'create': [], 'update': [], 'delete': []}
+    for pk, (line, (product, variant, quantity, packaging, record)) in kept.items():
+        product_bill = existing[pk]
+        values = {'product_id': product.pk, 'is_variant': variant is not None,
+                  'variant_id': variant.pk if variant else None, 'quantity': quantity}
+        sell_price = line.get('sell_price', product_bill.sell_price)
+        if sell_price != product_bill.sell_price:
+            values['sell_price'] = sell_price
+            values['unit_price'] = unit_prices.get(sell_price.pk, sell_price.price) if sell_price else None
+        if any(getattr(product_bill, name) != value for name, value in values.items()):
+            for name, value in values.items():
+                setattr(product_bill, name, value)
+            changed_lines.append(product_bill)
+        package = getattr(product_bill, 'package_product_bill', None)
+        if package and not packaging:
+            package_rows['delete'].append(package.pk)
+        elif packaging and not package:
+            package_rows['create'].append(PackageProductBill(product_bill=product_bill, packaging=packaging,
+                                                             quantity=quantity, record=record))
+        elif packaging and (package.packaging_id, package.quantity, package.record) != (packaging.pk, quantity, record):
+            package.packaging, package.quantity, package.record = packaging, quantity, record
+            package_rows['update'].append(package)
+    ProductBill.objects.bulk_update(changed_lines, ['product', 'is_variant', 'variant_id', 'quantity', 'sell_price',
+                                                    'unit_price'])
+
+    new_lines = []
+    for line, (product, variant, quantity, packaging, record) in added:
+        sell_price = line.get('sell_price')
+        product_bill = ProductBill(bill=bill, product=product, sell_price=sell_price, quantity=quantity,
+                                   is_variant=variant is not None, variant_id=variant.pk if variant else None,
+                                   unit_price=unit_prices.get(sell_price.pk, sell_price.price) if sell_price else None)
+        new_lines.append(product_bill)
+        if packaging:
+            package_rows['create'].append(PackageProductBill(product_bill=product_bill, packaging=packaging,
+                                                             quantity=quantity, record=record))
+    ProductBill.objects.bulk_create(new_lines)
+    PackageProductBill.objects.filter(pk__in=package_rows['delete']).delete()
+    PackageProductBill.objects.bulk_update(package_rows['update'], ['packaging', 'quantity', 'record'])
+    PackageProductBill.objects.bulk_create(package_rows['create'])
+    StockMovement.objects.bulk_create(movements)
+    history.flush()
+    return bill
+
+
+def restore_product_bills(product_bills, reason='sale_delete', user=None):
+    """Puts back the stock taken by a ProductBill queryset and deletes its
+    packaging rows, without deleting the lines themselves.
+
+    Quantities are summed per sales point and product or variant by the
+    database and restored with one UPDATE per table; crates come back line
+    by line so that each gets its packaging history entry. Must run inside a
+    transaction.
+    """
+    product_deltas = defaultdict(int)
+    variant_deltas = defaultdict(int)
+    movements = []
+    lines = product_bills.values('bill__sales_point_id', 'product_id', 'is_variant', 'variant_id').annotate(
+        total=Sum('quantity')).order_by()
+    for line in lines:
+        variant_id = line['variant_id'] if line['is_variant'] else None
+        if variant_id:
+            variant_deltas[variant_id] += line['total']
+        else:
+            product_deltas[line['product_id']] += line['total']
+        movements.append(StockMovement(sales_point_id=line['bill__sales_point_id'], product_id=line['product_id'],
+                                       variant_id=variant_id, quantity=line['total'], reason=reason))
+    # ProductBill.variant_id is not a foreign key and may outlive its variant
+    existing_variants = set(Variant.objects.filter(pk__in=variant_deltas).values_list('pk', flat=True))
+
+    # Full crates come back; the empties handed in for them go back out
+    package_product_bills = PackageProductBill.objects.filter(product_bill__in=product_bills)
+    rows = list(package_product_bills.values_list(
+        'packaging_id', 'quantity', 'record', 'product_bill__product_id', 'product_bill__is_variant',
+        'product_bill__variant_id', 'product_bill__bill_id', 'product_bill__bill__sales_point_id',
+        'product_bill__bill__customer_id').order_by('pk'))
+    packagings = Packaging.objects.select_for_update().in_bulk({row[0] for row in rows})
+    history = PackagingHistoryLog(user, reason)
+    crates = defaultdict(lambda: [0, 0])
+    deposits = defaultdict(int)
+    for packaging_id, quantity, record, product_id, is_variant, variant_id, bill_id, sales_point_id, customer_id in rows:
+        variant_id = variant_id if is_variant and variant_id in existing_variants else None
+        full_delta, empty_delta = history.move(packagings[packaging_id], quantity, record - quantity, quantity,
+                                               product_id=product_id, variant_id=variant_id, bill_id=bill_id,
+                                               sales_point_id=sales_point_id)
+        crates[(sales_point_id, packaging_id)][0] += full_delta
+        crates[(sales_point_id, packaging_id)][1] += empty_delta
+        deposits[(customer_id, packaging_id)] -= record
+    for (sales_point_id, packaging_id), (full_delta, empty_delta) in crates.items():
+        movements.append(StockMovement(sales_point_id=sales_point_id, packaging_id=packaging_id, quantity=full_delta,
+                                       empty_quantity=empty_delta, reason=reason))
+
+    apply_quantity_deltas(Variant, {pk: delta for pk, delta in variant_deltas.items() if pk in existing_variants})
+    apply_quantity_deltas(Product, product_deltas)
+    apply_packaging_deltas(*history.net_deltas())
+    ClientPackagingBalance.apply(deposits)
+    package_product_bills.delete()
+    StockMovement.objects.bulk_create(movements)
+    history.flush()
+
+def delete_bills(bills, user=None):
+    """Deletes a Bill queryset and gives its stock back, with a fixed number
+    of statements whatever the number of bills and lines. Must run inside a
+    transaction."""
+    bill_ids = list(bills.select_for_update().values_list('pk', flat=True))
+    if not bill_ids:
+        return 0
+    restore_product_bills(ProductBill.objects.filter(bill_id__in=bill_ids), user=user)
+
+    heatmap = {}
+    for sales_point_id, created_at, total_amount in Bill.objects.filter(pk__in=bill_ids).values_list(
+            'sales_point_id', 'created_at', 'total_amount'):
+        local = timezone.localtime(created_at)
+        key = (sales_point_id, local.isoweekday(), local.hour)
+        count, revenue, _ = heatmap.get(key, (0, Decimal('0'), created_at))
+        heatmap[key] = (count - 1, revenue - total_amount, created_at)
+    for (sales_point_id, _, _), (count, revenue, created_at) in heatmap.items():
+        SalesHeatmapCell.record(sales_point_id, created_at, count, revenue)
+
+    Bill.objects.filter(pk__in=bill_ids).delete()
+    return len(bill_ids)
+
+def settle_bills(bills, settlements, user, batch_size=200):
+    """Settles a deliverer's pending bills at once.
+
+    settlements are {'bill', 'amount', 'reduce_from_balance'} dicts. The
+    bills are locked and checked against their stored totals with one query;
+    then every bill gets its paid amount and state with one UPDATE per batch
+    of distinct amounts, the client balances move through one ledger post
+    and each sales point balance with one increment, all in one transaction.
+    A single invalid entry rejects the whole batch.
+    """
+    with transaction.atomic():
+        by_pk = bills.select_for_update().select_related('sales_point').only(
+            'id', 'bill_number', 'state', 'total_amount', 'package_amount', 'customer_id',
+            'sales_point__id', 'sales_point__balance_shards').in_bulk([entry['bill'] for entry in settlements])
+        errors = []
+        seen = set()
+        for entry in settlements:
+            bill = by_pk.get(entry['bill'])
+            if bill is None:
+                errors.append(f"Bill {entry['bill']} not found.")
+            elif bill.pk in seen:
+                errors.append(f"Bill {bill.bill_number} is listed twice.")
+            elif bill.state != 'pending':
+                errors.append(f"Bill {bill.bill_number} must be in 'pending' state to update.")
+            elif bill.sales_point is None:
+                errors.append(f"Bill {bill.bill_number} has no sales point.")
+            elif entry['amount'] > bill.amount_due:
+                errors.append(f"Bill {bill.bill_number}: amount cannot be greater than the total amount.")
+            seen.add(entry['bill'])
+        if errors:
+            raise serializers.ValidationError({'bills': errors})
+
+        paid = defaultdict(list)
+        ledger = []
+        sales_point_credits = defaultdict(Decimal)
+        sales_points = {}
+        for entry in settlements:
+            bill = by_pk[entry['bill']]
+            paid[entry['amount']].append(bill.pk)
+            if entry['reduce_from_balance']:
+                sales_point_credits[bill.sales_point_id] += entry['amount']
+                sales_points[bill.sales_point_id] = bill.sales_point
+                if bill.customer_id is not None:
+                    ledger.extend(ClientLedgerEntry.bill_payment(bill, entry['amount'], user))
+
+        now = timezone.now()
+        paid = list(paid.items())
+        for start in range(0, len(paid), batch_size):
+            batch = paid[start:start + batch_size]
+            Bill.objects.filter(pk__in=[pk for _, pks in batch for pk in pks]).update(
+                paid=Case(*[When(pk__in=pks, then=Value(amount)) for amount, pks in batch],
+                          output_field=DecimalField()),
+                state='success', paid_at=now, delivered_at=now)
+        ClientLedgerEntry.post(ledger)
+        for sales_point_id, amount in sales_point_credits.items():
+            sales_points[sales_point_id].add_to_balance(amount)
+    return len(settlements)
+
+# State a bill must be in to be moved to each state. Bills are only marked
+# delivered by settle_bills(), which also books the payment.
+BILL_TRANSITIONS = {'pending': 'created'}
+# Timestamp set by each transition
+BILL_TRANSITION_STAMPS = {'pending': 'pending_at'}
+
+def dispatch_bills(bills, changes):
+    """Assigns a deliverer to and/or moves a set of bills to a state of
+    BILL_TRANSITIONS.
+
+    changes may hold 'deliverer' (None to unassign) and 'state'. Runs as
+    one UPDATE guarded by the allowed transitions: bills already in the
+    target state only get the deliverer, and if any other bill is not in
+    the state it must come from, nothing is changed.
+    """
+    fields = {}
+    if 'deliverer' in changes:
+        fields['deliverer'] = changes['deliverer']
+    state = changes.get('state')
+    if state:
+        source = BILL_TRANSITIONS[state]
+        stamp = BILL_TRANSITION_STAMPS[state]
+        fields['state'] = state
+        fields[stamp] = Case(When(state=source, then=Value(timezone.now())), default=F(stamp))
+    with transaction.atomic():
+        selected = bills.count()
+        updated = (bills.filter(state__in=[source, state]) if state else bills).update(**fields)
+        if updated != selected:
+            blocked = bills.exclude(state__in=[source, state]).values_list('bill_number', flat=True)[:50]
+            raise serializers.ValidationError({'state': [
+                f"Bill {number} cannot be moved to '{state}'." for number in blocked]})
+    return updated
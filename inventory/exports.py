@@ -0,0 +1,235 @@
+import csv
+import os
+from .models import Bill, ProductBill, PackageProductBill, Product
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed by the columnar exports
+    pa = None
+    pq = None
+
+
+# Columns of each dataset as (column name, ORM path, type). Rows are read in
+# partition order (sales point, then month) so that a single file is open at
+# a time and memory only holds one batch.
+COLUMNAR_DATASETS = {
+    'bills': {
+        'model': Bill,
+        'enterprise': 'enterprise',
+        'columns': [
+            ('id', 'id', 'int'),
+            ('bill_number', 'bill_number', 'str'),
+            ('sales_point_id', 'sales_point_id', 'int'),
+            ('customer_id', 'customer_id', 'int'),
+            ('customer_name', 'customer_name', 'str'),
+            ('deliverer_id', 'deliverer_id', 'int'),
+            ('state', 'state', 'str'),
+            ('created_at', 'created_at', 'datetime'),
+            ('delivery_date', 'delivery_date', 'datetime'),
+            ('pending_at', 'pending_at', 'datetime'),
+            ('delivered_at', 'delivered_at', 'datetime'),
+            ('paid_at', 'paid_at', 'datetime'),
+            ('paid', 'paid', 'money'),
+            ('total_amount', 'total_amount', 'money'),
+            ('package_amount', 'package_amount', 'money'),
+        ],
+        'partition': ('sales_point_id', 'created_at'),
+    },
+    'product_bills': {
+        'model': ProductBill,
+        'enterprise': 'bill__enterprise',
+        'columns': [
+            ('id', 'id', 'int'),
+            ('bill_id', 'bill_id', 'int'),
+            ('sales_point_id', 'bill__sales_point_id', 'int'),
+            ('bill_created_at', 'bill__created_at', 'datetime'),
+            ('product_id', 'product_id', 'int'),
+            ('is_variant', 'is_variant', 'bool'),
+            ('variant_id', 'variant_id', 'int'),
+            ('sell_price_id', 'sell_price_id', 'int'),
+            ('price', 'unit_price', 'money'),
+            ('quantity', 'quantity', 'int'),
+            ('created_at', 'created_at', 'datetime'),
+        ],
+        'partition': ('sales_point_id', 'bill_created_at'),
+    },
+    'package_product_bills': {
+        'model': PackageProductBill,
+        'enterprise': 'product_bill__bill__enterprise',
+        'columns': [
+            ('id', 'id', 'int'),
+            ('product_bill_id', 'product_bill_id', 'int'),
+            ('bill_id', 'product_bill__bill_id', 'int'),
+            ('sales_point_id', 'product_bill__bill__sales_point_id', 'int'),
+            ('bill_created_at', 'product_bill__bill__created_at', 'datetime'),
+            ('packaging_id', 'packaging_id', 'int'),
+            ('packaging_price', 'packaging__price', 'money'),
+            ('quantity', 'quantity', 'int'),
+            ('record', 'record', 'int'),
+        ],
+        'partition': ('sales_point_id', 'bill_created_at'),
+    },
+    'products': {
+        'model': Product,
+        'enterprise': 'enterprise',
+        'columns': [
+            ('id', 'id', 'int'),
+            ('sales_point_id', 'sales_point_id', 'int'),
+            ('name', 'name', 'str'),
+            ('product_code', 'product_code', 'str'),
+            ('category_id', 'category_id', 'int'),
+            ('category', 'category__name', 'str'),
+            ('supplier_id', 'supplier_id', 'int'),
+            ('supplier', 'supplier__name', 'str'),
+            ('package_id', 'package_id', 'int'),
+            ('price', 'price', 'money'),
+            ('is_beer', 'is_beer', 'bool'),
+            ('with_variant', 'with_variant', 'bool'),
+            ('created_at', 'created_at', 'datetime'),
+        ],
+        'partition': ('sales_point_id', None),
+    },
+}
+
+
+def columnar_schema(dataset):
+    types = {
+        'int': pa.int64(),
+        'str': pa.string(),
+        'bool': pa.bool_(),
+        'money': pa.decimal128(20, 2),
+        'datetime': pa.timestamp('us', tz='UTC'),
+    }
+    return pa.schema([(name, types[kind]) for name, _, kind in COLUMNAR_DATASETS[dataset]['columns']])
+
+def columnar_rows(dataset, enterprise, sales_point_ids, start=None, end=None):
+    # Only ever the given sales points: no ids means an empty export
+    spec = COLUMNAR_DATASETS[dataset]
+    paths = {name: path for name, path, _ in spec['columns']}
+    sales_point_field, date_field = spec['partition']
+    queryset = spec['model'].objects.filter(**{spec['enterprise']: enterprise,
+                                               f"{paths[sales_point_field]}__in": sales_point_ids})
+    if date_field and start:
+        queryset = queryset.filter(**{f"{paths[date_field]}__gte": start})
+    if date_field and end:
+        queryset = queryset.filter(**{f"{paths[date_field]}__lte": end})
+    ordering = [paths[sales_point_field]] + ([paths[date_field]] if date_field else []) + ['id']
+    return queryset.order_by(*ordering).values_list(*paths.values())
+
+def _record_batches(dataset, rows, batch_size):
+    spec = COLUMNAR_DATASETS[dataset]
+    names = [name for name, _, _ in spec['columns']]
+    sales_point_index = names.index(spec['partition'][0])
+    date_index = names.index(spec['partition'][1]) if spec['partition'][1] else None
+    schema = columnar_schema(dataset)
+
+    columns = [[] for _ in names]
+    partition = None
+    # iterator() reads through a server-side cursor on PostgreSQL
+    for row in rows.iterator(chunk_size=batch_size):
+        month = row[date_index].strftime('%Y-%m') if date_index is not None else None
+        row_partition = (row[sales_point_index], month)
+        if columns[0] and (row_partition != partition or len(columns[0]) >= batch_size):
+            yield partition, pa.record_batch(columns, schema=schema)
+            columns = [[] for _ in names]
+        partition = row_partition
+        for column, value in zip(columns, row):
+            column.append(value)
+    if columns[0]:
+        yield partition, pa.record_batch(columns, schema=schema)
+
+def write_columnar_export(dataset, rows, root, file_format='parquet', batch_size=10000):
+    schema = columnar_schema(dataset)
+    extension = 'parquet' if file_format == 'parquet' else 'arrow'
+    written = []
+    writer = None
+    current = None
+    try:
+        for partition, batch in _record_batches(dataset, rows, batch_size):
+            if partition != current:
+                if writer:
+                    writer.close()
+                sales_point_id, month = partition
+                directory = os.path.join(root, dataset, f"sales_point={sales_point_id}")
+                if month:
+                    directory = os.path.join(directory, f"month={month}")
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.join(directory, f"part-0.{extension}")
+                if file_format == 'parquet':
+                    writer = pq.ParquetWriter(path, schema)
+                else:
+                    writer = pa.ipc.new_file(path, schema)
+                current = partition
+                written.append(path)
+            writer.write_batch(batch)
+    finally:
+        if writer:
+            writer.close()
+    return written
+
+class _ChunkSink:
+    # File-like object collecting what the Arrow writer produces so that it
+    # can be handed to a streaming response batch by batch.
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+def stream_arrow(dataset, rows, batch_size=10000):
+    sink = _ChunkSink()
+    writer = pa.ipc.new_stream(sink, columnar_schema(dataset))
+    yield from sink.drain()
+    for _, batch in _record_batches(dataset, rows, batch_size):
+        writer.write_batch(batch)
+        yield from sink.drain()
+    writer.close()
+    yield from sink.drain()
+
+
+# Flat (CSV / NDJSON) exports of the list views. Columns are (name, attribute
+# path or callable) pairs read from model instances, so that properties and
+# prefetched relations can be used.
+def _resolve(obj, path):
+    if callable(path):
+        return path(obj)
+    for attr in path.split('.'):
+        if obj is None:
+            return None
+        obj = getattr(obj, attr)
+    return obj
+
+def export_rows(queryset, columns, chunk_size=2000):
+    # iterator() with prefetch_related() runs the prefetch once per chunk
+    for obj in queryset.iterator(chunk_size=chunk_size):
+        yield [_resolve(obj, path) for _, path in columns]
+
+class _Echo:
+    # Pseudo buffer: csv.writer hands each formatted line straight back
+    def write(self, value):
+        return value
+
+def stream_csv(columns, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow([name for name, _ in columns])
+    for row in rows:
+        yield writer.writerow(row)
+
+def stream_records(columns, rows):
+    names = [name for name, _ in columns]
+    for row in rows:
+        yield dict(zip(names, row))
@@ -1,2 +1,427 @@
-from inventory.models import PackagingHistory
+import json
+from decimal import Decimal, InvalidOperation
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import (Case, When, F, Q, Sum, Count, Avg, Subquery, OuterRef, ExpressionWrapper,
+                              DecimalField, IntegerField, DurationField, Value)
+from django.db.models.functions import Coalesce, ExtractIsoWeekDay, ExtractHour, Round, Greatest
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from datetime import datetime, time, timedelta
+from rest_framework.exceptions import ValidationError
+from .models import (Product, Variant, Packaging, SalesPoint, StockMovement, StockSnapshot,
+                     StockSnapshotLine, Bill, RecordedPackaging, UNPAID_BILLS, SalesHeatmapCell, SellPriceHistory,
+                     ClientCategoryPrice, Client, ClientLedgerEntry,
+                     ProductBill, PackageProductBill, ClientPackagingBalance)
 
+
+def stream_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+def parse_report_datetime(value, end_of_day=False):
+    # Accepts a datetime or a bare date, which stands for the start (or the
+    # end) of that day. Returns None when the value cannot be parsed.
+    try:
+        day = parse_date(value)
+        if day:
+            result = datetime.combine(day, time.max if end_of_day else time.min)
+        else:
+            result = parse_datetime(value)
+    except ValueError:
+        return None
+    if result is not None and timezone.is_naive(result):
+        result = timezone.make_aware(result)
+    return result
+
+def report_date_range(params):
+    # (start, end) from the start_date and end_date query parameters, None
+    # where missing. A value that does not parse is a 400 on that parameter.
+    dates = []
+    for param, end_of_day in (('start_date', False), ('end_date', True)):
+        value = params.get(param)
+        if value:
+            value = parse_report_datetime(value, end_of_day=end_of_day)
+            if value is None:
+                raise ValidationError({param: 'Invalid date.'})
+        dates.append(value or None)
+    return dates
+
+# Parsers of the cells of uploaded files (product imports, stocktake
+# counts). They raise ValueError({field: message}).
+
+def name_key(name):
+    # Categories, suppliers, packagings and variants are matched by name
+    # regardless of case and surrounding spaces
+    return name.strip().casefold()
+
+def parse_amount(value, field):
+    try:
+        return Decimal(value.replace(',', '.')).quantize(Decimal('0.01'))
+    except (InvalidOperation, AttributeError):
+        raise ValueError({field: f"'{value}' is not a valid amount."})
+
+def parse_quantity(value, field):
+    try:
+        quantity = int(value or 0)
+    except ValueError:
+        raise ValueError({field: f"'{value}' is not a valid quantity."})
+    if quantity < 0:
+        raise ValueError({field: 'Quantity cannot be negative.'})
+    return quantity
+
+def get_report_sales_points(user, sales_point_ids=None):
+    # Admins may pick any sales point of their enterprise, everyone else is
+    # restricted to their own.
+    if user.user_type == 'admin':
+        queryset = SalesPoint.objects.filter(enterprise=user.enterprise)
+        if sales_point_ids:
+            queryset = queryset.filter(id__in=sales_point_ids)
+        return queryset
+    return SalesPoint.objects.filter(pk=user.sales_point_id)
+
+def take_stock_snapshot(sales_point, batch_size=2000):
+    snapshot = StockSnapshot.objects.create(sales_point=sales_point)
+    lines = []
+    products = Product.objects.filter(sales_point=sales_point).annotate(
+        stock=_live_product_quantity()).values_list('id', 'stock')
+    for product_id, stock in products.iterator(chunk_size=batch_size):
+        lines.append(StockSnapshotLine(snapshot=snapshot, product_id=product_id, quantity=stock))
+        if len(lines) >= batch_size:
+            StockSnapshotLine.objects.bulk_create(lines)
+            lines = []
+    packagings = Packaging.objects.filter(sales_point=sales_point).values_list('id', 'full_quantity')
+    for packaging_id, full_quantity in packagings.iterator(chunk_size=batch_size):
+        lines.append(StockSnapshotLine(snapshot=snapshot, packaging_id=packaging_id, quantity=full_quantity))
+        if len(lines) >= batch_size:
+            StockSnapshotLine.objects.bulk_create(lines)
+            lines = []
+    StockSnapshotLine.objects.bulk_create(lines)
+    return snapshot
+
+def _live_product_quantity():
+    variants_quantity = Variant.objects.filter(product=OuterRef('pk')).values('product').annotate(
+        total=Sum('quantity')).values('total')
+    return Case(
+        When(with_variant=True, then=Coalesce(Subquery(variants_quantity), 0)),
+        default=F('quantity'),
+        output_field=IntegerField(),
+    )
+
+def _nearest_stock_base(sales_point, at):
+    # Returns (snapshot or None for the live stock, base time, direction of
+    # the replay). Live stock acts as a snapshot taken now.
+    now = timezone.now()
+    if at is None or at >= now:
+        return None, now, 0
+    before = StockSnapshot.objects.filter(sales_point=sales_point, taken_at__lte=at).order_by('-taken_at').first()
+    after = StockSnapshot.objects.filter(sales_point=sales_point, taken_at__gt=at).order_by('taken_at').first()
+    after_time = after.taken_at if after else now
+    if before and at - before.taken_at <= after_time - at:
+        return before, before.taken_at, 1
+    return after, after_time, -1
+
+def stock_valuation(sales_point, at=None, group_by=None):
+    snapshot, base_time, direction = _nearest_stock_base(sales_point, at)
+
+    if snapshot is None:
+        product_base = _live_product_quantity()
+        packaging_base = F('full_quantity')
+    else:
+        product_base = Coalesce(Subquery(StockSnapshotLine.objects.filter(
+            snapshot=snapshot, product=OuterRef('pk')).values('quantity')[:1]), 0)
+        packaging_base = Coalesce(Subquery(StockSnapshotLine.objects.filter(
+            snapshot=snapshot, packaging=OuterRef('pk')).values('quantity')[:1]), 0)
+
+    if direction:
+        start, end = (base_time, at) if direction > 0 else (at, base_time)
+        window = Q(created_at__gt=start, created_at__lte=end)
+        product_moves = StockMovement.objects.filter(window, product=OuterRef('pk')).values(
+            'product').annotate(total=Sum('quantity')).values('total')
+        packaging_moves = StockMovement.objects.filter(window, packaging=OuterRef('pk')).values(
+            'packaging').annotate(total=Sum('quantity')).values('total')
+        product_stock = product_base + direction * Coalesce(Subquery(product_moves), 0)
+        packaging_stock = packaging_base + direction * Coalesce(Subquery(packaging_moves), 0)
+    else:
+        product_stock = product_base
+        packaging_stock = packaging_base
+
+    value_field = DecimalField(max_digits=20, decimal_places=2)
+    products = Product.objects.filter(sales_point=sales_point).annotate(
+        stock=ExpressionWrapper(product_stock, output_field=IntegerField()))
+    packagings = Packaging.objects.filter(sales_point=sales_point).annotate(
+        stock=ExpressionWrapper(packaging_stock, output_field=IntegerField()))
+
+    if group_by == 'category':
+        product_groups = ['category', 'category__name']
+        packaging_groups = []
+    elif group_by == 'supplier':
+        product_groups = ['supplier', 'supplier__name']
+        packaging_groups = ['supplier', 'supplier__name']
+    else:
+        product_groups = []
+        packaging_groups = []
+
+    valued_at = at or timezone.now()
+    for kind, queryset, groups in (('product', products, product_groups),
+                                   ('packaging', packagings, packaging_groups)):
+        rows = queryset.values('sales_point', *groups).annotate(
+            quantity=Sum('stock'),
+            value=Sum(ExpressionWrapper(F('stock') * F('price'), output_field=value_field)),
+        ).order_by(*groups)
+        for row in rows.iterator():
+            row['kind'] = kind
+            row['date'] = valued_at
+            row['quantity'] = row['quantity'] or 0
+            row['value'] = row['value'] or 0
+            yield row
+
+CLIENT_STATEMENT_SQL = """
+    SELECT entry_date, entry_order, entry_id, entry_type, bill_id, bill_number, debit, credit,
+           SUM(debit - credit) OVER (
+               ORDER BY entry_date, entry_order, entry_id
+               ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+           ) AS balance
+    FROM (
+        SELECT b.created_at AS entry_date, 'bill' AS entry_type, 0 AS entry_order, b.id AS entry_id,
+               b.id AS bill_id, b.bill_number, b.total_amount AS debit, 0 AS credit
+        FROM {bill} b WHERE b.customer_id = %(client)s
+        UNION ALL
+        SELECT b.created_at, 'packaging_deposit', 1, b.id, b.id, b.bill_number, b.package_amount, 0
+        FROM {bill} b WHERE b.customer_id = %(client)s AND b.package_amount > 0
+        UNION ALL
+        SELECT COALESCE(b.paid_at, b.delivery_date), 'payment', 2, b.id, b.id, b.bill_number, 0, b.paid
+        FROM {bill} b WHERE b.customer_id = %(client)s AND b.paid > 0
+        UNION ALL
+        SELECT r.created_at, 'packaging_refund', 3, r.id, r.bill_id, b.bill_number, 0, r.repay
+        FROM {recorded} r LEFT JOIN {bill} b ON b.id = r.bill_id
+        WHERE r.customer_id = %(client)s AND r.repay > 0
+    ) entries
+"""
+
+def _to_decimal(value):
+    return Decimal(str(value)).quantize(Decimal('0.01'))
+
+def client_statement(client, start=None, end=None, chunk_size=2000):
+    # The running balance is computed over the whole history so that a date
+    # range still starts from the right opening balance.
+    sql = CLIENT_STATEMENT_SQL.format(bill=Bill._meta.db_table, recorded=RecordedPackaging._meta.db_table)
+    conditions = []
+    params = {'client': client.pk}
+    if start:
+        conditions.append('entry_date >= %(start)s')
+        params['start'] = connection.ops.adapt_datetimefield_value(start)
+    if end:
+        conditions.append('entry_date <= %(end)s')
+        params['end'] = connection.ops.adapt_datetimefield_value(end)
+    sql = f"SELECT * FROM ({sql}) statement"
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY entry_date, entry_order, entry_id'
+
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                entry = dict(zip(columns, row))
+                del entry['entry_order'], entry['entry_id']
+                for key in ('debit', 'credit', 'balance'):
+                    entry[key] = _to_decimal(entry[key])
+                yield entry
+
+AGING_BUCKETS = [('0_30', 0, 30), ('31_60', 30, 60), ('61_90', 60, 90), ('90_plus', 90, None)]
+
+def receivables_aging(bills, group_by='client', as_of=None):
+    as_of = as_of or timezone.now()
+    outstanding = ExpressionWrapper(
+        F('total_amount') + F('package_amount') - Coalesce(F('paid'), 0, output_field=DecimalField()),
+        output_field=DecimalField(max_digits=20, decimal_places=2))
+
+    buckets = {}
+    for name, newest, oldest in AGING_BUCKETS:
+        condition = Q(created_at__lte=as_of - timedelta(days=newest))
+        if oldest is not None:
+            condition &= Q(created_at__gt=as_of - timedelta(days=oldest))
+        buckets[name] = Coalesce(Sum(outstanding, filter=condition), 0, output_field=DecimalField())
+
+    if group_by == 'sales_point':
+        groups = ['sales_point', 'sales_point__name']
+    else:
+        groups = ['customer', 'customer__name', 'customer__surname', 'sales_point']
+
+    return bills.filter(UNPAID_BILLS, created_at__lte=as_of).values(*groups).annotate(
+        bills=Count('id'), total=Sum(outstanding), **buckets).order_by(*groups)
+
+def deliverer_report(bills, now=None):
+    now = now or timezone.now()
+    to_pending = ExpressionWrapper(F('pending_at') - F('created_at'), output_field=DurationField())
+    to_delivered = ExpressionWrapper(F('delivered_at') - F('pending_at'), output_field=DurationField())
+    rows = bills.values('deliverer', 'deliverer__name', 'deliverer__surname').annotate(
+        created=Count('id', filter=Q(state='created')),
+        pending=Count('id', filter=Q(state='pending')),
+        success=Count('id', filter=Q(state='success')),
+        overdue=Count('id', filter=Q(delivery_date__lt=now) & ~Q(state='success')),
+        avg_to_pending=Avg(to_pending, filter=Q(pending_at__isnull=False)),
+        avg_to_delivered=Avg(to_delivered, filter=Q(pending_at__isnull=False, delivered_at__isnull=False)),
+    ).order_by('deliverer')
+    for row in rows:
+        for key in ('avg_to_pending', 'avg_to_delivered'):
+            row[key] = row[key].total_seconds() if row[key] is not None else None
+        yield row
+
+def rebuild_sales_heatmap(sales_point):
+    cells = Bill.objects.filter(sales_point=sales_point).annotate(
+        weekday=ExtractIsoWeekDay('created_at'), hour=ExtractHour('created_at')).values(
+        'weekday', 'hour').annotate(bill_count=Count('id'), revenue=Sum('total_amount')).order_by()
+    with transaction.atomic():
+        SalesHeatmapCell.objects.filter(sales_point=sales_point).delete()
+        SalesHeatmapCell.objects.bulk_create([
+            SalesHeatmapCell(sales_point=sales_point, weekday=cell['weekday'], hour=cell['hour'],
+                             bills=cell['bill_count'], revenue=cell['revenue'] or 0)
+            for cell in cells
+        ])
+
+def rebuild_client_balances(sales_point, fix=True):
+    # Recomputes the balances of the clients of a sales point (None for those
+    # without one) from their ledger with one grouped query, and returns the
+    # clients whose stored balance had drifted as (id, stored, ledger).
+    clients = Client.objects.filter(sales_point=sales_point) if sales_point else Client.objects.filter(
+        sales_point__isnull=True)
+    rows = clients.annotate(ledger_balance=Sum('ledger_entries__amount')).values_list(
+        'id', 'balance', 'ledger_balance').order_by()
+    drift = []
+    for client_id, balance, ledger_balance in rows.iterator(chunk_size=2000):
+        ledger_balance = _to_decimal(ledger_balance or 0)
+        if _to_decimal(balance) != ledger_balance:
+            drift.append((client_id, balance, ledger_balance))
+    if fix:
+        # Recomputed in the UPDATE itself so that entries posted meanwhile count
+        ledger_balance = ClientLedgerEntry.objects.filter(client=OuterRef('pk')).values('client').annotate(
+            total=Sum('amount')).values('total')
+        drifted = [client_id for client_id, _, _ in drift]
+        with transaction.atomic():
+            for start in range(0, len(drifted), 2000):
+                Client.objects.filter(pk__in=drifted[start:start + 2000]).update(
+                    balance=Coalesce(Subquery(ledger_balance), Value(0), output_field=DecimalField()))
+    return drift
+
+CLIENT_PACKAGING_SQL = """
+    SELECT client_id, packaging_id, SUM(crates) AS crates
+    FROM (
+        SELECT b.customer_id AS client_id, ppb.packaging_id, ppb.record AS crates
+        FROM {package_product_bill} ppb
+        JOIN {product_bill} pb ON pb.id = ppb.product_bill_id
+        JOIN {bill} b ON b.id = pb.bill_id
+        WHERE b.customer_id IS NOT NULL AND ppb.record > 0
+        UNION ALL
+        SELECT r.customer_id, r.packaging_id, -r.quantity
+        FROM {recorded} r
+    ) deposits
+    JOIN {client} c ON c.id = deposits.client_id
+    {where}
+    GROUP BY client_id, packaging_id
+    HAVING SUM(crates) != 0
+"""
+
+def rebuild_client_packaging(sales_point=None):
+    # Recomputes the crates owed by the clients (of a sales point, or all of
+    # them) with one grouped query, and returns the number of rows
+    sql = CLIENT_PACKAGING_SQL.format(
+        package_product_bill=PackageProductBill._meta.db_table, product_bill=ProductBill._meta.db_table,
+        bill=Bill._meta.db_table, recorded=RecordedPackaging._meta.db_table, client=Client._meta.db_table,
+        where='WHERE c.sales_point_id = %(sales_point)s' if sales_point else '')
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {'sales_point': sales_point.pk if sales_point else None})
+            rows = cursor.fetchall()
+        balances = ClientPackagingBalance.objects.all()
+        if sales_point:
+            balances = balances.filter(client__sales_point=sales_point)
+        balances.delete()
+        ClientPackagingBalance.objects.bulk_create([
+            ClientPackagingBalance(client_id=client_id, packaging_id=packaging_id, crates=crates)
+            for client_id, packaging_id, crates in rows
+        ], batch_size=2000)
+    return len(rows)
+
+def sales_heatmap(sales_point):
+    bills = [[0] * 24 for _ in range(7)]
+    revenue = [[0] * 24 for _ in range(7)]
+    for cell in SalesHeatmapCell.objects.filter(sales_point=sales_point):
+        bills[cell.weekday - 1][cell.hour] = cell.bills
+        revenue[cell.weekday - 1][cell.hour] = cell.revenue
+    return {'sales_point': sales_point.id, 'name': sales_point.name, 'bills': bills, 'revenue': revenue}
+
+
+def catalogue_cache_key(sales_point_id):
+    return f'catalogue:{sales_point_id}'
+
+CATALOGUE_CACHE_TIMEOUT = 300
+
+def invalidate_catalogue_cache(sales_point_ids):
+    cache.delete_many([catalogue_cache_key(sales_point_id) for sales_point_id in set(sales_point_ids)])
+
+def client_category_price_map(sales_point_id):
+    # {client_category_id: {sell_price_id: price}} of the products of a sales
+    # point, built with one query and cached until invalidate_catalogue_cache
+    key = catalogue_cache_key(sales_point_id)
+    price_map = cache.get(key)
+    if price_map is None:
+        price_map = {}
+        rows = ClientCategoryPrice.objects.filter(sell_price__product__sales_point_id=sales_point_id).values_list(
+            'client_category_id', 'sell_price_id', 'price')
+        for client_category_id, sell_price_id, price in rows:
+            price_map.setdefault(client_category_id, {})[sell_price_id] = price
+        cache.set(key, price_map, CATALOGUE_CACHE_TIMEOUT)
+    return price_map
+
+def bill_unit_prices(bill, sell_price_ids):
+    # {sell_price_id: price} for the lines of a bill: the price at the bill
+    # date, overridden by the price list of the customer's category
+    unit_prices = SellPriceHistory.prices_at(sell_price_ids, bill.created_at)
+    if bill.customer_id and bill.sales_point_id:
+        category_prices = client_category_price_map(bill.sales_point_id).get(bill.customer.client_category_id, {})
+        unit_prices.update((pk, category_prices[pk]) for pk in sell_price_ids if pk in category_prices)
+    return unit_prices
+
+def reprice_expression(rule, value, rounding=None):
+    # New SellPrice.price for a repricing rule, evaluated by the database
+    money = DecimalField(max_digits=10, decimal_places=2)
+    if rule == 'percent':
+        price = F('price') * Value(1 + value / 100)
+    elif rule == 'delta':
+        price = F('price') + Value(value)
+    else:  # margin over the purchase price of the product
+        cost = Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('price')[:1])
+        price = cost * Value(1 + value / 100)
+    price = ExpressionWrapper(price, output_field=money)
+    if rounding:
+        price = Round(price / Value(rounding)) * Value(rounding)
+    return Greatest(Round(price, 2, output_field=money), Value(Decimal('0')), output_field=money)
+
+def reprice_sell_prices(sell_prices, rule, value, rounding=None, dry_run=False, sample_size=20):
+    """Applies a repricing rule to a SellPrice queryset with a single UPDATE.
+
+    With dry_run nothing is written and a sample of old and new prices is
+    returned instead. Catalogue caches of the touched sales points are
+    invalidated once, after the update.
+    """
+    new_price = reprice_expression(rule, value, rounding)
+    result = {'count': sell_prices.count()}
+    if dry_run:
+        result['sample'] = list(sell_prices.annotate(new_price=new_price).order_by('id').values(
+            'id', 'product_id', 'product__name', 'price', 'new_price')[:sample_size])
+        return result
+    sales_point_ids = sell_prices.values_list('product__sales_point_id', flat=True).distinct()
+    sales_point_ids = [pk for pk in sales_point_ids if pk]
+    now = timezone.now()
+    with transaction.atomic():
+        result['count'] = sell_prices.update(price=new_price, last_update=now)
+        SellPriceHistory.record(sell_prices.values('pk'), at=now)
+    invalidate_catalogue_cache(sales_point_ids)
+    return result
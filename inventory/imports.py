@@ -0,0 +1,295 @@
+import csv
+import io
+from collections import defaultdict
+from django.db import connection, transaction
+from django.utils import timezone
+from .billing import apply_packaging_deltas
+from .functions import name_key, parse_amount, parse_quantity
+from .models import (Product, Variant, SellPrice, SellPriceHistory, Category, Supplier, Packaging,
+                     PackagingHistory, StockMovement)
+
+try:
+    import openpyxl
+except ImportError:  # openpyxl is only needed to import .xlsx files
+    openpyxl = None
+
+
+PRODUCT_IMPORT_COLUMNS = ['product_code', 'name', 'category', 'supplier', 'package', 'price', 'quantity',
+                          'is_beer', 'sell_prices', 'variant', 'variant_quantity']
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 'x'}
+# Product fields an import row can change
+PRODUCT_IMPORT_FIELDS = ['name', 'category', 'supplier', 'package', 'price', 'is_beer', 'with_variant', 'quantity']
+
+
+def read_import_rows(uploaded_file):
+    # Yields (row number, dict) from a .csv or .xlsx upload without loading it whole
+    if uploaded_file.name.lower().endswith('.xlsx'):
+        workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(name or '').strip().lower() for name in next(rows, [])]
+        for number, values in enumerate(rows, start=2):
+            yield number, {name: '' if value is None else str(value).strip() for name, value in zip(header, values)}
+        workbook.close()
+    else:
+        reader = csv.DictReader(io.TextIOWrapper(uploaded_file, encoding='utf-8-sig'))
+        reader.fieldnames = [name.strip().lower() for name in reader.fieldnames or []]
+        for number, row in enumerate(reader, start=2):
+            yield number, {name: (value or '').strip() for name, value in row.items() if name}
+
+def _product_values(product):
+    return tuple(getattr(product, field.attname) for field in
+                 (Product._meta.get_field(name) for name in PRODUCT_IMPORT_FIELDS))
+
+def _update_column(model, name, values, now, batch_size=500):
+    # Sets {pk: value} on one column with UPDATE ... SET column = CASE pk
+    # WHEN ... END per batch. Written as SQL: bulk_update() spends far more
+    # time building one When() per row than the database spends running it.
+    field = model._meta.get_field(name)
+    quote = connection.ops.quote_name
+    pk_column = quote(model._meta.pk.column)
+    last_update = model._meta.get_field('last_update')
+    case = f"CASE {pk_column} {{}} END"
+    if connection.features.requires_casted_case_in_updates:
+        case = f"CAST({case} AS {field.db_type(connection)})"
+    items = list(values.items())
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        params = [param for pk, value in batch for param in (pk, field.get_db_prep_save(value, connection))]
+        params.append(last_update.get_db_prep_save(now, connection))
+        params.extend(pk for pk, _ in batch)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {quote(model._meta.db_table)} SET {quote(field.column)} = "
+                f"{case.format(' '.join(['WHEN %s THEN %s'] * len(batch)))}, {quote(last_update.column)} = %s "
+                f"WHERE {pk_column} IN ({', '.join(['%s'] * len(batch))})", params)
+
+
+class ProductImport:
+    """Upserts products, variants and sell prices of one sales point from
+    import rows, keyed by product_code.
+
+    Categories, suppliers and packagings are resolved by name from maps built
+    once. Rows are written in chunks, each in its own transaction, with a
+    fixed number of queries per chunk. Beer products move their quantity from
+    empty to full crates, as ProductSerializer.create does.
+    """
+    # Above this many new values of a field, changed products are written
+    # with bulk_update rather than one UPDATE per value
+    few_values = 20
+
+    def __init__(self, user, sales_point, chunk_size=2000):
+        self.user = user
+        self.sales_point = sales_point
+        self.chunk_size = chunk_size
+        self.categories = {name_key(c.name): c for c in Category.objects.filter(sales_point=sales_point)}
+        self.suppliers = {name_key(s.name): s for s in Supplier.objects.filter(sales_point=sales_point)}
+        self.packagings = {name_key(p.name): p for p in Packaging.objects.filter(sales_point=sales_point)}
+        self.packagings_by_id = {p.pk: p for p in self.packagings.values()}
+        self.summary = {'rows': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'variants': 0, 'sell_prices': 0,
+                        'errors': []}
+
+    def run(self, rows):
+        chunk = []
+        for number, row in rows:
+            self.summary['rows'] += 1
+            chunk.append((number, row))
+            if len(chunk) >= self.chunk_size:
+                self._import_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._import_chunk(chunk)
+        return self.summary
+
+    def _parse(self, row):
+        code = row.get('product_code')
+        if not code:
+            raise ValueError({'product_code': 'This field is required.'})
+        if not row.get('name'):
+            raise ValueError({'name': 'This field is required.'})
+        category = self.categories.get(name_key(row.get('category', '')))
+        if category is None:
+            raise ValueError({'category': f"Unknown category '{row.get('category', '')}'."})
+        supplier = self.suppliers.get(name_key(row.get('supplier', '')))
+        if supplier is None:
+            raise ValueError({'supplier': f"Unknown supplier '{row.get('supplier', '')}'."})
+        is_beer = row.get('is_beer', '').lower() in TRUE_VALUES
+        package = None
+        if row.get('package'):
+            package = self.packagings.get(name_key(row['package']))
+            if package is None:
+                raise ValueError({'package': f"Unknown packaging '{row['package']}'."})
+        if is_beer and package is None:
+            raise ValueError({'package': 'Package must be provided if the product is beer.'})
+        return {
+            'code': code,
+            'name': row['name'],
+            'category': category,
+            'supplier': supplier,
+            'package': package,
+            'price': parse_amount(row.get('price') or '0', 'price'),
+            'quantity': parse_quantity(row.get('quantity'), 'quantity'),
+            'is_beer': is_beer,
+            'sell_prices': [parse_amount(price, 'sell_prices') for price in row.get('sell_prices', '').split('|') if price.strip()],
+            'variant': row.get('variant') or None,
+            'variant_quantity': parse_quantity(row.get('variant_quantity'), 'variant_quantity'),
+        }
+
+    def _import_chunk(self, chunk):
+        parsed = []
+        for number, row in chunk:
+            try:
+                parsed.append((number, self._parse(row)))
+            except ValueError as exc:
+                self.summary['errors'].append({'row': number, 'errors': exc.args[0]})
+        if not parsed:
+            return
+
+        with transaction.atomic():
+            codes = {data['code'] for _, data in parsed}
+            products = {product.product_code: product for product in
+                        Product.objects.filter(sales_point=self.sales_point, product_code__in=codes)}
+            # Values as stored before this chunk, to know what changed
+            stored_quantity = {code: (product.quantity, product.is_beer, product.package_id)
+                               for code, product in products.items()}
+            stored_values = {code: _product_values(product) for code, product in products.items()}
+            now = timezone.now()
+            new_products = {}
+            touched = {}
+            for number, data in parsed:
+                product = products.get(data['code'])
+                if product is None:
+                    product = Product(product_code=data['code'], sales_point=self.sales_point,
+                                      enterprise=self.user.enterprise)
+                    products[data['code']] = new_products[data['code']] = product
+                product.name = data['name']
+                product.category = data['category']
+                product.supplier = data['supplier']
+                product.package = data['package']
+                product.price = data['price']
+                product.is_beer = data['is_beer']
+                product.quantity = data['quantity']
+                product.with_variant = product.with_variant or bool(data['variant'])
+                touched[data['code']] = (number, product)
+
+            self._apply_packaging(touched, stored_quantity)
+            kept = {code: product for code, (_, product) in touched.items() if not getattr(product, '_import_error', False)}
+
+            created = [product for code, product in new_products.items() if code in kept]
+            Product.objects.bulk_create(created, batch_size=500)
+            updated = [product for code, product in kept.items()
+                       if code not in new_products and _product_values(product) != stored_values[code]]
+            self._update_changed(updated, stored_values, now)
+            self.summary['created'] += len(created)
+            self.summary['updated'] += len(updated)
+            self.summary['unchanged'] += len(kept) - len(created) - len(updated)
+
+            movements = [StockMovement(sales_point=self.sales_point, product=product, quantity=product.quantity,
+                                       reason='create') for product in created if not product.with_variant and product.quantity]
+            for product in updated:
+                before = stored_quantity[product.product_code][0]
+                if not product.with_variant and product.quantity != before:
+                    movements.append(StockMovement(sales_point=self.sales_point, product=product,
+                                                   quantity=product.quantity - before, reason='adjustment'))
+            movements.extend(self.packaging_movements)
+            StockMovement.objects.bulk_create(movements, batch_size=1000)
+            PackagingHistory.objects.bulk_create(self.packaging_history, batch_size=1000)
+
+            self._upsert_variants_and_prices([(data, kept[data['code']]) for _, data in parsed if data['code'] in kept])
+
+    def _update_changed(self, products, stored_values, now):
+        # Per changed field: an UPDATE per new value when the field takes a
+        # few values (a category, a supplier), else one CASE per batch for
+        # values that differ per product (quantities, names, prices).
+        changes = defaultdict(lambda: defaultdict(list))
+        for product in products:
+            current = _product_values(product)
+            for name, before, after in zip(PRODUCT_IMPORT_FIELDS, stored_values[product.product_code], current):
+                if before != after:
+                    changes[name][after].append(product.pk)
+        for name, by_value in changes.items():
+            attname = Product._meta.get_field(name).attname
+            if len(by_value) <= self.few_values:
+                for value, pks in by_value.items():
+                    for start in range(0, len(pks), 500):
+                        Product.objects.filter(pk__in=pks[start:start + 500]).update(**{attname: value, 'last_update': now})
+            else:
+                _update_column(Product, name, {pk: value for value, pks in by_value.items() for pk in pks}, now)
+
+    def _apply_packaging(self, touched, stored_quantity):
+        # Crates follow the beer quantity: a product taking n more bottles
+        # turns n empty crates into full ones, and back when it takes fewer.
+        self.packaging_movements = []
+        self.packaging_history = []
+        full_deltas = defaultdict(int)
+        for code, (number, product) in touched.items():
+            before, was_beer, package_id = stored_quantity.get(code, (0, False, None))
+            moves = []
+            if was_beer and package_id in self.packagings_by_id:
+                moves.append((self.packagings_by_id[package_id], -before))
+            if product.is_beer:
+                moves.append((product.package, product.quantity))
+            moves = self._merge_moves(moves)
+            for packaging, delta in moves:
+                if delta > packaging.empty_quantity or -delta > packaging.full_quantity:
+                    product._import_error = True
+                    self.summary['errors'].append({'row': number, 'errors': {
+                        'quantity': 'Quantity cannot be greater than the empty quantity of the selected packaging.'}})
+                    break
+            else:
+                for packaging, delta in moves:
+                    full_before, empty_before = packaging.full_quantity, packaging.empty_quantity
+                    packaging.full_quantity += delta
+                    packaging.empty_quantity -= delta
+                    full_deltas[packaging.pk] += delta
+                    self.packaging_movements.append(StockMovement(sales_point=self.sales_point, packaging=packaging,
+                                                                  quantity=delta, empty_quantity=-delta, reason='create'))
+                    self.packaging_history.append(PackagingHistory(
+                        packaging=packaging, product=product, action='import',
+                        quantity_changed=abs(delta), full_quantity_before=full_before, empty_quantity_before=empty_before,
+                        full_quantity_after=packaging.full_quantity, empty_quantity_after=packaging.empty_quantity,
+                        performed_by=self.user, sales_point=self.sales_point))
+        apply_packaging_deltas(full_deltas, {pk: -delta for pk, delta in full_deltas.items()})
+
+    def _merge_moves(self, moves):
+        merged = {}
+        for packaging, delta in moves:
+            merged[packaging.pk] = (packaging, merged.get(packaging.pk, (packaging, 0))[1] + delta)
+        return [(packaging, delta) for packaging, delta in merged.values() if delta]
+
+    def _upsert_variants_and_prices(self, rows):
+        product_ids = {product.pk for _, product in rows}
+        variants = {(variant.product_id, name_key(variant.name)): variant
+                    for variant in Variant.objects.filter(product_id__in=product_ids)}
+        prices = set(SellPrice.objects.filter(product_id__in=product_ids).values_list('product_id', 'price'))
+        new_variants = {}
+        changed_variants = {}
+        stored_quantities = {}
+        new_prices = []
+        for data, product in rows:
+            if data['variant']:
+                key = (product.pk, name_key(data['variant']))
+                variant = variants.get(key) or new_variants.get(key)
+                if variant is None:
+                    new_variants[key] = Variant(product=product, name=data['variant'], quantity=data['variant_quantity'])
+                elif variant.quantity != data['variant_quantity']:
+                    if variant.pk and key not in changed_variants:
+                        stored_quantities[key] = variant.quantity
+                        changed_variants[key] = variant
+                    variant.quantity = data['variant_quantity']
+            for price in data['sell_prices']:
+                if (product.pk, price) not in prices:
+                    prices.add((product.pk, price))
+                    new_prices.append(SellPrice(product=product, price=price))
+        Variant.objects.bulk_create(new_variants.values(), batch_size=1000)
+        Variant.objects.bulk_update(changed_variants.values(), ['quantity'], batch_size=500)
+        movements = [StockMovement(sales_point=self.sales_point, product=variant.product, variant=variant,
+                                   quantity=variant.quantity, reason='create')
+                     for variant in new_variants.values() if variant.quantity]
+        movements.extend(StockMovement(sales_point=self.sales_point, product=variant.product, variant=variant,
+                                       quantity=variant.quantity - stored_quantities[key], reason='adjustment')
+                         for key, variant in changed_variants.items() if variant.quantity != stored_quantities[key])
+        StockMovement.objects.bulk_create(movements, batch_size=1000)
+        SellPrice.objects.bulk_create(new_prices, batch_size=1000)
+        SellPriceHistory.record([sell_price.pk for sell_price in new_prices])
+        self.summary['variants'] += len(new_variants) + len(changed_variants)
+        self.summary['sell_prices'] += len(new_prices)
@@ -0,0 +1,73 @@
+import threading
+import time
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction, OperationalError
+from inventory.models import SalesPoint
+
+
+MODES = ('save', 'atomic', 'sharded')
+
+
+class Command(BaseCommand):
+    help = ('Credit the balance of a scratch sales point from concurrent threads, once per update mode '
+            '(read-modify-save, atomic increment, sharded increment), and report throughput and lost updates.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--updates', type=int, default=200, help='Balance updates per thread.')
+        parser.add_argument('--shards', type=int, default=16)
+        parser.add_argument('--mode', choices=MODES, action='append', dest='modes')
+
+    def handle(self, *args, **options):
+        for mode in options['modes'] or MODES:
+            sales_point = SalesPoint.objects.create(name=f'balance benchmark ({mode})',
+                                                    balance_shards=options['shards'] if mode == 'sharded' else 0)
+            try:
+                elapsed, retries = self._run(sales_point, mode, options['threads'], options['updates'])
+                expected = Decimal(options['threads'] * options['updates'])
+                balance = SalesPoint.objects.get(pk=sales_point.pk).current_balance
+                updates = options['threads'] * options['updates']
+                self.stdout.write(f"{mode:>8}: {updates} updates in {elapsed:.2f}s ({updates / elapsed:.0f}/s), "
+                                  f"{retries} retries, balance {balance} of {expected} "
+                                  f"({expected - balance} lost)")
+            finally:
+                sales_point.delete()
+
+    def _run(self, sales_point, mode, threads, updates):
+        retries = []
+        barrier = threading.Barrier(threads)
+
+        def credit():
+            if mode == 'save':
+                # What the deliveries did before: read, add in Python, save
+                current = SalesPoint.objects.get(pk=sales_point.pk)
+                current.balance += 1
+                current.save(update_fields=['balance'])
+            else:
+                sales_point.add_to_balance(1)
+
+        def worker():
+            failed = 0
+            barrier.wait()
+            try:
+                for _ in range(updates):
+                    while True:
+                        try:
+                            with transaction.atomic():
+                                credit()
+                            break
+                        except OperationalError:
+                            # Lock timeouts of databases that refuse concurrent writers
+                            failed += 1
+            finally:
+                retries.append(failed)
+                connection.close()
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return time.perf_counter() - start, sum(retries)
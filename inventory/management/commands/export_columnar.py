@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from inventory import exports
+from inventory.functions import parse_report_datetime
+from inventory.models import Enterprise, SalesPoint
+
+
+class Command(BaseCommand):
+    help = 'Export bills, bill lines, packaging lines and products to Parquet or Arrow files partitioned by sales point and month.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('enterprise', type=int)
+        parser.add_argument('output')
+        parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet')
+        parser.add_argument('--dataset', choices=list(exports.COLUMNAR_DATASETS), action='append', dest='datasets')
+        parser.add_argument('--sales-point', type=int, action='append', dest='sales_points')
+        parser.add_argument('--start-date')
+        parser.add_argument('--end-date')
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        if exports.pa is None:
+            raise CommandError('pyarrow is required for columnar exports.')
+        try:
+            enterprise = Enterprise.objects.get(pk=options['enterprise'])
+        except Enterprise.DoesNotExist:
+            raise CommandError('Enterprise does not exist.')
+
+        start = parse_report_datetime(options['start_date']) if options['start_date'] else None
+        end = parse_report_datetime(options['end_date'], end_of_day=True) if options['end_date'] else None
+        if (options['start_date'] and start is None) or (options['end_date'] and end is None):
+            raise CommandError('Invalid --start-date or --end-date.')
+
+        sales_point_ids = options['sales_points'] or list(
+            SalesPoint.objects.filter(enterprise=enterprise).values_list('id', flat=True))
+        for dataset in options['datasets'] or exports.COLUMNAR_DATASETS:
+            rows = exports.columnar_rows(dataset, enterprise, sales_point_ids, start, end)
+            written = exports.write_columnar_export(dataset, rows, options['output'], options['format'],
+                                                    options['batch_size'])
+            self.stdout.write(f"{dataset}: {len(written)} files")
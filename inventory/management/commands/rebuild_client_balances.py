@@ -0,0 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connection
+from inventory.functions import rebuild_client_balances
+from inventory.models import SalesPoint
+
+
+class Command(BaseCommand):
+    help = 'Recompute the client balances of each sales point from the client ledger and report any drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sales-point', type=int, action='append', dest='sales_points')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--dry-run', action='store_true', help='Only report the drift.')
+
+    def handle(self, *args, **options):
+        sales_points = SalesPoint.objects.all()
+        if options['sales_points']:
+            sales_points = sales_points.filter(id__in=options['sales_points'])
+        sales_points = list(sales_points)
+        if not options['sales_points']:
+            # Clients without a sales point
+            sales_points.append(None)
+
+        def rebuild(sales_point):
+            try:
+                return sales_point, rebuild_client_balances(sales_point, fix=not options['dry_run'])
+            finally:
+                connection.close()
+
+        drifted = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for sales_point, drift in executor.map(rebuild, sales_points):
+                drifted += len(drift)
+                for client_id, balance, ledger_balance in drift:
+                    self.stdout.write(f"{sales_point or 'no sales point'}: client {client_id} "
+                                      f"balance {balance}, ledger {ledger_balance}")
+                self.stdout.write(f"{sales_point or 'no sales point'}: {len(drift)} drifted balances")
+        verb = 'found' if options['dry_run'] else 'fixed'
+        self.stdout.write(f"{drifted} drifted balances {verb}")
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from inventory.functions import rebuild_client_packaging
+from inventory.models import SalesPoint
+
+
+class Command(BaseCommand):
+    help = 'Recompute the crates each client owes per packaging from the bills and the recorded returns.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sales-point', type=int, action='append', dest='sales_points')
+
+    def handle(self, *args, **options):
+        if not options['sales_points']:
+            rows = rebuild_client_packaging()
+            self.stdout.write(f"{rows} client packaging balances rebuilt")
+            return
+
+        for sales_point in SalesPoint.objects.filter(id__in=options['sales_points']):
+            rows = rebuild_client_packaging(sales_point)
+            self.stdout.write(f"{sales_point}: {rows} client packaging balances rebuilt")
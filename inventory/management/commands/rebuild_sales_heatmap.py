@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from inventory.functions import rebuild_sales_heatmap
+from inventory.models import SalesPoint
+
+
+class Command(BaseCommand):
+    help = 'Recompute the hourly sales heatmap of each sales point from the bills.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sales-point', type=int, action='append', dest='sales_points')
+
+    def handle(self, *args, **options):
+        sales_points = SalesPoint.objects.all()
+        if options['sales_points']:
+            sales_points = sales_points.filter(id__in=options['sales_points'])
+
+        for sales_point in sales_points:
+            rebuild_sales_heatmap(sales_point)
+            self.stdout.write(f"{sales_point}: heatmap rebuilt")
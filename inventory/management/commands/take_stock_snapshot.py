@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from inventory.functions import take_stock_snapshot
+from inventory.models import SalesPoint
+
+
+class Command(BaseCommand):
+    help = 'Store the current product and packaging quantities of each sales point, used as a base for past valuations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sales-point', type=int, action='append', dest='sales_points')
+
+    def handle(self, *args, **options):
+        sales_points = SalesPoint.objects.all()
+        if options['sales_points']:
+            sales_points = sales_points.filter(id__in=options['sales_points'])
+
+        for sales_point in sales_points:
+            snapshot = take_stock_snapshot(sales_point)
+            self.stdout.write(f"{sales_point}: snapshot {snapshot.id} with {snapshot.lines.count()} lines")
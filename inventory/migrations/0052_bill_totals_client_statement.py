@@ -0,0 +1,53 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:38
+
+from django.db import migrations, models
+from django.db.models import F, Sum, Value, Subquery, OuterRef
+from django.db.models.functions import Coalesce
+
+
+def backfill_bill_totals(apps, schema_editor):
+    Bill = apps.get_model('inventory', 'Bill')
+    ProductBill = apps.get_model('inventory', 'ProductBill')
+    PackageProductBill = apps.get_model('inventory', 'PackageProductBill')
+    lines_total = ProductBill.objects.filter(bill=OuterRef('pk')).values('bill').annotate(
+        total=Sum(F('quantity') * F('sell_price__price'))).values('total')
+    packages_total = PackageProductBill.objects.filter(product_bill__bill=OuterRef('pk')).values(
+        'product_bill__bill').annotate(total=Sum(F('record') * F('packaging__price'))).values('total')
+    Bill.objects.update(
+        total_amount=Coalesce(Subquery(lines_total), Value(0), output_field=models.DecimalField()),
+        package_amount=Coalesce(Subquery(packages_total), Value(0), output_field=models.DecimalField()),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0051_stockmovement_stocksnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bill',
+            name='package_amount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='bill',
+            name='paid_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='bill',
+            name='total_amount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=20),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['customer', 'created_at'], name='inventory_b_custome_e211e2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recordedpackaging',
+            index=models.Index(fields=['customer', 'created_at'], name='inventory_r_custome_900ae1_idx'),
+        ),
+        migrations.RunPython(backfill_bill_totals, migrations.RunPython.noop),
+    ]
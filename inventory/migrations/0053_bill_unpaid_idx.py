@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:40
+
+from django.db import migrations, models
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0052_bill_totals_client_statement'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(condition=models.Q(('paid__isnull', True), ('paid__lt', django.db.models.expressions.CombinedExpression(models.F('total_amount'), '+', models.F('package_amount'))), _connector='OR'), fields=['sales_point', 'customer', 'created_at'], name='bill_unpaid_idx'),
+        ),
+    ]
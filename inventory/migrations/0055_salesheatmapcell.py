@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0054_bill_delivery_tracking'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SalesHeatmapCell',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weekday', models.PositiveSmallIntegerField()),
+                ('hour', models.PositiveSmallIntegerField()),
+                ('bills', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('sales_point', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='heatmap_cells', to='inventory.salespoint')),
+            ],
+            options={
+                'unique_together': {('sales_point', 'weekday', 'hour')},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0055_salesheatmapcell'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['sales_point', 'created_at'], name='inventory_b_sales_p_6480c4_idx'),
+        ),
+    ]
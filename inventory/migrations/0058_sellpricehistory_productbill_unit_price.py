@@ -0,0 +1,52 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_price_history(apps, schema_editor):
+    SellPrice = apps.get_model('inventory', 'SellPrice')
+    SellPriceHistory = apps.get_model('inventory', 'SellPriceHistory')
+    ProductBill = apps.get_model('inventory', 'ProductBill')
+    # Only the current price is known: it is taken as effective since the
+    # sell price was created
+    SellPriceHistory.objects.bulk_create(
+        (SellPriceHistory(sell_price_id=pk, product_id=product_id, price=price, effective_from=created_at)
+         for pk, product_id, price, created_at in
+         SellPrice.objects.values_list('pk', 'product_id', 'price', 'created_at').iterator()),
+        batch_size=1000,
+    )
+    ProductBill.objects.filter(sell_price__isnull=False).update(
+        unit_price=Subquery(SellPrice.objects.filter(pk=OuterRef('sell_price_id')).values('price')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0057_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productbill',
+            name='unit_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.CreateModel(
+            name='SellPriceHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('effective_from', models.DateTimeField(default=django.utils.timezone.now)),
+                ('effective_to', models.DateTimeField(blank=True, null=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_history', to='inventory.product')),
+                ('sell_price', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='history', to='inventory.sellprice')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['product', 'effective_from'], name='inventory_s_product_b4d851_idx'), models.Index(fields=['sell_price', 'effective_from'], name='inventory_s_sell_pr_dfe0f1_idx'), models.Index(condition=models.Q(('effective_to__isnull', True)), fields=['sell_price'], name='sellprice_current_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_price_history, migrations.RunPython.noop),
+    ]
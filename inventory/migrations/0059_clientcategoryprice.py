@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0058_sellpricehistory_productbill_unit_price'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClientCategoryPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_update', models.DateTimeField(auto_now=True)),
+                ('client_category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='prices', to='inventory.clientcategory')),
+                ('sell_price', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='client_category_prices', to='inventory.sellprice')),
+            ],
+            options={
+                'unique_together': {('client_category', 'sell_price')},
+            },
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:20
+
+from django.conf import settings
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0060_stocktransfer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Stocktake',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('open', 'Open'), ('applied', 'Applied')], default='open', max_length=10)),
+                ('note', models.CharField(blank=True, default='', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('reconciled_at', models.DateTimeField(blank=True, null=True)),
+                ('applied_at', models.DateTimeField(blank=True, null=True)),
+                ('summary', models.JSONField(blank=True, default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('enterprise', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stocktakes', to='inventory.enterprise')),
+                ('sales_point', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stocktakes', to='inventory.salespoint')),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='stockmovement',
+            name='reason',
+            field=models.CharField(choices=[('create', 'Create'), ('adjustment', 'Adjustment'), ('sale', 'Sale'), ('sale_update', 'Sale update'), ('sale_delete', 'Sale delete'), ('transfer_out', 'Transfer out'), ('transfer_in', 'Transfer in'), ('stocktake', 'Stocktake')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='StocktakeLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('counted', models.IntegerField(default=0)),
+                ('counted_empty', models.IntegerField(default=0)),
+                ('expected', models.IntegerField(blank=True, null=True)),
+                ('expected_empty', models.IntegerField(blank=True, null=True)),
+                ('packaging', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='inventory.packaging')),
+                ('product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='inventory.product')),
+                ('stocktake', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='inventory.stocktake')),
+                ('variant', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='inventory.variant')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['stocktake', 'product'], name='inventory_s_stockta_16f8b0_idx'), models.Index(fields=['stocktake', 'variant'], name='inventory_s_stockta_0fa5d8_idx'), models.Index(fields=['stocktake', 'packaging'], name='inventory_s_stockta_d65bcb_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:28
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0062_purchasing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillReturn',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('note', models.CharField(blank=True, default='', max_length=255)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('package_amount', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('refund', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('bill', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='returns', to='inventory.bill')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='stockmovement',
+            name='reason',
+            field=models.CharField(choices=[('create', 'Create'), ('adjustment', 'Adjustment'), ('sale', 'Sale'), ('sale_update', 'Sale update'), ('sale_delete', 'Sale delete'), ('transfer_out', 'Transfer out'), ('transfer_in', 'Transfer in'), ('stocktake', 'Stocktake'), ('purchase', 'Purchase'), ('return', 'Return')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='BillReturnLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('crates', models.PositiveIntegerField(default=0)),
+                ('bill_return', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='inventory.billreturn')),
+                ('product_bill', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='return_lines', to='inventory.productbill')),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0063_billreturn'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='salespoint',
+            name='balance_shards',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='SalesPointBalanceShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('sales_point', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_parts', to='inventory.salespoint')),
+            ],
+            options={
+                'unique_together': {('sales_point', 'shard')},
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def backfill_opening_balances(apps, schema_editor):
+    # Existing balances become the opening entry of each client ledger
+    Client = apps.get_model('inventory', 'Client')
+    ClientLedgerEntry = apps.get_model('inventory', 'ClientLedgerEntry')
+    entries = []
+    for client_id, balance in Client.objects.exclude(balance=0).values_list('id', 'balance').iterator(chunk_size=2000):
+        entries.append(ClientLedgerEntry(client_id=client_id, kind='opening', amount=balance))
+        if len(entries) >= 2000:
+            ClientLedgerEntry.objects.bulk_create(entries)
+            entries = []
+    ClientLedgerEntry.objects.bulk_create(entries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0064_salespoint_balance_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClientLedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('opening', 'Opening balance'), ('payment', 'Payment'), ('charge', 'Bill charge'), ('deposit', 'Packaging deposit'), ('refund', 'Refund'), ('adjustment', 'Adjustment')], max_length=20)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('bill', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='inventory.bill')),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='inventory.client')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['client', 'created_at'], name='inventory_c_client__7b5f43_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_opening_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0065_clientledgerentry'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='packaginghistory',
+            name='performed_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
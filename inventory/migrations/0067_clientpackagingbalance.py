@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:42
+
+from collections import defaultdict
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def backfill_client_packaging(apps, schema_editor):
+    PackageProductBill = apps.get_model('inventory', 'PackageProductBill')
+    RecordedPackaging = apps.get_model('inventory', 'RecordedPackaging')
+    ClientPackagingBalance = apps.get_model('inventory', 'ClientPackagingBalance')
+    crates = defaultdict(int)
+    for row in (PackageProductBill.objects.filter(product_bill__bill__customer__isnull=False, record__gt=0)
+                .values('product_bill__bill__customer', 'packaging').annotate(total=Sum('record')).order_by()):
+        crates[(row['product_bill__bill__customer'], row['packaging'])] += row['total']
+    for row in RecordedPackaging.objects.values('customer', 'packaging').annotate(total=Sum('quantity')).order_by():
+        crates[(row['customer'], row['packaging'])] -= row['total']
+    ClientPackagingBalance.objects.bulk_create([
+        ClientPackagingBalance(client_id=client_id, packaging_id=packaging_id, crates=total)
+        for (client_id, packaging_id), total in crates.items() if total
+    ], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0066_packaginghistory_performed_by_null'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClientPackagingBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('crates', models.IntegerField(default=0)),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='packaging_balances', to='inventory.client')),
+                ('packaging', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='client_balances', to='inventory.packaging')),
+            ],
+            options={
+                'unique_together': {('client', 'packaging')},
+            },
+        ),
+        migrations.RunPython(backfill_client_packaging, migrations.RunPython.noop),
+    ]
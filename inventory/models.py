@@ -1,9 +1,12 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin, Group, Permission
 from django.utils import timezone
-from django.db.models import F
+from django.db.models import F, Sum, Value, Subquery, OuterRef
+from django.db.models.functions import Coalesce
 import random
 import string
+from datetime import timedelta
+from django.core.serializers.json import DjangoJSONEncoder
 
 class Plan(models.Model):
     name = models.CharField(max_length=100)
@@ -46,9 +49,63 @@ class SalesPoint(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     last_update = models.DateTimeField(auto_now=True)
     balance = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
+    # Number of SalesPointBalanceShard rows that balance changes are spread
+    # over, so that concurrent deliveries do not all wait on this row. 0 keeps
+    # the whole balance here.
+    balance_shards = models.PositiveSmallIntegerField(default=0)
 
     def __str__(self):
         return self.name
+
+    def add_to_balance(self, amount):
+        # Atomic increment, on a random shard when the balance is sharded
+        if not amount:
+            return
+        if self.balance_shards:
+            SalesPointBalanceShard.add(self.pk, random.randrange(self.balance_shards), amount)
+        else:
+            SalesPoint.objects.filter(pk=self.pk).update(balance=F('balance') + amount)
+
+    @property
+    def current_balance(self):
+        # The shards only exist while the balance is sharded, see fold_balance()
+        if not self.balance_shards:
+            return self.balance
+        return self.balance + (self.balance_parts.aggregate(total=Sum('amount'))['total'] or 0)
+
+    def fold_balance(self):
+        # Moves what the shards hold back into the balance column
+        with transaction.atomic():
+            list(SalesPoint.objects.select_for_update().filter(pk=self.pk).values_list('pk', flat=True))
+            shards = SalesPointBalanceShard.objects.select_for_update().filter(sales_point=self)
+            total = shards.aggregate(total=Sum('amount'))['total']
+            if total is None:
+                return
+            SalesPoint.objects.filter(pk=self.pk).update(balance=F('balance') + total)
+            shards.delete()
+        self.refresh_from_db(fields=['balance'])
+
+class SalesPointBalanceShard(models.Model):
+    sales_point = models.ForeignKey(SalesPoint, on_delete=models.CASCADE, related_name='balance_parts')
+    shard = models.PositiveSmallIntegerField()
+    amount = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('sales_point', 'shard')
+
+    @classmethod
+    def add(cls, sales_point_id, shard, amount):
+        if cls.objects.filter(sales_point_id=sales_point_id, shard=shard).update(amount=F('amount') + amount):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(sales_point_id=sales_point_id, shard=shard, amount=amount)
+        except IntegrityError:
+            # Created concurrently by another request
+            cls.objects.filter(sales_point_id=sales_point_id, shard=shard).update(amount=F('amount') + amount)
+
+    def __str__(self):
+        return f"{self.sales_point} shard {self.shard}"
     
 class Category(models.Model):
     name = models.CharField(max_length=100)
@@ -127,9 +184,59 @@ class SellPrice(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     last_update = models.DateTimeField(auto_now=True)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        SellPriceHistory.record([self.pk])
+
     def __str__(self):
         return f"{self.product.name} - {self.price}"
 
+class SellPriceHistory(models.Model):
+    # Price of a SellPrice from effective_from until effective_to. The open
+    # row (no effective_to) holds the current price.
+    sell_price = models.ForeignKey(SellPrice, on_delete=models.CASCADE, related_name='history')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='price_history')
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    effective_from = models.DateTimeField(default=timezone.now)
+    effective_to = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'effective_from']),
+            models.Index(fields=['sell_price', 'effective_from']),
+            # Open rows, looked up and closed by record()
+            models.Index(fields=['sell_price'], name='sellprice_current_idx',
+                         condition=models.Q(effective_to__isnull=True)),
+        ]
+
+    @classmethod
+    def record(cls, sell_price_ids, at=None, batch_size=500):
+        # Closes the open row of every sell price whose price changed and
+        # opens a new one. Sell prices that did not change are left alone.
+        at = at or timezone.now()
+        current = {pk: (product_id, price) for pk, product_id, price in
+                   SellPrice.objects.filter(pk__in=sell_price_ids).values_list('pk', 'product_id', 'price')}
+        current_ids = list(current)
+        open_prices = {}
+        for start in range(0, len(current_ids), batch_size):
+            open_prices.update(cls.objects.filter(sell_price_id__in=current_ids[start:start + batch_size],
+                                                  effective_to__isnull=True).values_list('sell_price_id', 'price'))
+        changed = [pk for pk, (_, price) in current.items() if open_prices.get(pk) != price]
+        for start in range(0, len(changed), batch_size):
+            cls.objects.filter(sell_price_id__in=changed[start:start + batch_size],
+                               effective_to__isnull=True).update(effective_to=at)
+        cls.objects.bulk_create([cls(sell_price_id=pk, product_id=current[pk][0], price=current[pk][1], effective_from=at)
+                                 for pk in changed], batch_size=batch_size)
+
+    @classmethod
+    def prices_at(cls, sell_price_ids, at):
+        # {sell_price_id: price} in effect at the given date, in one query
+        return dict(cls.objects.filter(sell_price_id__in=sell_price_ids, effective_from__lte=at).filter(
+            models.Q(effective_to__isnull=True) | models.Q(effective_to__gt=at)).values_list('sell_price_id', 'price'))
+
+    def __str__(self):
+        return f"{self.sell_price_id} - {self.price} from {self.effective_from}"
+
 class ClientCategory(models.Model):
     name = models.CharField(max_length=100)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -140,6 +247,21 @@ class ClientCategory(models.Model):
     def __str__(self):
         return self.name
 
+class ClientCategoryPrice(models.Model):
+    # Price of a SellPrice for the clients of a category, used on their bills
+    # instead of the sell price itself
+    client_category = models.ForeignKey(ClientCategory, on_delete=models.CASCADE, related_name='prices')
+    sell_price = models.ForeignKey(SellPrice, on_delete=models.CASCADE, related_name='client_category_prices')
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_update = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('client_category', 'sell_price')
+
+    def __str__(self):
+        return f"{self.client_category.name} - {self.sell_price_id}: {self.price}"
+
 def generate_client_code(name, surname, number):
     initials = ""
     if name and surname:
@@ -255,6 +377,10 @@ class EnterpriseDetails(models.Model):
     def __str__(self):
         return f"Details for {self.enterprise.name}"
     
+# Bills that are not fully paid, also the condition of the bill_unpaid_idx
+# partial index so that filtering with it can use the index.
+UNPAID_BILLS = models.Q(paid__isnull=True) | models.Q(paid__lt=F('total_amount') + F('package_amount'))
+
 class Bill(models.Model):
     BILL_STATES = [
         ('created', 'Created'),
@@ -272,6 +398,21 @@ class Bill(models.Model):
     sales_point = models.ForeignKey(SalesPoint, on_delete=models.CASCADE, null=True, blank=True)  # New field
     deliverer = models.ForeignKey('Employee', on_delete=models.SET_NULL, null=True, blank=True, related_name='bills')
     paid = models.DecimalField(max_digits=20, decimal_places=2,null=True, blank=True)
+    paid_at = models.DateTimeField(null=True, blank=True)
+    pending_at = models.DateTimeField(null=True, blank=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    # Stored totals, kept in sync by refresh_totals()
+    total_amount = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    package_amount = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['customer', 'created_at']),
+            models.Index(fields=['sales_point', 'created_at']),
+            models.Index(fields=['deliverer', 'state', 'delivery_date']),
+            models.Index(fields=['sales_point', 'customer', 'created_at'], name='bill_unpaid_idx',
+                         condition=UNPAID_BILLS),
+        ]
     
     def save(self, *args, **kwargs):
         if not self.bill_number:
@@ -285,36 +426,25 @@ class Bill(models.Model):
         super().save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
-        for product_bill in self.product_bills.all():
-            if product_bill.is_variant:
-                # If the product bill is a variant, increase the variant's quantity
-                Variant.objects.filter(pk=product_bill.variant_id).update(quantity=F('quantity') + product_bill.quantity)
-            else:
-                # If the product bill is a standard product, increase the product's quantity
-                Product.objects.filter(pk=product_bill.product.id).update(quantity=F('quantity') + product_bill.quantity)
-            if product_bill.product.is_beer:
-                try:
-                    package_product_bill = PackageProductBill.objects.get(product_bill=product_bill)
-                    packaging = package_product_bill.packaging
-
-                    # Restore the packaging quantities
-                    packaging.full_quantity += package_product_bill.quantity
-                    packaging.empty_quantity -= package_product_bill.quantity - package_product_bill.record
-
-                    if packaging.full_quantity < 0:
-                        packaging.full_quantity = 0
-
-                    if packaging.empty_quantity < 0:
-                        packaging.empty_quantity = 0
-
-                    packaging.save()
-
-                    # Delete the PackageProductBill instance
-                    package_product_bill.delete()
-                except PackageProductBill.DoesNotExist:
-                    pass
-        # Call the superclass delete method
-        super().delete(*args, **kwargs)
+        # Stock, crates and the sales heatmap are given back in bulk
+        from .billing import delete_bills
+        with transaction.atomic():
+            delete_bills(Bill.objects.filter(pk=self.pk))
+
+    def refresh_totals(self):
+        lines_total = ProductBill.objects.filter(bill=OuterRef('pk')).values('bill').annotate(
+            total=Sum(F('quantity') * Coalesce('unit_price', 'sell_price__price'))).values('total')
+        packages_total = PackageProductBill.objects.filter(product_bill__bill=OuterRef('pk')).values(
+            'product_bill__bill').annotate(total=Sum(F('record') * F('packaging__price'))).values('total')
+        Bill.objects.filter(pk=self.pk).update(
+            total_amount=Coalesce(Subquery(lines_total), Value(0), output_field=models.DecimalField()),
+            package_amount=Coalesce(Subquery(packages_total), Value(0), output_field=models.DecimalField()),
+        )
+        self.refresh_from_db(fields=['total_amount', 'package_amount'])
+
+    @property
+    def amount_due(self):
+        return self.total_amount + self.package_amount
 
     def generate_bill_number(self):
         last_bill = Bill.objects.filter(enterprise=self.enterprise).order_by('id').last()
@@ -334,30 +464,24 @@ class ProductBill(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     is_variant = models.BooleanField(default=False)
     variant_id = models.IntegerField(null=True, blank=True)
+    # Price of sell_price at the bill date, set when the line is created
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
 
     @property
     def price(self):
+        if self.unit_price is not None:
+            return self.unit_price
         return self.sell_price.price
     
     def delete(self, *args, **kwargs):
-        if self.is_variant:
-            variant = Variant.objects.get(pk=self.variant_id)
-            product_instance = variant.product
-        else:
-            product_instance = self.product
-
-        if product_instance.is_beer:
-            packaging = product_instance.package
-            if packaging:
-                package_product_bill = PackageProductBill.objects.get(product_bill=self)
-                packaging.empty_quantity -= package_product_bill.quantity - package_product_bill.record 
-                packaging.full_quantity += package_product_bill.quantity
-                if packaging.empty_quantity < 0:
-                    packaging.empty_quantity = 0
-                packaging.save()
-                package_product_bill.delete()
-
-        super().delete(*args, **kwargs)
+        from .billing import restore_product_bills
+        with transaction.atomic():
+            restore_product_bills(ProductBill.objects.filter(pk=self.pk))
+            super().delete(*args, **kwargs)
+            bill = self.bill
+            total_before = bill.total_amount
+            bill.refresh_totals()
+            SalesHeatmapCell.record(bill.sales_point_id, bill.created_at, revenue=bill.total_amount - total_before)
     
 class Employee(models.Model):
     name = models.CharField(max_length=100)
@@ -401,6 +525,9 @@ class RecordedPackaging(models.Model):
     class Meta:
         verbose_name = 'Recorded Packaging'
         verbose_name_plural = 'Recorded Packaging'
+        indexes = [
+            models.Index(fields=['customer', 'created_at']),
+        ]
 
     def __str__(self):
         return f"{self.customer} - {self.packaging} - {self.quantity}"
@@ -426,7 +553,8 @@ class PackagingHistory(models.Model):
     empty_quantity_before = models.PositiveIntegerField()
     full_quantity_after = models.PositiveIntegerField()
     empty_quantity_after = models.PositiveIntegerField()
-    performed_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Null for changes made outside a request, e.g. Bill.delete() from the shell
+    performed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
     sales_point = models.ForeignKey(SalesPoint, on_delete=models.SET_NULL, null=True, blank=True)
     bill =  models.ForeignKey(Bill, on_delete=models.SET_NULL, null=True, blank=True)
@@ -436,4 +564,368 @@ class PackagingHistory(models.Model):
         ordering = ['-timestamp']
 
     def __str__(self):
-        return f"{self.action} on {self.packaging} (Product: {self.product}) by {self.performed_by} at {self.timestamp}"
\ No newline at end of file
+        return f"{self.action} on {self.packaging} (Product: {self.product}) by {self.performed_by} at {self.timestamp}"
+
+class StockMovement(models.Model):
+    REASONS = [
+        ('create', 'Create'),
+        ('adjustment', 'Adjustment'),
+        ('sale', 'Sale'),
+        ('sale_update', 'Sale update'),
+        ('sale_delete', 'Sale delete'),
+        ('transfer_out', 'Transfer out'),
+        ('transfer_in', 'Transfer in'),
+        ('stocktake', 'Stocktake'),
+        ('purchase', 'Purchase'),
+        ('return', 'Return'),
+    ]
+
+    sales_point = models.ForeignKey(SalesPoint, on_delete=models.CASCADE, null=True, blank=True)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, null=True, blank=True, related_name='stock_movements')
+    variant = models.ForeignKey(Variant, on_delete=models.SET_NULL, null=True, blank=True)
+    packaging = models.ForeignKey(Packaging, on_delete=models.CASCADE, null=True, blank=True, related_name='stock_movements')
+    # Signed deltas. For packaging rows `quantity` is the full crates delta.
+    quantity = models.IntegerField(default=0)
+    empty_quantity = models.IntegerField(default=0)
+    reason = models.CharField(max_length=20, choices=REASONS)
+    bill = models.ForeignKey(Bill, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'created_at']),
+            models.Index(fields=['packaging', 'created_at']),
+            models.Index(fields=['sales_point', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.reason} {self.quantity} ({self.product or self.packaging})"
+
+class StockSnapshot(models.Model):
+    sales_point = models.ForeignKey(SalesPoint, on_delete=models.CASCADE, related_name='stock_snapshots')
+    taken_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sales_point', 'taken_at']),
+        ]
+
+    def __str__(self):
+        return f"Snapshot of {self.sales_point} at {self.taken_at}"
+
+class StockSnapshotLine(models.Model):
+    snapshot = models.ForeignKey(StockSnapshot, on_delete=models.CASCADE, related_name='lines')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, null=True, blank=True)
+    packaging = models.ForeignKey(Packaging, on_delete=models.CASCADE, null=True, blank=True)
+    quantity = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['snapshot', 'product']),
+            models.Index(fields=['snapshot', 'packaging']),
+        ]
+
+class SalesHeatmapCell(models.Model):
+    sales_point = models.ForeignKey(SalesPoint, on_delete=models.CASCADE, related_name='heatmap_cells')
+    # ISO weekday, 1 is Monday
+    weekday = models.PositiveSmallIntegerField()
+    hour = models.PositiveSmallIntegerField()
+    bills = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('sales_point', 'weekday', 'hour')
+
+    @classmethod
+    def record(cls, sales_point_id, created_at, bills=0, revenue=0):
+        if not sales_point_id or (not bills and not revenue):
+            return
+        created_at = timezone.localtime(created_at)
+        cell = {'sales_point_id': sales_point_id, 'weekday': created_at.isoweekday(), 'hour': created_at.hour}
+        changes = {'bills': F('bills') + bills, 'revenue': F('revenue') + revenue}
+        if cls.objects.filter(**cell).update(**changes):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(bills=bills, revenue=revenue, **cell)
+        except IntegrityError:
+            # Created concurrently by another request
+            cls.objects.filter(**cell).update(**changes)
+
+    def __str__(self):
+        return f"{self.sales_point} day {self.weekday} {self.hour}h"
+
+
+class IdempotencyKey(models.Model):
+    # Response of the first request sent with an Idempotency-Key header, kept
+    # for TTL so that retries are answered without running the view again.
+    TTL = timedelta(hours=24)
+
+    # sha256 of the user, endpoint and client supplied key
+    key = models.CharField(max_length=64, unique=True)
+    # sha256 of the request body, to refuse a key reused for another request
+    request_hash = models.CharField(max_length=64)
+    # Null while the first request is still running
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key} ({self.status_code})"
+
+
+class StockTransfer(models.Model):
+    STATES = [
+        ('draft', 'Draft'),
+        ('done', 'Done'),
+    ]
+
+    enterprise = models.ForeignKey(Enterprise, on_delete=models.CASCADE, related_name='stock_transfers')
+    source = models.ForeignKey(SalesPoint, on_delete=models.CASCADE, related_name='outgoing_transfers')
+    destination = models.ForeignKey(SalesPoint, on_delete=models.CASCADE, related_name='incoming_transfers')
+    state = models.CharField(max_length=10, choices=STATES, default='draft')
+    note = models.CharField(max_length=255, blank=True, default='')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    executed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Transfer {self.id} {self.source} -> {self.destination}"
+
+class StockTransferLine(models.Model):
+    # Product (or variant) of the source sales point. The matching product of
+    # the destination has the same product_code, variants match by name.
+    transfer = models.ForeignKey(StockTransfer, on_delete=models.CASCADE, related_name='lines')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    variant = models.ForeignKey(Variant, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    quantity = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f"{self.quantity} x {self.variant or self.product}"
+
+class Stocktake(models.Model):
+    STATES = [
+        ('open', 'Open'),
+        ('applied', 'Applied'),
+    ]
+
+    enterprise = models.ForeignKey(Enterprise, on_delete=models.CASCADE, related_name='stocktakes')
+    sales_point = models.ForeignKey(SalesPoint, on_delete=models.CASCADE, related_name='stocktakes')
+    state = models.CharField(max_length=10, choices=STATES, default='open')
+    note = models.CharField(max_length=255, blank=True, default='')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    reconciled_at = models.DateTimeField(null=True, blank=True)
+    applied_at = models.DateTimeField(null=True, blank=True)
+    # Totals of the last reconciliation, see stocktakes.reconcile_stocktake
+    summary = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+
+    def __str__(self):
+        return f"Stocktake {self.id} of {self.sales_point}"
+
+class StocktakeLine(models.Model):
+    # One line per counted product, variant or packaging; uploads add to the
+    # counts. `expected` holds the stock at reconciliation time, which makes
+    # the lines the variance report of the stocktake.
+    stocktake = models.ForeignKey(Stocktake, on_delete=models.CASCADE, related_name='lines')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    variant = models.ForeignKey(Variant, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    packaging = models.ForeignKey(Packaging, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    counted = models.IntegerField(default=0)
+    counted_empty = models.IntegerField(default=0)
+    expected = models.IntegerField(null=True, blank=True)
+    expected_empty = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['stocktake', 'product']),
+            models.Index(fields=['stocktake', 'variant']),
+            models.Index(fields=['stocktake', 'packaging']),
+        ]
+
+    @property
+    def variance(self):
+        return None if self.expected is None else self.counted - self.expected
+
+    @property
+    def empty_variance(self):
+        return None if self.expected_empty is None else self.counted_empty - self.expected_empty
+
+    def __str__(self):
+        return f"{self.counted} x {self.variant or self.product or self.packaging}"
+
+class PurchaseOrder(models.Model):
+    STATES = [
+        ('open', 'Open'),
+        ('partial', 'Partially received'),
+        ('received', 'Received'),
+    ]
+
+    enterprise = models.ForeignKey(Enterprise, on_delete=models.CASCADE, related_name='purchase_orders')
+    sales_point = models.ForeignKey(SalesPoint, on_delete=models.CASCADE, related_name='purchase_orders')
+    supplier = models.ForeignKey(Supplier, on_delete=models.CASCADE, related_name='purchase_orders')
+    reference = models.CharField(max_length=100, blank=True, default='')
+    state = models.CharField(max_length=10, choices=STATES, default='open')
+    note = models.CharField(max_length=255, blank=True, default='')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Purchase order {self.id} from {self.supplier}"
+
+class PurchaseOrderLine(models.Model):
+    order = models.ForeignKey(PurchaseOrder, on_delete=models.CASCADE, related_name='lines')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    variant = models.ForeignKey(Variant, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    quantity = models.PositiveIntegerField()
+    received_quantity = models.PositiveIntegerField(default=0)
+    unit_cost = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.quantity} x {self.variant or self.product}"
+
+class GoodsReceipt(models.Model):
+    # Goods received note: what actually came in, with or without an order
+    STATES = [
+        ('draft', 'Draft'),
+        ('received', 'Received'),
+    ]
+
+    enterprise = models.ForeignKey(Enterprise, on_delete=models.CASCADE, related_name='goods_receipts')
+    sales_point = models.ForeignKey(SalesPoint, on_delete=models.CASCADE, related_name='goods_receipts')
+    supplier = models.ForeignKey(Supplier, on_delete=models.CASCADE, related_name='goods_receipts')
+    purchase_order = models.ForeignKey(PurchaseOrder, on_delete=models.SET_NULL, null=True, blank=True,
+                                       related_name='receipts')
+    reference = models.CharField(max_length=100, blank=True, default='')
+    state = models.CharField(max_length=10, choices=STATES, default='draft')
+    note = models.CharField(max_length=255, blank=True, default='')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    received_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Goods receipt {self.id} from {self.supplier}"
+
+class GoodsReceiptLine(models.Model):
+    receipt = models.ForeignKey(GoodsReceipt, on_delete=models.CASCADE, related_name='lines')
+    order_line = models.ForeignKey(PurchaseOrderLine, on_delete=models.SET_NULL, null=True, blank=True,
+                                   related_name='receipt_lines')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    variant = models.ForeignKey(Variant, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    quantity = models.PositiveIntegerField()
+    unit_cost = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.quantity} x {self.variant or self.product}"
+
+class BillReturn(models.Model):
+    bill = models.ForeignKey(Bill, on_delete=models.CASCADE, related_name='returns')
+    note = models.CharField(max_length=255, blank=True, default='')
+    # Taken off the bill totals
+    amount = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    package_amount = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    # Part of the bill already paid that no longer is due: credited to the
+    # client balance, or to hand back for bills without a client
+    refund = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Return {self.id} on {self.bill}"
+
+class BillReturnLine(models.Model):
+    bill_return = models.ForeignKey(BillReturn, on_delete=models.CASCADE, related_name='lines')
+    product_bill = models.ForeignKey(ProductBill, on_delete=models.CASCADE, related_name='return_lines')
+    # Units brought back, and empty crates brought back out of those the
+    # client kept (PackageProductBill.record)
+    quantity = models.PositiveIntegerField(default=0)
+    crates = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_bill}"
+
+
+class ClientLedgerEntry(models.Model):
+    # Every change of Client.balance, which is the running total of these
+    # entries kept on the client row (see rebuild_client_balances)
+    KINDS = [
+        ('opening', 'Opening balance'),
+        ('payment', 'Payment'),
+        ('charge', 'Bill charge'),
+        ('deposit', 'Packaging deposit'),
+        ('refund', 'Refund'),
+        ('adjustment', 'Adjustment'),
+    ]
+
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='ledger_entries')
+    kind = models.CharField(max_length=20, choices=KINDS)
+    # Signed: credits the balance when positive, debits it when negative
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    bill = models.ForeignKey(Bill, on_delete=models.SET_NULL, null=True, blank=True, related_name='ledger_entries')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['client', 'created_at'])]
+
+    @classmethod
+    def post(cls, entries):
+        # Inserts the entries and moves each client balance by their total
+        # with one UPDATE
+        totals = {}
+        for entry in entries:
+            totals[entry.client_id] = totals.get(entry.client_id, 0) + entry.amount
+        totals = {client_id: total for client_id, total in totals.items() if total}
+        cls.objects.bulk_create(entries)
+        if totals:
+            Client.objects.filter(pk__in=totals).update(balance=models.Case(
+                *[models.When(pk=client_id, then=F('balance') + total) for client_id, total in totals.items()],
+                default=F('balance'), output_field=models.DecimalField()))
+
+    @classmethod
+    def bill_payment(cls, bill, amount, user=None):
+        # Entries for paying amount of a bill from the client balance: the
+        # products first, then the crate deposit
+        charge = min(amount, bill.total_amount)
+        entries = [cls(client_id=bill.customer_id, kind='charge', amount=-charge, bill=bill, created_by=user)]
+        if amount > charge:
+            entries.append(cls(client_id=bill.customer_id, kind='deposit', amount=charge - amount, bill=bill,
+                               created_by=user))
+        return entries
+
+    def __str__(self):
+        return f"{self.client} {self.kind} {self.amount}"
+
+
+class ClientPackagingBalance(models.Model):
+    # Crates a client still has, per packaging: kept on bills
+    # (PackageProductBill.record) minus brought back (RecordedPackaging).
+    # Kept up to date by apply(), see rebuild_client_packaging.
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='packaging_balances')
+    packaging = models.ForeignKey(Packaging, on_delete=models.CASCADE, related_name='client_balances')
+    crates = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('client', 'packaging')
+
+    @classmethod
+    def apply(cls, deltas, batch_size=200):
+        # {(client id, packaging id): crates}; rows are created as needed,
+        # then moved with one UPDATE per batch
+        deltas = [(key, delta) for key, delta in deltas.items() if delta and key[0] and key[1]]
+        if not deltas:
+            return
+        cls.objects.bulk_create([cls(client_id=client_id, packaging_id=packaging_id) for (client_id, packaging_id), _
+                                 in deltas], ignore_conflicts=True)
+        for start in range(0, len(deltas), batch_size):
+            batch = deltas[start:start + batch_size]
+            rows = models.Q()
+            for (client_id, packaging_id), _ in batch:
+                rows |= models.Q(client_id=client_id, packaging_id=packaging_id)
+            cls.objects.filter(rows).update(crates=models.Case(
+                *[models.When(client_id=client_id, packaging_id=packaging_id, then=F('crates') + delta)
+                  for (client_id, packaging_id), delta in batch],
+                default=F('crates'), output_field=models.IntegerField()))
+
+    def __str__(self):
+        return f"{self.client} owes {self.crates} {self.packaging}"
@@ -0,0 +1,118 @@
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import F, Q, Count
+from django.utils import timezone
+from rest_framework import serializers
+from .billing import apply_quantity_deltas, apply_packaging_deltas
+from .models import (Product, Variant, Packaging, PackagingHistory, StockMovement, PurchaseOrder, PurchaseOrderLine,
+                     GoodsReceipt, GoodsReceiptLine)
+
+
+def receive_goods(receipt, user):
+    """Books a draft goods receipt on the stock of its sales point.
+
+    Runs in one transaction with one UPDATE per table: product and variant
+    quantities grow by the received quantities, and every full beer crate
+    coming in replaces an empty one handed back to the supplier on the
+    Packaging row. The lines of the purchase order, if any, are marked as
+    received and the order state follows; receiving more than is
+    outstanding on an order line is refused. Movements and packaging history
+    are bulk inserted.
+    """
+    with transaction.atomic():
+        receipt = GoodsReceipt.objects.select_for_update().get(pk=receipt.pk)
+        if receipt.state != 'draft':
+            raise serializers.ValidationError({'state': 'This goods receipt has already been received.'})
+        lines = list(receipt.lines.select_related('product', 'variant'))
+        if not lines:
+            raise serializers.ValidationError({'lines': 'The goods receipt has no lines.'})
+
+        product_deltas = defaultdict(int)
+        variant_deltas = defaultdict(int)
+        crate_deltas = defaultdict(int)
+        received = defaultdict(int)
+        movements = []
+        for line in lines:
+            if line.variant_id:
+                variant_deltas[line.variant_id] += line.quantity
+            else:
+                product_deltas[line.product_id] += line.quantity
+            if line.product.is_beer and line.product.package_id:
+                crate_deltas[(line.product.package_id, line.product_id)] += line.quantity
+            if line.order_line_id:
+                received[line.order_line_id] += line.quantity
+            movements.append(StockMovement(sales_point_id=receipt.sales_point_id, product=line.product,
+                                           variant=line.variant, quantity=line.quantity, reason='purchase'))
+
+        # Nothing is received past what was ordered
+        order_lines = PurchaseOrderLine.objects.select_for_update().select_related('product').in_bulk(received)
+        over = [f"{order_lines[pk].product.name}: {quantity} received, "
+                f"{max(order_lines[pk].quantity - order_lines[pk].received_quantity, 0)} outstanding."
+                for pk, quantity in received.items()
+                if order_lines[pk].received_quantity + quantity > order_lines[pk].quantity]
+        if over:
+            raise serializers.ValidationError({'lines': over})
+
+        # Locked so that the history below records exact before/after values
+        packagings = Packaging.objects.select_for_update().in_bulk({package_id for package_id, _ in crate_deltas})
+        full_deltas = defaultdict(int)
+        history = []
+        for (package_id, product_id), quantity in crate_deltas.items():
+            packaging = packagings[package_id]
+            if quantity > packaging.empty_quantity:
+                raise serializers.ValidationError({'lines': [
+                    f"Not enough empty {packaging.name} crates to swap for {quantity} full ones."]})
+            history.append(PackagingHistory(
+                packaging=packaging, product_id=product_id, action='purchase', quantity_changed=quantity,
+                full_quantity_before=packaging.full_quantity, empty_quantity_before=packaging.empty_quantity,
+                full_quantity_after=packaging.full_quantity + quantity,
+                empty_quantity_after=packaging.empty_quantity - quantity,
+                performed_by=user, sales_point_id=receipt.sales_point_id))
+            packaging.full_quantity += quantity
+            packaging.empty_quantity -= quantity
+            full_deltas[package_id] += quantity
+        for package_id, quantity in full_deltas.items():
+            movements.append(StockMovement(sales_point_id=receipt.sales_point_id, packaging=packagings[package_id],
+                                           quantity=quantity, empty_quantity=-quantity, reason='purchase'))
+
+        apply_quantity_deltas(Product, product_deltas)
+        apply_quantity_deltas(Variant, variant_deltas)
+        apply_packaging_deltas(full_deltas, {package_id: -quantity for package_id, quantity in full_deltas.items()})
+        apply_quantity_deltas(PurchaseOrderLine, received, field='received_quantity')
+        StockMovement.objects.bulk_create(movements)
+        PackagingHistory.objects.bulk_create(history)
+
+        if receipt.purchase_order_id:
+            _refresh_order_state(receipt.purchase_order_id)
+        receipt.state = 'received'
+        receipt.received_at = timezone.now()
+        receipt.save(update_fields=['state', 'received_at'])
+    return receipt
+
+def _refresh_order_state(order_id):
+    progress = PurchaseOrderLine.objects.filter(order_id=order_id).aggregate(
+        pending=Count('id', filter=Q(received_quantity__lt=F('quantity'))),
+        started=Count('id', filter=Q(received_quantity__gt=0)),
+    )
+    state = 'received' if not progress['pending'] else 'partial' if progress['started'] else 'open'
+    PurchaseOrder.objects.filter(pk=order_id).update(state=state)
+
+def receipt_from_order(order, user, quantities=None):
+    # Draft receipt for the outstanding quantities of an order, or for the
+    # given {order line id: quantity}.
+    lines = []
+    for order_line in order.lines.all():
+        outstanding = max(order_line.quantity - order_line.received_quantity, 0)
+        quantity = outstanding if quantities is None else quantities.get(order_line.pk, 0)
+        if quantity:
+            lines.append(GoodsReceiptLine(order_line=order_line, product_id=order_line.product_id,
+                                          variant_id=order_line.variant_id, quantity=quantity,
+                                          unit_cost=order_line.unit_cost))
+    if not lines:
+        raise serializers.ValidationError({'lines': 'Nothing left to receive on this order.'})
+    receipt = GoodsReceipt.objects.create(enterprise_id=order.enterprise_id, sales_point_id=order.sales_point_id,
+                                          supplier_id=order.supplier_id, purchase_order=order, created_by=user)
+    for line in lines:
+        line.receipt = receipt
+    GoodsReceiptLine.objects.bulk_create(lines)
+    return receipt
@@ -0,0 +1,135 @@
+from collections import defaultdict
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import F
+from rest_framework import serializers
+from .billing import apply_quantity_deltas, apply_packaging_deltas
+from .models import (Product, Variant, Packaging, PackagingHistory, StockMovement, Bill, ProductBill,
+                     PackageProductBill, ClientLedgerEntry, SalesHeatmapCell, BillReturn, BillReturnLine,
+                     ClientPackagingBalance)
+
+
+def return_bill_lines(bill, lines_data, user, note=''):
+    """Takes back part of a bill without rewriting it.
+
+    Each line names a product bill with the units brought back (which come
+    back full) and the empty crates brought back out of those the client
+    kept. Only the returned lines, their packaging rows, the stock rows, the
+    bill totals and the client balance are written, with conditional
+    set-based updates in one transaction. Full crates brought back first
+    cancel the crates the client kept, then the client gets empties back.
+    """
+    with transaction.atomic():
+        bill = Bill.objects.select_for_update().get(pk=bill.pk)
+        requested = defaultdict(lambda: [0, 0])
+        for line in lines_data:
+            requested[line['product_bill_id']][0] += line.get('quantity', 0)
+            requested[line['product_bill_id']][1] += line.get('crates', 0)
+        product_bills = {product_bill.pk: product_bill for product_bill in bill.product_bills.filter(
+            pk__in=requested).select_related('product', 'package_product_bill__packaging')}
+
+        errors = []
+        plan = []
+        for pk, (quantity, crates) in requested.items():
+            product_bill = product_bills.get(pk)
+            if product_bill is None:
+                errors.append(f"Line {pk} is not part of bill {bill.bill_number}.")
+                continue
+            if quantity > product_bill.quantity:
+                errors.append(f"{product_bill.product.name}: only {product_bill.quantity} can be returned.")
+                continue
+            package = getattr(product_bill, 'package_product_bill', None)
+            kept = max(package.record - quantity, 0) if package else 0
+            if crates > kept:
+                errors.append(f"{product_bill.product.name}: the client only kept {kept} crates.")
+                continue
+            plan.append((product_bill, package, quantity, crates))
+        if errors:
+            raise serializers.ValidationError({'lines': errors})
+
+        product_deltas = defaultdict(int)
+        variant_deltas = defaultdict(int)
+        line_deltas = {}
+        package_deltas = {}
+        record_deltas = {}
+        deposits = defaultdict(int)
+        crate_moves = []
+        movements = []
+        amount = Decimal('0')
+        package_amount = Decimal('0')
+        for product_bill, package, quantity, crates in plan:
+            if quantity:
+                if product_bill.is_variant:
+                    variant_deltas[product_bill.variant_id] += quantity
+                else:
+                    product_deltas[product_bill.product_id] += quantity
+                line_deltas[product_bill.pk] = -quantity
+                amount += quantity * product_bill.price
+                movements.append(StockMovement(sales_point_id=bill.sales_point_id, product_id=product_bill.product_id,
+                                               variant_id=product_bill.variant_id if product_bill.is_variant else None,
+                                               quantity=quantity, reason='return', bill=bill))
+            if package:
+                record_after = max(package.record - quantity, 0) - crates
+                package_deltas[package.pk] = -quantity
+                record_deltas[package.pk] = record_after - package.record
+                deposits[(bill.customer_id, package.packaging_id)] += record_after - package.record
+                package_amount += (package.record - record_after) * package.packaging.price
+                # Empties handed back for full crates beyond the kept ones,
+                # empties taken in for the crates returned
+                empty_delta = crates - (quantity - min(quantity, package.record))
+                crate_moves.append((product_bill, package.packaging_id, quantity, empty_delta))
+
+        packagings = Packaging.objects.select_for_update().in_bulk({package_id for _, package_id, _, _ in crate_moves})
+        full_deltas = defaultdict(int)
+        empty_deltas = defaultdict(int)
+        history = []
+        for product_bill, package_id, full_delta, empty_delta in crate_moves:
+            if not full_delta and not empty_delta:
+                continue
+            packaging = packagings[package_id]
+            if packaging.empty_quantity + empty_delta < 0:
+                raise serializers.ValidationError({'lines': [f"Not enough empty {packaging.name} crates to hand back."]})
+            history.append(PackagingHistory(
+                packaging=packaging, product_id=product_bill.product_id, action='return', bill=bill,
+                variant_id=product_bill.variant_id if product_bill.is_variant else None,
+                quantity_changed=full_delta + abs(empty_delta),
+                full_quantity_before=packaging.full_quantity, empty_quantity_before=packaging.empty_quantity,
+                full_quantity_after=packaging.full_quantity + full_delta,
+                empty_quantity_after=packaging.empty_quantity + empty_delta,
+                performed_by=user, sales_point_id=bill.sales_point_id))
+            movements.append(StockMovement(sales_point_id=bill.sales_point_id, packaging=packaging, quantity=full_delta,
+                                           empty_quantity=empty_delta, reason='return', bill=bill))
+            packaging.full_quantity += full_delta
+            packaging.empty_quantity += empty_delta
+            full_deltas[package_id] += full_delta
+            empty_deltas[package_id] += empty_delta
+
+        apply_quantity_deltas(Product, product_deltas)
+        apply_quantity_deltas(Variant, variant_deltas)
+        apply_quantity_deltas(ProductBill, line_deltas)
+        apply_quantity_deltas(PackageProductBill, package_deltas)
+        apply_quantity_deltas(PackageProductBill, record_deltas, field='record')
+        apply_packaging_deltas(full_deltas, empty_deltas)
+        ClientPackagingBalance.apply(deposits)
+        StockMovement.objects.bulk_create(movements)
+        PackagingHistory.objects.bulk_create(history)
+
+        # What was paid beyond the amount due is owed back to the client
+        paid = bill.paid or Decimal('0')
+        due_before = bill.amount_due
+        due_after = due_before - amount - package_amount
+        refund = max(paid - due_after, 0) - max(paid - due_before, 0)
+        if amount or package_amount:
+            Bill.objects.filter(pk=bill.pk).update(total_amount=F('total_amount') - amount,
+                                                   package_amount=F('package_amount') - package_amount)
+        if refund and bill.customer_id:
+            ClientLedgerEntry.post([ClientLedgerEntry(client_id=bill.customer_id, kind='refund', amount=refund,
+                                                      bill=bill, created_by=user)])
+        SalesHeatmapCell.record(bill.sales_point_id, bill.created_at, 0, -amount)
+
+        bill_return = BillReturn.objects.create(bill=bill, note=note, amount=amount, package_amount=package_amount,
+                                                refund=refund, created_by=user)
+        BillReturnLine.objects.bulk_create([
+            BillReturnLine(bill_return=bill_return, product_bill=product_bill, quantity=quantity, crates=crates)
+            for product_bill, _, quantity, crates in plan])
+    return bill_return
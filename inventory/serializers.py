@@ -1,17 +1,31 @@
 from .models import (Product, Category, Supplier,ClientCategory, Client,Enterprise,
                      PaymentInfo, Plan,EnterpriseDetails,SellPrice,ProductBill,Bill,Variant,
                      SalesPoint, Employee,EmployeeDebt,Packaging,RecordedPackaging,PackageProductBill,
-                     PackagingHistory
+                     PackagingHistory,StockMovement,SalesHeatmapCell,SellPriceHistory,ClientCategoryPrice,
+                     StockTransfer,StockTransferLine,Stocktake,PurchaseOrder,PurchaseOrderLine,GoodsReceipt,
+                     GoodsReceiptLine,BillReturn,BillReturnLine,ClientLedgerEntry,ClientPackagingBalance
                      )
 from django.contrib.auth import get_user_model
 from datetime import timedelta,datetime
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework import serializers
+from django.db import transaction
 from django.db.models import F
+from decimal import Decimal
+from collections import defaultdict
 from django.shortcuts import get_object_or_404
+from .functions import bill_unit_prices, invalidate_catalogue_cache
+from .billing import update_bill_lines, apply_packaging_deltas, PackagingHistoryLog, lock_bill_numbers
 
 User = get_user_model()
 
+def line_unit_price(sell_price, unit_prices):
+    # Price of a line from bill_unit_prices, or the current one for sell
+    # prices without history
+    if sell_price is None:
+        return None
+    return unit_prices.get(sell_price.pk, sell_price.price)
+
 class EnterpriseDetailsSerializer(serializers.ModelSerializer):
     class Meta:
         model = EnterpriseDetails
@@ -64,7 +78,9 @@ class SalesPointSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = SalesPoint
-        fields = ['id', 'name', 'enterprise', 'balance', 'address', 'created_at', 'last_update']
+        fields = ['id', 'name', 'enterprise', 'balance', 'balance_shards', 'address', 'created_at', 'last_update']
+        # Only moved by settlements, through SalesPoint.add_to_balance()
+        read_only_fields = ['balance']
 
     def validate(self, data):
         user = self.context['request'].user
@@ -78,6 +94,26 @@ class SalesPointSerializer(serializers.ModelSerializer):
 
         return super().create(validated_data)
 
+    def update(self, instance, validated_data):
+        # Saves only the fields sent, so the balance increments of concurrent
+        # settlements are not overwritten
+        with transaction.atomic():
+            instance = SalesPoint.objects.select_for_update().get(pk=instance.pk)
+            for attr, value in validated_data.items():
+                setattr(instance, attr, value)
+            instance.save(update_fields=[*validated_data, 'last_update'])
+            if not instance.balance_shards:
+                instance.fold_balance()
+        return instance
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # Includes what the balance shards hold. Also used for the details of
+        # suppliers and client categories, which have no such balance.
+        if isinstance(instance, SalesPoint):
+            data['balance'] = self.fields['balance'].to_representation(instance.current_balance)
+        return data
+
 
 class CategorySerializer(serializers.ModelSerializer):
     enterprise = serializers.PrimaryKeyRelatedField(read_only=True,required=False)
@@ -130,6 +166,11 @@ class SellPriceSerializer(serializers.ModelSerializer):
         model = SellPrice
         fields = ['id', 'product', 'price', 'created_at', 'last_update']
 
+class SellPriceHistorySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SellPriceHistory
+        fields = ['id', 'sell_price', 'product', 'price', 'effective_from', 'effective_to']
+
 class ProductVariantSerializer(serializers.ModelSerializer):
     product = serializers.PrimaryKeyRelatedField(queryset=Product.objects.all())
 
@@ -137,6 +178,22 @@ class ProductVariantSerializer(serializers.ModelSerializer):
         model = Variant
         fields = ['id', 'name', 'quantity', 'product']
 
+    def create(self, validated_data):
+        variant = super().create(validated_data)
+        if variant.quantity:
+            StockMovement.objects.create(sales_point=variant.product.sales_point, product=variant.product,
+                                         variant=variant, quantity=variant.quantity, reason='create')
+        return variant
+
+    def update(self, instance, validated_data):
+        quantity_before = instance.quantity
+        variant = super().update(instance, validated_data)
+        if variant.quantity != quantity_before:
+            StockMovement.objects.create(sales_point=variant.product.sales_point, product=variant.product,
+                                         variant=variant, quantity=variant.quantity - quantity_before,
+                                         reason='adjustment')
+        return variant
+
 class EmployeeSerializer(serializers.ModelSerializer):
     sales_point_details = SalesPointSerializer(source='sales_point',read_only=True)
 
@@ -165,7 +222,26 @@ class PackagingSerializer(serializers.ModelSerializer):
         else:
             validated_data['sales_point'] = user.sales_point
 
-        return super().create(validated_data)
+        packaging = super().create(validated_data)
+        if packaging.full_quantity or packaging.empty_quantity:
+            StockMovement.objects.create(sales_point=packaging.sales_point, packaging=packaging,
+                                         quantity=packaging.full_quantity, empty_quantity=packaging.empty_quantity,
+                                         reason='create')
+        return packaging
+
+    def update(self, instance, validated_data):
+        full_quantity_before = instance.full_quantity
+        empty_quantity_before = instance.empty_quantity
+        packaging = super().update(instance, validated_data)
+        if packaging.full_quantity != full_quantity_before or packaging.empty_quantity != empty_quantity_before:
+            StockMovement.objects.create(
+                sales_point=packaging.sales_point,
+                packaging=packaging,
+                quantity=packaging.full_quantity - full_quantity_before,
+                empty_quantity=packaging.empty_quantity - empty_quantity_before,
+                reason='adjustment'
+            )
+        return packaging
     
 class ProductSerializer(serializers.ModelSerializer):
     category = CategorySerializer(read_only=True)
@@ -242,7 +318,13 @@ class ProductSerializer(serializers.ModelSerializer):
                 raise serializers.ValidationError({"quantity": "Quantity cannot be greater than the empty quantity of the selected packaging."})
 
         product = super().create(validated_data)
+        movements = []
+        if not product.with_variant and product.quantity:
+            movements.append(StockMovement(sales_point=product.sales_point, product=product,
+                                           quantity=product.quantity, reason='create'))
         if validated_data.get('is_beer'):
+            movements.append(StockMovement(sales_point=product.sales_point, packaging=package,
+                                           quantity=quantity, empty_quantity=-quantity, reason='create'))
             PackagingHistory.objects.create(
                 packaging=package,
                 product=product,
@@ -255,9 +337,18 @@ class ProductSerializer(serializers.ModelSerializer):
                 performed_by=user,
                 sales_point=product.sales_point
             )
+        StockMovement.objects.bulk_create(movements)
             
         return product
 
+    def update(self, instance, validated_data):
+        quantity_before = instance.quantity
+        product = super().update(instance, validated_data)
+        if not product.with_variant and product.quantity != quantity_before:
+            StockMovement.objects.create(sales_point=product.sales_point, product=product,
+                                         quantity=product.quantity - quantity_before, reason='adjustment')
+        return product
+
 
 class ClientCategorySerializer(serializers.ModelSerializer):
     class Meta:
@@ -265,6 +356,26 @@ class ClientCategorySerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'created_at', 'enterprise', 'sales_point', 'last_update']
 
 
+class ClientCategoryPriceSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ClientCategoryPrice
+        fields = ['id', 'client_category', 'sell_price', 'price', 'created_at', 'last_update']
+
+    def validate(self, data):
+        client_category = data.get('client_category', getattr(self.instance, 'client_category', None))
+        sell_price = data.get('sell_price', getattr(self.instance, 'sell_price', None))
+        if client_category.enterprise_id != sell_price.product.enterprise_id:
+            raise serializers.ValidationError({'sell_price': 'Sell price and client category belong to different enterprises.'})
+        if client_category.sales_point_id and client_category.sales_point_id != sell_price.product.sales_point_id:
+            raise serializers.ValidationError({'sell_price': 'Sell price does not belong to the sales point of the client category.'})
+        return data
+
+    def save(self, **kwargs):
+        instance = super().save(**kwargs)
+        invalidate_catalogue_cache([instance.sell_price.product.sales_point_id])
+        return instance
+
+
 class ClientSerializer(serializers.ModelSerializer):
     client_category = serializers.PrimaryKeyRelatedField(queryset=ClientCategory.objects.all())
     sales_point = serializers.PrimaryKeyRelatedField(queryset=SalesPoint.objects.all(), required=False)
@@ -289,7 +400,28 @@ class ClientSerializer(serializers.ModelSerializer):
         else:
             validated_data['sales_point'] = user.sales_point
 
-        return super().create(validated_data)
+        # The balance is the total of the client ledger
+        balance = validated_data.pop('balance', 0)
+        with transaction.atomic():
+            client = super().create(validated_data)
+            if balance:
+                ClientLedgerEntry.post([ClientLedgerEntry(client=client, kind='opening', amount=balance,
+                                                          created_by=user)])
+                client.refresh_from_db(fields=['balance'])
+        return client
+
+    def update(self, instance, validated_data):
+        balance = validated_data.pop('balance', None)
+        with transaction.atomic():
+            instance = super().update(instance, validated_data)
+            if balance is not None:
+                current = Client.objects.select_for_update().values_list('balance', flat=True).get(pk=instance.pk)
+                if balance != current:
+                    ClientLedgerEntry.post([ClientLedgerEntry(
+                        client=instance, kind='payment' if balance > current else 'adjustment',
+                        amount=balance - current, created_by=self.context['request'].user)])
+                instance.refresh_from_db(fields=['balance'])
+        return instance
 
 class PaymentInfoSerializer(serializers.ModelSerializer):
     plan = PlanSerializer()
@@ -389,7 +521,9 @@ class PackageProductBillSerializer(serializers.ModelSerializer):
         return obj.record * obj.packaging.price
 
 class ProductBillSerializer(serializers.ModelSerializer):
-    price = serializers.ReadOnlyField(source='sell_price.price')
+    # Writable so that BillSerializer.update can tell kept lines from new ones
+    id = serializers.IntegerField(required=False)
+    price = serializers.ReadOnlyField()
     is_variant = serializers.BooleanField()
     product_details = serializers.SerializerMethodField()
     variant_id = serializers.IntegerField(required=False, allow_null=True)
@@ -443,11 +577,11 @@ class ProductBillSerializer(serializers.ModelSerializer):
                 raise serializers.ValidationError({'product': 'Product does not exist.'})
             
     def get_total_amount(self, obj):
-        return obj.quantity * obj.sell_price.price
+        return obj.quantity * obj.price
 
     def get_benefit(self, obj):
         product_price = self.get_product_details(obj)['price']
-        return (obj.sell_price.price - product_price) * obj.quantity
+        return (obj.price - product_price) * obj.quantity
 
     def validate(self, data):
         product = data['product']
@@ -504,7 +638,8 @@ class BillSerializer(serializers.ModelSerializer):
         fields = ['id', 'bill_number', 'customer', 'sales_point', 'deliverer', 'deliverer_details',
                   'total', 'sales_point_details', 'customer_details', 'sales_point', 'paid',
                   'customer_name', 'created_at', 'delivery_date', 'state', 'product_bills', 'total_bill_amount', 'deliverer',
-                  'deliverer_details']
+                  'deliverer_details', 'total_amount', 'package_amount', 'paid_at', 'pending_at', 'delivered_at']
+        read_only_fields = ['total_amount', 'package_amount', 'paid_at', 'pending_at', 'delivered_at']
 
     def validate(self, attrs):
         user = self.context['request'].user
@@ -543,7 +678,22 @@ class BillSerializer(serializers.ModelSerializer):
         product_bills_data = validated_data.pop('product_bills')
         request = self.context.get('request')
         enterprise = request.user.enterprise
+        with transaction.atomic():
+            return self._create(validated_data, product_bills_data, request.user)
+
+    def _create(self, validated_data, product_bills_data, user):
+        if validated_data.get('enterprise'):
+            lock_bill_numbers(validated_data['enterprise'].pk)
         bill = Bill.objects.create(**validated_data)
+        movements = []
+        # Packagings are locked once each so that the history records exact
+        # before/after values, and written with one UPDATE at the end
+        packagings = {}
+        history = PackagingHistoryLog(user, 'sale')
+        # Crates kept by the customer, per packaging
+        deposits = defaultdict(int)
+        # Prices of all the lines at the bill date, with the customer's price list
+        unit_prices = bill_unit_prices(bill, [data['sell_price'].pk for data in product_bills_data if data.get('sell_price')])
 
         for product_bill_data in product_bills_data:
             product_id = product_bill_data['product']
@@ -561,9 +711,14 @@ class BillSerializer(serializers.ModelSerializer):
                         variant.save()
 
                         product_instance = variant.product
+                        movements.append(StockMovement(sales_point=bill.sales_point, product=product_instance,
+                                                       variant=variant, quantity=-quantity, reason='sale', bill=bill))
                         if product_instance.is_beer:
                             empty_quantity_needed = quantity
-                            packaging = product_instance.package
+                            if product_instance.package_id and product_instance.package_id not in packagings:
+                                packagings[product_instance.package_id] = Packaging.objects.select_for_update().get(
+                                    pk=product_instance.package_id)
+                            packaging = packagings.get(product_instance.package_id)
                             if packaging:
                                 if record_package > empty_quantity_needed:
                                     raise serializers.ValidationError({'record_package': f"Packaging to record can't be greater than needed packaging for product {product_instance.name}"})
@@ -573,6 +728,7 @@ class BillSerializer(serializers.ModelSerializer):
                                         bill=bill,
                                         product=product_instance,
                                         sell_price=sell_price,
+                                        unit_price=line_unit_price(sell_price, unit_prices),
                                         quantity=quantity,
                                         is_variant=True,
                                         variant_id=variant_id
@@ -583,16 +739,20 @@ class BillSerializer(serializers.ModelSerializer):
                                         quantity=empty_quantity_needed,
                                         record=record_package
                                     )
-                                    packaging.full_quantity -= empty_quantity_needed
-                                    packaging.empty_quantity += record_quantity
-                                    if packaging.full_quantity < 0:
-                                        packaging.full_quantity = 0
-                                    packaging.save()
+                                    full_delta, empty_delta = history.move(
+                                        packaging, -empty_quantity_needed, record_quantity, quantity,
+                                        product_id=product_instance.pk, variant_id=variant.pk, bill=bill,
+                                        sales_point_id=bill.sales_point_id)
+                                    deposits[(bill.customer_id, packaging.pk)] += record_package
+                                    movements.append(StockMovement(sales_point=bill.sales_point, packaging=packaging,
+                                                                   quantity=full_delta, empty_quantity=empty_delta,
+                                                                   reason='sale', bill=bill))
                         else:
                             ProductBill.objects.create(
                                         bill=bill,
                                         product=product_instance,
                                         sell_price=sell_price,
+                                        unit_price=line_unit_price(sell_price, unit_prices),
                                         quantity=quantity,
                                         is_variant=True,
                                         variant_id=variant_id
@@ -607,10 +767,15 @@ class BillSerializer(serializers.ModelSerializer):
                     if product_instance.quantity >= quantity:
                         product_instance.quantity -= quantity
                         product_instance.save()
+                        movements.append(StockMovement(sales_point=bill.sales_point, product=product_instance,
+                                                       quantity=-quantity, reason='sale', bill=bill))
 
                         if product_instance.is_beer:
                             empty_quantity_needed = quantity
-                            packaging = product_instance.package
+                            if product_instance.package_id and product_instance.package_id not in packagings:
+                                packagings[product_instance.package_id] = Packaging.objects.select_for_update().get(
+                                    pk=product_instance.package_id)
+                            packaging = packagings.get(product_instance.package_id)
                             if packaging:
                                 if record_package > empty_quantity_needed:
                                     raise serializers.ValidationError({'record_package': f"Packaging to record can't be greater than needed packaging for product {product_instance.name}"})
@@ -620,6 +785,7 @@ class BillSerializer(serializers.ModelSerializer):
                                         bill=bill,
                                         product=product_instance,
                                         sell_price=sell_price,
+                                        unit_price=line_unit_price(sell_price, unit_prices),
                                         quantity=quantity,
                                         is_variant=False
                                     )
@@ -629,16 +795,19 @@ class BillSerializer(serializers.ModelSerializer):
                                         quantity=empty_quantity_needed,
                                         record=record_package
                                     )
-                                    packaging.empty_quantity += record_package
-                                    packaging.full_quantity -= empty_quantity_needed
-                                    if packaging.full_quantity < 0:
-                                        packaging.full_quantity = 0
-                                    packaging.save()
+                                    full_delta, empty_delta = history.move(
+                                        packaging, -empty_quantity_needed, record_quantity, quantity,
+                                        product_id=product_instance.pk, bill=bill, sales_point_id=bill.sales_point_id)
+                                    deposits[(bill.customer_id, packaging.pk)] += record_package
+                                    movements.append(StockMovement(sales_point=bill.sales_point, packaging=packaging,
+                                                                   quantity=full_delta, empty_quantity=empty_delta,
+                                                                   reason='sale', bill=bill))
                         else:
                             ProductBillInstance = ProductBill.objects.create(
                                         bill=bill,
                                         product=product_instance,
                                         sell_price=sell_price,
+                                        unit_price=line_unit_price(sell_price, unit_prices),
                                         quantity=quantity,
                                         is_variant=False
                                     )
@@ -647,158 +816,28 @@ class BillSerializer(serializers.ModelSerializer):
                 else:
                     raise serializers.ValidationError({'product': 'Product does not exist.'})
 
+        apply_packaging_deltas(*history.net_deltas())
+        ClientPackagingBalance.apply(deposits)
+        StockMovement.objects.bulk_create(movements)
+        history.flush()
+        bill.refresh_totals()
+        SalesHeatmapCell.record(bill.sales_point_id, bill.created_at, 1, bill.total_amount)
         return bill
 
     def update(self, instance, validated_data):
-        product_bills_data = validated_data.pop('product_bills')
-        instance.delivery_date = validated_data.get('delivery_date', instance.delivery_date)
-        instance.state = validated_data.get('state', instance.state)
-        instance.save()
-
-        new_product_bill_ids = []
-
-        for product_bill_data in product_bills_data:
-            product_bill_id = product_bill_data.get('id')
-            updated_quantity = product_bill_data.get('quantity')
-            record_package = product_bill_data.get('record_package', 0)
-
-            if product_bill_id:
-                product_bill = ProductBill.objects.get(id=product_bill_id)
-                current_quantity = product_bill.quantity
-                quantity_diff = updated_quantity - current_quantity
-
-                if product_bill.is_variant:
-                    variant = Variant.objects.get(pk=product_bill.variant_id)
-                    if variant.quantity < quantity_diff:
-                        raise serializers.ValidationError({
-                            'quantity': f'Insufficient quantity for variant. Available: {variant.quantity}'
-                        })
-                    variant.quantity -= quantity_diff
-                    variant.save()
-                    product_instance = variant.product
-                else:
-                    product = Product.objects.get(pk=product_bill.product.id)
-                    if product.quantity < quantity_diff:
-                        raise serializers.ValidationError({
-                            'quantity': f'Insufficient quantity for product. Available: {product.quantity}'
-                        })
-                    product.quantity -= quantity_diff
-                    product.save()
-                    product_instance = product
-
-                if product_instance.is_beer:
-                    empty_quantity_needed = updated_quantity
-                    packaging = product_instance.package
-                    if packaging:
-                        if record_package > empty_quantity_needed:
-                            raise serializers.ValidationError({'record_package': f"Packaging to record can't be greater than needed packaging for product {product_instance.name}"})
-                        else:
-                            record_quantity = empty_quantity_needed - record_package
-                            package_product_bill = PackageProductBill.objects.get(product_bill=product_bill.id)
-                            old_record_package = package_product_bill.record
-                            old_quantity = package_product_bill.quantity
-
-                            package_product_bill.quantity = empty_quantity_needed
-                            package_product_bill.record = record_package
-                            package_product_bill.save()
-
-                            packaging.full_quantity += old_quantity - empty_quantity_needed
-                            packaging.empty_quantity += old_record_package - record_package
-                            if packaging.full_quantity < 0:
-                                packaging.full_quantity = 0
-                            packaging.save()
-
-                product_bill.product = product_bill_data.get('product', product_bill.product)
-                product_bill.variant_id = product_bill_data.get('variant_id', product_bill.variant_id)
-                product_bill.sell_price = product_bill_data.get('sell_price', product_bill.sell_price)
-                product_bill.quantity = product_bill_data.get('quantity', product_bill.quantity)
-                product_bill.is_variant = product_bill_data.get('is_variant', product_bill.is_variant)
-                product_bill.save()
-                new_product_bill_ids.append(product_bill.id)
-            else:
-                if product_bill_data['is_variant']:
-                    variant = Variant.objects.get(pk=product_bill_data['variant_id'])
-                    if variant.quantity < product_bill_data['quantity']:
-                        raise serializers.ValidationError({
-                            'quantity': f'Insufficient quantity for variant. Available: {variant.quantity}'
-                        })
-                    variant.quantity -= product_bill_data['quantity']
-                    variant.save()
-                    product_instance = variant.product
-                else:
-                    product = Product.objects.get(pk=product_bill_data['product'].id)
-                    if product.quantity < product_bill_data['quantity']:
-                        raise serializers.ValidationError({
-                            'quantity': f'Insufficient quantity for product. Available: {product.quantity}'
-                        })
-                    product.quantity -= product_bill_data['quantity']
-                    product.save()
-                    product_instance = product
-
-                new_product_bill = ProductBill.objects.create(bill=instance, **product_bill_data)
-                new_product_bill_ids.append(new_product_bill.id)
-
-                if product_instance.is_beer:
-                    empty_quantity_needed = new_product_bill.quantity
-                    packaging = product_instance.package
-                    if packaging:
-                        if packaging.full_quantity >= empty_quantity_needed:
-                            if record_package > empty_quantity_needed:
-                                raise serializers.ValidationError({'record_package': f"Packaging to record can't be greater than needed packaging for product {product_instance.name}"})
-                            else:
-                                record_quantity = empty_quantity_needed - record_package
-                                PackageProductBill.objects.create(
-                                    product_bill=new_product_bill,
-                                    packaging=packaging,
-                                    quantity=empty_quantity_needed,
-                                    record=record_package
-                                )
-                                packaging.empty_quantity += record_quantity
-                                packaging.full_quantity -= empty_quantity_needed
-                                if packaging.full_quantity < 0:
-                                    packaging.full_quantity = 0
-                                packaging.save()
-                        else:
-                            raise serializers.ValidationError({'quantity': f"Insufficient quantity for packaging {packaging.name}. Available: {packaging.full_quantity}"})
-
-        for product_bill in instance.product_bills.exclude(id__in=new_product_bill_ids):
-            if product_bill.is_variant:
-                variant = Variant.objects.get(pk=product_bill.variant_id)
-                variant.quantity += product_bill.quantity
-                variant.save()
-            else:
-                product = Product.objects.get(pk=product_bill.product.id)
-                product.quantity += product_bill.quantity
-                product.save()
-
-            if product_bill.product.is_beer:
-                packaging = product_bill.product.package
-                if packaging:
-                    package_product_bill = PackageProductBill.objects.get(product_bill=product_bill.id)
-                    packaging.full_quantity += package_product_bill.quantity
-                    packaging.empty_quantity -= package_product_bill.record
-                    if packaging.full_quantity < 0:
-                        packaging.full_quantity = 0
-                    packaging.save()
-
-            product_bill.delete()
-
+        product_bills_data = validated_data.pop('product_bills', None)
+        with transaction.atomic():
+            instance = Bill.objects.select_for_update().get(pk=instance.pk)
+            instance.delivery_date = validated_data.get('delivery_date', instance.delivery_date)
+            instance.state = validated_data.get('state', instance.state)
+            instance.save(update_fields=['delivery_date', 'state'])
+
+            if product_bills_data is not None:
+                update_bill_lines(instance, product_bills_data, self.context['request'].user)
+            total_before = instance.total_amount
+            instance.refresh_totals()
+            SalesHeatmapCell.record(instance.sales_point_id, instance.created_at, revenue=instance.total_amount - total_before)
         return instance
-    
-    def create_packaging_history(self, bill, product_instance, packaging, quantity, record_package, user, action, variant=None):
-        PackagingHistory.objects.create(
-            packaging=packaging,
-            product=product_instance,
-            action=action,
-            quantity_changed=quantity,
-            full_quantity_before=packaging.full_quantity + quantity,
-            empty_quantity_before=packaging.empty_quantity - (quantity - record_package),
-            full_quantity_after=packaging.full_quantity,
-            empty_quantity_after=packaging.empty_quantity,
-            performed_by=user,
-            bill=bill,
-            variant=variant
-        )
 
 class DelivererUpdateSerializer(serializers.ModelSerializer):
     deliverer = serializers.PrimaryKeyRelatedField(queryset=Employee.objects.filter(is_deliverer=True), required=False, allow_null=True)
@@ -818,13 +857,45 @@ class DelivererUpdateSerializer(serializers.ModelSerializer):
 
         return data
 
+class BillDispatchSerializer(serializers.Serializer):
+    # Bills chosen by ids and/or filters, and what to change on them
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False, max_length=5000)
+    sales_point = serializers.IntegerField(required=False)
+    delivery_date = serializers.DateField(required=False)
+    state = serializers.ChoiceField(choices=Bill.BILL_STATES, required=False)
+    deliverer = serializers.PrimaryKeyRelatedField(queryset=Employee.objects.filter(is_deliverer=True), required=False,
+                                                   allow_null=True)
+    to_state = serializers.ChoiceField(choices=['pending'], required=False, error_messages={
+        'invalid_choice': 'Bills can only be moved to pending here; delivered bills are settled with bills/settle/.'})
+
+    def validate(self, data):
+        if not any(name in data for name in ('ids', 'sales_point', 'delivery_date', 'state')):
+            raise serializers.ValidationError('Choose the bills with ids or at least one filter.')
+        if 'deliverer' not in data and 'to_state' not in data:
+            raise serializers.ValidationError('Nothing to change: give a deliverer and/or to_state.')
+        deliverer = data.get('deliverer')
+        enterprise_id = deliverer and (deliverer.enterprise_id or getattr(deliverer.sales_point, 'enterprise_id', None))
+        if deliverer is not None and enterprise_id != self.context['request'].user.enterprise_id:
+            raise serializers.ValidationError({'deliverer': 'Selected employee is not a deliverer.'})
+        return data
+
 class UpdateDeliveredBillSerializer(serializers.ModelSerializer):
     amount = serializers.DecimalField(max_digits=20, decimal_places=2)
+    reduce_from_balance = serializers.BooleanField(required=False, default=False)
+    use_balance_as_paid = serializers.BooleanField(required=False, default=False)
 
     class Meta:
         model = Bill
-        fields = ['amount']
+        fields = ['amount', 'reduce_from_balance', 'use_balance_as_paid']
     
+class BillSettlementSerializer(serializers.Serializer):
+    bill = serializers.IntegerField()
+    amount = serializers.DecimalField(max_digits=20, decimal_places=2, min_value=0)
+    reduce_from_balance = serializers.BooleanField(required=False, default=False)
+
+class BulkSettlementSerializer(serializers.Serializer):
+    bills = BillSettlementSerializer(many=True, allow_empty=False, max_length=1000)
+
 class EmployeeDebtSerializer(serializers.ModelSerializer):
     employee_details = EmployeeSerializer(source='employee',read_only=True)
     
@@ -844,6 +915,27 @@ class PayDebtSerializer(serializers.Serializer):
         return data
 
 
+class RepriceSerializer(serializers.Serializer):
+    RULES = [
+        ('percent', 'Change by a percentage'),
+        ('delta', 'Change by a fixed amount'),
+        ('margin', 'Margin percentage over the product price'),
+    ]
+    rule = serializers.ChoiceField(choices=RULES)
+    value = serializers.DecimalField(max_digits=10, decimal_places=2)
+    rounding = serializers.DecimalField(max_digits=10, decimal_places=2, required=False, allow_null=True,
+                                        min_value=Decimal('0.01'))
+    sales_point = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+    category = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+    supplier = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+    dry_run = serializers.BooleanField(required=False, default=False)
+
+    def validate(self, data):
+        if data['rule'] == 'percent' and data['value'] <= -100:
+            raise serializers.ValidationError({'value': 'A percentage must be greater than -100.'})
+        return data
+
+
 class RecordedPackagingSerializer(serializers.ModelSerializer):
     class Meta:
         model = RecordedPackaging
@@ -875,4 +967,178 @@ class PackagingHistorySerializer(serializers.ModelSerializer):
             'performed_by',
             'timestamp',
             'sales_point'
-        ]
\ No newline at end of file
+        ]
+
+class StockTransferLineSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = StockTransferLine
+        fields = ['id', 'product', 'variant', 'quantity']
+
+    def validate(self, data):
+        if data['quantity'] <= 0:
+            raise serializers.ValidationError({'quantity': 'Quantity must be greater than zero.'})
+        if data.get('variant') and data['variant'].product_id != data['product'].id:
+            raise serializers.ValidationError({'variant': 'Variant does not belong to the product.'})
+        return data
+
+class StockTransferSerializer(serializers.ModelSerializer):
+    lines = StockTransferLineSerializer(many=True)
+
+    class Meta:
+        model = StockTransfer
+        fields = ['id', 'source', 'destination', 'state', 'note', 'created_by', 'created_at', 'executed_at', 'lines']
+        read_only_fields = ['state', 'created_by', 'created_at', 'executed_at']
+
+    def validate(self, data):
+        user = self.context['request'].user
+        source, destination = data['source'], data['destination']
+        if source == destination:
+            raise serializers.ValidationError({'destination': 'Source and destination must be different sales points.'})
+        if source.enterprise_id != user.enterprise_id or destination.enterprise_id != user.enterprise_id:
+            raise serializers.ValidationError({'source': 'Sales points must belong to your enterprise.'})
+        if user.user_type != 'admin' and source != user.sales_point:
+            raise serializers.ValidationError({'source': 'You can only transfer stock from your own sales point.'})
+        if not data['lines']:
+            raise serializers.ValidationError({'lines': 'At least one line is required.'})
+        if any(line['product'].sales_point_id != source.id for line in data['lines']):
+            raise serializers.ValidationError({'lines': 'All products must belong to the source sales point.'})
+        return data
+
+    def create(self, validated_data):
+        lines_data = validated_data.pop('lines')
+        transfer = StockTransfer.objects.create(**validated_data)
+        StockTransferLine.objects.bulk_create([StockTransferLine(transfer=transfer, **line) for line in lines_data])
+        return transfer
+
+
+class StocktakeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Stocktake
+        fields = ['id', 'sales_point', 'state', 'note', 'created_by', 'created_at', 'reconciled_at', 'applied_at',
+                  'summary']
+        read_only_fields = ['state', 'created_by', 'created_at', 'reconciled_at', 'applied_at', 'summary']
+
+    def validate_sales_point(self, sales_point):
+        user = self.context['request'].user
+        if sales_point.enterprise_id != user.enterprise_id:
+            raise serializers.ValidationError('Sales point must belong to your enterprise.')
+        if user.user_type != 'admin' and sales_point != user.sales_point:
+            raise serializers.ValidationError('You can only count the stock of your own sales point.')
+        return sales_point
+
+
+def _validate_document_lines(lines, sales_point):
+    if not lines:
+        raise serializers.ValidationError({'lines': 'At least one line is required.'})
+    for line in lines:
+        if line['quantity'] <= 0:
+            raise serializers.ValidationError({'lines': 'Quantities must be greater than zero.'})
+        if line['product'].sales_point_id != sales_point.id:
+            raise serializers.ValidationError({'lines': f"{line['product']} does not belong to {sales_point}."})
+        if line.get('variant') and line['variant'].product_id != line['product'].id:
+            raise serializers.ValidationError({'lines': f"{line['variant']} does not belong to {line['product']}."})
+        if line['product'].with_variant and not line.get('variant'):
+            raise serializers.ValidationError({'lines': f"A variant of {line['product']} is required."})
+
+def _validate_document_parties(user, data):
+    sales_point, supplier = data['sales_point'], data['supplier']
+    if sales_point.enterprise_id != user.enterprise_id:
+        raise serializers.ValidationError({'sales_point': 'Sales point must belong to your enterprise.'})
+    if user.user_type != 'admin' and sales_point != user.sales_point:
+        raise serializers.ValidationError({'sales_point': 'You can only purchase for your own sales point.'})
+    if supplier.enterprise_id != user.enterprise_id:
+        raise serializers.ValidationError({'supplier': 'Supplier must belong to your enterprise.'})
+
+class PurchaseOrderLineSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PurchaseOrderLine
+        fields = ['id', 'product', 'variant', 'quantity', 'received_quantity', 'unit_cost']
+        read_only_fields = ['received_quantity']
+
+class PurchaseOrderSerializer(serializers.ModelSerializer):
+    lines = PurchaseOrderLineSerializer(many=True)
+
+    class Meta:
+        model = PurchaseOrder
+        fields = ['id', 'sales_point', 'supplier', 'reference', 'state', 'note', 'created_by', 'created_at', 'lines']
+        read_only_fields = ['state', 'created_by', 'created_at']
+
+    def validate(self, data):
+        _validate_document_parties(self.context['request'].user, data)
+        _validate_document_lines(data['lines'], data['sales_point'])
+        return data
+
+    def create(self, validated_data):
+        lines_data = validated_data.pop('lines')
+        order = PurchaseOrder.objects.create(**validated_data)
+        PurchaseOrderLine.objects.bulk_create([PurchaseOrderLine(order=order, **line) for line in lines_data])
+        return order
+
+class GoodsReceiptLineSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = GoodsReceiptLine
+        fields = ['id', 'order_line', 'product', 'variant', 'quantity', 'unit_cost']
+
+class GoodsReceiptSerializer(serializers.ModelSerializer):
+    lines = GoodsReceiptLineSerializer(many=True)
+
+    class Meta:
+        model = GoodsReceipt
+        fields = ['id', 'sales_point', 'supplier', 'purchase_order', 'reference', 'state', 'note', 'created_by',
+                  'created_at', 'received_at', 'lines']
+        read_only_fields = ['state', 'created_by', 'created_at', 'received_at']
+
+    def validate(self, data):
+        _validate_document_parties(self.context['request'].user, data)
+        _validate_document_lines(data['lines'], data['sales_point'])
+        order = data.get('purchase_order')
+        if order and (order.sales_point_id != data['sales_point'].id or order.supplier_id != data['supplier'].id):
+            raise serializers.ValidationError({'purchase_order': 'The order is for another sales point or supplier.'})
+        for line in data['lines']:
+            order_line = line.get('order_line')
+            if order_line and (order is None or order_line.order_id != order.id):
+                raise serializers.ValidationError({'lines': 'Order lines must belong to the purchase order.'})
+            if order_line and (order_line.product_id, order_line.variant_id) != (
+                    line['product'].id, line['variant'].id if line.get('variant') else None):
+                raise serializers.ValidationError({'lines': f"{line['product']} does not match its order line."})
+        ordered = defaultdict(int)
+        for line in data['lines']:
+            if line.get('order_line'):
+                ordered[line['order_line']] += line['quantity']
+        for order_line, quantity in ordered.items():
+            if order_line.received_quantity + quantity > order_line.quantity:
+                raise serializers.ValidationError({'lines': f"{order_line.product}: {quantity} received, "
+                                                            f"{max(order_line.quantity - order_line.received_quantity, 0)} outstanding."})
+        return data
+
+    def create(self, validated_data):
+        lines_data = validated_data.pop('lines')
+        receipt = GoodsReceipt.objects.create(**validated_data)
+        GoodsReceiptLine.objects.bulk_create([GoodsReceiptLine(receipt=receipt, **line) for line in lines_data])
+        return receipt
+
+
+class BillReturnLineSerializer(serializers.ModelSerializer):
+    product_bill = serializers.IntegerField(source='product_bill_id')
+
+    class Meta:
+        model = BillReturnLine
+        fields = ['id', 'product_bill', 'quantity', 'crates']
+
+    def validate(self, data):
+        if not data.get('quantity') and not data.get('crates'):
+            raise serializers.ValidationError('Return a quantity or crates.')
+        return data
+
+class BillReturnSerializer(serializers.ModelSerializer):
+    lines = BillReturnLineSerializer(many=True)
+
+    class Meta:
+        model = BillReturn
+        fields = ['id', 'bill', 'note', 'amount', 'package_amount', 'refund', 'created_by', 'created_at', 'lines']
+        read_only_fields = ['bill', 'amount', 'package_amount', 'refund', 'created_by', 'created_at']
+
+    def validate_lines(self, lines):
+        if not lines:
+            raise serializers.ValidationError('At least one line is required.')
+        return lines
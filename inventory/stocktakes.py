@@ -0,0 +1,236 @@
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import F, Q, Sum, Count, Subquery, OuterRef, IntegerField, DecimalField, ExpressionWrapper
+from django.utils import timezone
+from rest_framework import serializers
+from .billing import apply_quantity_deltas, apply_packaging_deltas
+from .functions import name_key, parse_quantity
+from .models import (Product, Variant, Packaging, PackagingHistory, StockMovement, Stocktake, StocktakeLine)
+
+
+STOCKTAKE_COLUMNS = ['product_code', 'variant', 'packaging', 'quantity', 'empty_quantity']
+# Row errors kept in the upload summary, the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+
+
+class StocktakeCountImport:
+    """Adds uploaded counts to the lines of an open stocktake.
+
+    A row counts a product (product_code, and variant for products with
+    variants) or, without product_code, the full and empty crates of a
+    packaging. Rows are read as a stream and aggregated chunk by chunk, so
+    memory only holds one chunk; each chunk resolves its products with one
+    query and merges into the stored lines with a few set-based statements.
+    """
+    def __init__(self, stocktake, chunk_size=5000):
+        self.stocktake = stocktake
+        self.chunk_size = chunk_size
+        self.packagings = {name_key(p.name): p for p in Packaging.objects.filter(sales_point=stocktake.sales_point_id)}
+        self.summary = {'rows': 0, 'counted': 0, 'lines': 0, 'error_count': 0, 'errors': []}
+
+    def run(self, rows):
+        chunk = []
+        for number, row in rows:
+            self.summary['rows'] += 1
+            chunk.append((number, row))
+            if len(chunk) >= self.chunk_size:
+                self._count_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._count_chunk(chunk)
+        self.summary['lines'] = self.stocktake.lines.count()
+        return self.summary
+
+    def _error(self, number, errors):
+        self.summary['error_count'] += 1
+        if len(self.summary['errors']) < MAX_REPORTED_ERRORS:
+            self.summary['errors'].append({'row': number, 'errors': errors})
+
+    def _resolve(self, chunk):
+        # (id, name, with_variant) by product_code; plain tuples are much
+        # cheaper than model instances at this volume
+        codes = {row.get('product_code') for _, row in chunk if row.get('product_code')}
+        products = {code: (pk, name, with_variant) for code, pk, name, with_variant in
+                    Product.objects.filter(sales_point=self.stocktake.sales_point_id, product_code__in=codes)
+                    .values_list('product_code', 'id', 'name', 'with_variant')}
+        variants = {(product_id, name_key(name)): pk for pk, product_id, name in
+                    Variant.objects.filter(product_id__in=[pk for pk, _, with_variant in products.values() if with_variant])
+                    .values_list('id', 'product_id', 'name')}
+        return products, variants
+
+    def _count_chunk(self, chunk):
+        products, variants = self._resolve(chunk)
+        counts = defaultdict(lambda: [0, 0])
+        for number, row in chunk:
+            try:
+                quantity = parse_quantity(row.get('quantity'), 'quantity')
+                empty_quantity = parse_quantity(row.get('empty_quantity'), 'empty_quantity')
+            except ValueError as exc:
+                self._error(number, exc.args[0])
+                continue
+            code = row.get('product_code')
+            if code:
+                if code not in products:
+                    self._error(number, {'product_code': f"Unknown product code '{code}'."})
+                    continue
+                product_id, name, with_variant = products[code]
+                variant_id = None
+                if with_variant:
+                    variant_id = variants.get((product_id, name_key(row.get('variant', ''))))
+                    if variant_id is None:
+                        self._error(number, {'variant': f"Unknown variant '{row.get('variant', '')}' of {name}."})
+                        continue
+                key = ('product', product_id, variant_id)
+            elif row.get('packaging'):
+                packaging = self.packagings.get(name_key(row['packaging']))
+                if packaging is None:
+                    self._error(number, {'packaging': f"Unknown packaging '{row['packaging']}'."})
+                    continue
+                key = ('packaging', packaging.pk, None)
+            else:
+                self._error(number, {'product_code': 'Either product_code or packaging is required.'})
+                continue
+            counts[key][0] += quantity
+            counts[key][1] += empty_quantity
+            self.summary['counted'] += 1
+        if not counts:
+            return
+
+        with transaction.atomic():
+            # Serializes uploads and reconciliation of the same stocktake
+            stocktake = Stocktake.objects.select_for_update().get(pk=self.stocktake.pk)
+            if stocktake.state != 'open':
+                raise serializers.ValidationError({'state': 'Counts can only be added to an open stocktake.'})
+            product_ids = {pk for kind, pk, _ in counts if kind == 'product'}
+            packaging_ids = {pk for kind, pk, _ in counts if kind == 'packaging'}
+            existing = {}
+            for line in stocktake.lines.filter(Q(product_id__in=product_ids) | Q(packaging_id__in=packaging_ids)).values(
+                    'id', 'product_id', 'variant_id', 'packaging_id'):
+                if line['packaging_id']:
+                    existing[('packaging', line['packaging_id'], None)] = line['id']
+                else:
+                    existing[('product', line['product_id'], line['variant_id'])] = line['id']
+
+            new_lines = []
+            counted_deltas = {}
+            empty_deltas = {}
+            for key, (quantity, empty_quantity) in counts.items():
+                kind, pk, variant_id = key
+                if key in existing:
+                    counted_deltas[existing[key]] = quantity
+                    empty_deltas[existing[key]] = empty_quantity
+                elif kind == 'product':
+                    new_lines.append(StocktakeLine(stocktake=stocktake, product_id=pk, variant_id=variant_id,
+                                                   counted=quantity))
+                else:
+                    new_lines.append(StocktakeLine(stocktake=stocktake, packaging_id=pk, counted=quantity,
+                                                   counted_empty=empty_quantity))
+            apply_quantity_deltas(StocktakeLine, counted_deltas, field='counted')
+            apply_quantity_deltas(StocktakeLine, empty_deltas, field='counted_empty')
+            StocktakeLine.objects.bulk_create(new_lines, batch_size=1000)
+
+
+def _line_sets(stocktake):
+    lines = StocktakeLine.objects.filter(stocktake=stocktake)
+    return (lines.filter(product__isnull=False, variant__isnull=True),
+            lines.filter(variant__isnull=False),
+            lines.filter(packaging__isnull=False))
+
+def _variance_summary(stocktake):
+    delta = F('counted') - F('expected')
+    empty_delta = F('counted_empty') - F('expected_empty')
+    stock = Q(packaging__isnull=True)
+    crates = Q(packaging__isnull=False)
+    money = DecimalField(max_digits=20, decimal_places=2)
+    summary = StocktakeLine.objects.filter(stocktake=stocktake).aggregate(
+        lines=Count('id'),
+        products=Count('id', filter=stock),
+        variances=Count('id', filter=~Q(counted=F('expected')) | (crates & ~Q(counted_empty=F('expected_empty')))),
+        surplus=Sum(delta, filter=stock & Q(counted__gt=F('expected'))),
+        shortage=Sum(-delta, filter=stock & Q(counted__lt=F('expected'))),
+        variance_value=Sum(ExpressionWrapper(delta * F('product__price'), output_field=money), filter=stock),
+        full_crates_variance=Sum(delta, filter=crates),
+        empty_crates_variance=Sum(empty_delta, filter=crates),
+        crates_variance_value=Sum(ExpressionWrapper((delta + empty_delta) * F('packaging__price'), output_field=money),
+                                  filter=crates),
+    )
+    return {name: value or 0 for name, value in summary.items()}
+
+def _apply_variances(stocktake, user, product_lines, variant_lines, packaging_lines):
+    # Counts win over the stored stock. The stock is moved by the variance
+    # rather than set to the count, so that a sale committed concurrently
+    # is not overwritten.
+    for model, lines, field in ((Product, product_lines, 'product_id'), (Variant, variant_lines, 'variant_id')):
+        differing = lines.exclude(counted=F('expected'))
+        variance = differing.filter(**{field: OuterRef('pk')}).annotate(
+            delta=ExpressionWrapper(F('counted') - F('expected'), output_field=IntegerField())).values('delta')[:1]
+        model.objects.filter(pk__in=differing.values(field)).update(quantity=F('quantity') + Subquery(variance))
+
+    movements = []
+    for product_id, variant_id, delta in (StocktakeLine.objects.filter(stocktake=stocktake, packaging__isnull=True)
+                                          .exclude(counted=F('expected'))
+                                          .annotate(delta=F('counted') - F('expected'))
+                                          .values_list('product_id', 'variant_id', 'delta')
+                                          .iterator(chunk_size=2000)):
+        movements.append(StockMovement(sales_point_id=stocktake.sales_point_id, product_id=product_id,
+                                       variant_id=variant_id, quantity=delta, reason='stocktake'))
+        if len(movements) >= 2000:
+            StockMovement.objects.bulk_create(movements)
+            movements = []
+
+    # A sales point has a handful of packagings: their lines are read whole
+    # and the crates were locked when the expected quantities were taken.
+    history = []
+    full_deltas = {}
+    empty_deltas = {}
+    for line in packaging_lines.select_related('packaging'):
+        full_delta = line.counted - line.expected
+        empty_delta = line.counted_empty - line.expected_empty
+        if not full_delta and not empty_delta:
+            continue
+        full_deltas[line.packaging_id] = full_delta
+        empty_deltas[line.packaging_id] = empty_delta
+        movements.append(StockMovement(sales_point_id=stocktake.sales_point_id, packaging=line.packaging,
+                                       quantity=full_delta, empty_quantity=empty_delta, reason='stocktake'))
+        history.append(PackagingHistory(
+            packaging=line.packaging, action='stocktake', quantity_changed=abs(full_delta) + abs(empty_delta),
+            full_quantity_before=line.expected, empty_quantity_before=line.expected_empty,
+            full_quantity_after=line.counted, empty_quantity_after=line.counted_empty,
+            performed_by=user, sales_point_id=stocktake.sales_point_id))
+    apply_packaging_deltas(full_deltas, empty_deltas)
+    StockMovement.objects.bulk_create(movements)
+    PackagingHistory.objects.bulk_create(history)
+
+def reconcile_stocktake(stocktake, user, apply=False):
+    """Diffs the counted lines of an open stocktake against the stock.
+
+    The current quantities are written into the lines with one UPDATE per
+    kind of line (products, variants, packagings), which turns the lines into
+    the variance report; its totals are stored on the stocktake. With apply,
+    the variances are also booked on the stock in the same transaction and
+    the stocktake is closed. Without, it stays open for more counts.
+    """
+    with transaction.atomic():
+        stocktake = Stocktake.objects.select_for_update().get(pk=stocktake.pk)
+        if stocktake.state != 'open':
+            raise serializers.ValidationError({'state': 'This stocktake has already been applied.'})
+        product_lines, variant_lines, packaging_lines = _line_sets(stocktake)
+        product_lines.update(expected=Subquery(
+            Product.objects.filter(pk=OuterRef('product_id')).values('quantity')[:1]))
+        variant_lines.update(expected=Subquery(
+            Variant.objects.filter(pk=OuterRef('variant_id')).values('quantity')[:1]))
+        if apply:
+            list(Packaging.objects.select_for_update().filter(pk__in=packaging_lines.values('packaging_id')))
+        packagings = Packaging.objects.filter(pk=OuterRef('packaging_id'))
+        packaging_lines.update(expected=Subquery(packagings.values('full_quantity')[:1]),
+                               expected_empty=Subquery(packagings.values('empty_quantity')[:1]))
+
+        now = timezone.now()
+        stocktake.summary = _variance_summary(stocktake)
+        stocktake.reconciled_at = now
+        if apply:
+            _apply_variances(stocktake, user, product_lines, variant_lines, packaging_lines)
+            stocktake.state = 'applied'
+            stocktake.applied_at = now
+        stocktake.save(update_fields=['summary', 'reconciled_at', 'state', 'applied_at'])
+    return stocktake
@@ -1,3 +1,959 @@
+import csv
+import io
+import json
+from datetime import timedelta
+from unittest import skipIf
+from decimal import Decimal
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models import Sum
 from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+from . import exports
+from .billing import StockConflict, apply_quantity_deltas
+from .functions import rebuild_client_balances, rebuild_client_packaging
+from .models import (Plan, Enterprise, SalesPoint, SalesPointBalanceShard, User, Category, Supplier, Packaging,
+                     ClientCategory, Client, Product, SellPrice, Bill, Employee, Variant, StockMovement,
+                     ProductBill, SellPriceHistory, PackagingHistory, PurchaseOrder, GoodsReceipt, SalesHeatmapCell,
+                     IdempotencyKey, ClientLedgerEntry, PackageProductBill,
+                     ClientPackagingBalance)
 
-# Create your tests here.
+
+class InventoryTestCase(TestCase):
+    # An enterprise with one sales point, an admin, a beer sold in crates and
+    # a soda, and a client with some credit
+
+    @classmethod
+    def setUpTestData(cls):
+        plan = Plan.objects.create(name='Basic', description='Basic plan', price=1, duration=30)
+        cls.enterprise = Enterprise.objects.create(name='Brewery', address='Main street', plan=plan)
+        cls.sales_point = SalesPoint.objects.get(enterprise=cls.enterprise)
+        cls.admin = User.objects.create_user(email='admin@example.com', username='admin', password='secret',
+                                             name='Ada', surname='Admin', user_type='admin',
+                                             enterprise=cls.enterprise, sales_point=cls.sales_point)
+        cls.category = Category.objects.create(name='Drinks', enterprise=cls.enterprise, sales_point=cls.sales_point)
+        cls.supplier = Supplier.objects.create(name='Brew', enterprise=cls.enterprise, sales_point=cls.sales_point)
+        cls.client_category = ClientCategory.objects.create(name='Retail', enterprise=cls.enterprise,
+                                                            sales_point=cls.sales_point)
+        cls.customer = Client.objects.create(name='Cli', surname='Ent', client_category=cls.client_category,
+                                             enterprise=cls.enterprise, sales_point=cls.sales_point,
+                                             balance=Decimal('1000'))
+
+    def setUp(self):
+        # Reports and the catalogue are cached by id, and ids come back
+        # between tests
+        cache.clear()
+        self.api = APIClient()
+        self.api.force_authenticate(self.admin)
+        self.packaging = Packaging.objects.create(name='Crate', price=Decimal('5'), supplier=self.supplier,
+                                                  full_quantity=0, empty_quantity=100, sales_point=self.sales_point,
+                                                  enterprise=self.enterprise)
+        self.beer = self.make_product('Lager', 50, 10, beer=True)
+        self.soda = self.make_product('Soda', 40, 3)
+        self.beer_price = SellPrice.objects.create(product=self.beer, price=Decimal('15'))
+        self.soda_price = SellPrice.objects.create(product=self.soda, price=Decimal('5'))
+
+    def make_product(self, name, quantity, price, beer=False):
+        response = self.api.post('/api/products/', {
+            'name': name, 'quantity': quantity, 'price': str(price), 'category_id': self.category.id,
+            'supplier_id': self.supplier.id, 'sales_point': self.sales_point.id, 'is_beer': beer,
+            'product_code': name, **({'package_id': self.packaging.id} if beer else {})}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return Product.objects.get(pk=response.data['id'])
+
+    def bill_payload(self, lines, customer=None):
+        # lines are (product, sell price, quantity, returned crates)
+        return {'customer': customer, 'customer_name': 'Walk in', 'sales_point': self.sales_point.id,
+                'product_bills': [{'product': product.id, 'sell_price': sell_price.id, 'quantity': quantity,
+                                   'is_variant': False, 'record_package': record}
+                                  for product, sell_price, quantity, record in lines]}
+
+    def create_bill(self, lines, customer=None):
+        response = self.api.post('/api/create-bill/', self.bill_payload(lines, customer), format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response
+
+    def stream(self, response):
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()
+                if line.strip()]
+
+    def reload(self, *instances):
+        for instance in instances:
+            instance.refresh_from_db()
+
+
+class SalesPointBalanceTests(InventoryTestCase):
+
+    def test_update_with_shards_keeps_balance(self):
+        self.sales_point.balance_shards = 4
+        self.sales_point.save()
+        self.sales_point.add_to_balance(Decimal('30'))
+        self.sales_point.add_to_balance(Decimal('12'))
+        url = f'/api/sales-points/{self.sales_point.id}/'
+        data = self.api.get('/api/sales-points-list/').data[0]
+        self.assertEqual(Decimal(data['balance']), Decimal('42'))
+
+        response = self.api.put(url, {**data, 'name': 'Renamed'}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(SalesPoint.objects.get(pk=self.sales_point.pk).current_balance, Decimal('42'))
+
+        response = self.api.patch(url, {'balance_shards': 0, 'balance': '999'}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        sales_point = SalesPoint.objects.get(pk=self.sales_point.pk)
+        self.assertEqual(sales_point.balance, Decimal('42'))
+        self.assertFalse(SalesPointBalanceShard.objects.filter(sales_point=sales_point).exists())
+
+
+class BatchBillTests(InventoryTestCase):
+
+    def stock(self):
+        self.reload(self.beer, self.soda, self.packaging)
+        return (self.beer.quantity, self.soda.quantity, self.packaging.full_quantity, self.packaging.empty_quantity)
+
+    def taken(self, before):
+        return tuple(old - new for old, new in zip(before, self.stock()))
+
+    def test_batch_and_single_bill_move_the_same_stock(self):
+        lines = [(self.beer, self.beer_price, 6, 2), (self.soda, self.soda_price, 3, 0)]
+        before = self.stock()
+        self.create_bill(lines, customer=self.customer.id)
+        single = self.taken(before)
+
+        before = self.stock()
+        payload = self.bill_payload(lines, customer=self.customer.id)
+        response = self.api.post('/api/bills/batch/', {'bills': [payload]}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(self.taken(before), single)
+        # Four of the six crates come back empty, two stay with the client
+        self.assertEqual(single, (6, 3, 6, -4))
+
+    def test_bill_numbers_follow_each_other(self):
+        self.create_bill([(self.soda, self.soda_price, 1, 0)])
+        line = self.bill_payload([(self.soda, self.soda_price, 1, 0)])
+        response = self.api.post('/api/bills/batch/', {'bills': [line, line]}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(list(Bill.objects.order_by('pk').values_list('bill_number', flat=True)),
+                         ['BILL-0001', 'BILL-0002', 'BILL-0003'])
+
+    def test_batch_reports_bills_short_of_stock(self):
+        ok = self.bill_payload([(self.soda, self.soda_price, 30, 0)])
+        short = self.bill_payload([(self.soda, self.soda_price, 30, 0)])
+        response = self.api.post('/api/bills/batch/', {'bills': [ok, short]}, format='json')
+        self.assertEqual(response.status_code, 207, response.content)
+        self.assertEqual([result['status'] for result in response.data['results']], ['created', 'failed'])
+        self.soda.refresh_from_db()
+        self.assertEqual(self.soda.quantity, 10)
+
+
+class BillDispatchTests(InventoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.deliverer = Employee.objects.create(name='Dan', salary=1, role='deliverer', is_deliverer=True,
+                                                 sales_point=self.sales_point, enterprise=self.enterprise)
+        self.bill_ids = [self.create_bill([(self.soda, self.soda_price, 1, 0)]).data['id'] for _ in range(3)]
+
+    def test_assigns_deliverer_and_moves_to_pending(self):
+        response = self.api.post('/api/bills/dispatch/', {'ids': self.bill_ids, 'deliverer': self.deliverer.id,
+                                                          'to_state': 'pending'}, format='json')
+        self.assertEqual(response.data, {'updated': 3})
+        self.assertEqual(Bill.objects.filter(state='pending', deliverer=self.deliverer,
+                                             pending_at__isnull=False).count(), 3)
+
+    def test_refuses_to_mark_bills_delivered(self):
+        Bill.objects.filter(pk__in=self.bill_ids).update(state='pending')
+        response = self.api.post('/api/bills/dispatch/', {'ids': self.bill_ids, 'to_state': 'success'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Bill.objects.filter(state='success').exists())
+
+    def test_employees_cannot_dispatch(self):
+        employee = User.objects.create_user(email='emp@example.com', username='emp', password='secret', name='Em',
+                                            surname='Ployee', user_type='employee', enterprise=self.enterprise,
+                                            sales_point=self.sales_point)
+        self.api.force_authenticate(employee)
+        response = self.api.post('/api/bills/dispatch/', {'ids': self.bill_ids, 'to_state': 'pending'}, format='json')
+        self.assertEqual(response.status_code, 403)
+
+
+class ProductImportTests(InventoryTestCase):
+
+    def import_rows(self, rows):
+        header = 'product_code,name,category,supplier,price,quantity,variant,variant_quantity\n'
+        content = header + ''.join(','.join(str(value) for value in row) + '\n' for row in rows)
+        upload = SimpleUploadedFile('catalogue.csv', content.encode(), content_type='text/csv')
+        response = self.api.post('/api/products-import/', {'file': upload, 'sales_point': self.sales_point.id},
+                                 format='multipart')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.data
+
+    def catalogue(self, bump):
+        rows = [(f'P{i}', f'Product {i}', 'Drinks', 'Brew', 2 + i, i * 3 + bump, '', '') for i in range(30)]
+        rows.append(('V1', 'Juice', 'Drinks', 'Brew', 4, 0, 'Large', 5 + bump))
+        return rows
+
+    def assert_movements_match_stock(self):
+        products = Product.objects.filter(product_code__in=[row[0] for row in self.catalogue(0)])
+        for product in products:
+            stock = (Variant.objects.filter(product=product).aggregate(total=Sum('quantity'))['total']
+                     if product.with_variant else product.quantity)
+            moved = StockMovement.objects.filter(product=product).aggregate(total=Sum('quantity'))['total'] or 0
+            self.assertEqual(moved, stock, product.product_code)
+
+    def test_reimport_updates_quantities_and_movements(self):
+        summary = self.import_rows(self.catalogue(0))
+        self.assertEqual((summary['created'], summary['variants'], summary['errors']), (31, 1, []))
+        self.assert_movements_match_stock()
+
+        summary = self.import_rows(self.catalogue(4))
+        self.assertEqual((summary['created'], summary['updated'], summary['variants']), (0, 30, 1))
+        self.assertEqual(Product.objects.get(product_code='P7').quantity, 25)
+        self.assertEqual(Variant.objects.get(product__product_code='V1').quantity, 9)
+        self.assert_movements_match_stock()
+
+        summary = self.import_rows(self.catalogue(4))
+        self.assertEqual(summary['unchanged'], 31)
+
+
+@skipIf(exports.pa is None, 'pyarrow is not installed')
+class ColumnarExportTests(InventoryTestCase):
+
+    def export(self, user):
+        self.api.force_authenticate(user)
+        response = self.api.get('/api/exports/bills.arrows')
+        self.assertEqual(response.status_code, 200)
+        return exports.pa.ipc.open_stream(b''.join(response.streaming_content)).read_all()
+
+    def test_export_is_limited_to_the_sales_points_of_the_user(self):
+        self.create_bill([(self.soda, self.soda_price, 1, 0)])
+        self.assertEqual(self.export(self.admin).num_rows, 1)
+        manager = User.objects.create_user(email='manager@example.com', username='manager', password='secret',
+                                           name='Man', surname='Ager', user_type='manager', enterprise=self.enterprise)
+        self.assertEqual(self.export(manager).num_rows, 0)
+
+
+class SellPriceHistoryTests(InventoryTestCase):
+
+    def test_bills_keep_the_price_of_their_date(self):
+        bill_id = self.create_bill([(self.soda, self.soda_price, 2, 0)]).data['id']
+        response = self.api.post('/api/sell-prices-reprice/', {'rule': 'percent', 'value': '20'}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.soda_price.refresh_from_db()
+        self.assertEqual(self.soda_price.price, Decimal('6'))
+
+        self.assertEqual(ProductBill.objects.get(bill_id=bill_id).unit_price, Decimal('5'))
+        history = self.api.get(f'/api/products/{self.soda.id}/price-history/').data
+        self.assertEqual([(row['price'], row['effective_to'] is None) for row in history],
+                         [('5.00', False), ('6.00', True)])
+        bill = Bill.objects.get(pk=bill_id)
+        self.assertEqual(SellPriceHistory.prices_at([self.soda_price.pk], bill.created_at),
+                         {self.soda_price.pk: Decimal('5')})
+
+
+class PurchasingTests(InventoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        response = self.api.post('/api/purchase-orders/', {
+            'sales_point': self.sales_point.id, 'supplier': self.supplier.id,
+            'lines': [{'product': self.beer.id, 'quantity': 30, 'unit_cost': '9.5'},
+                      {'product': self.soda.id, 'quantity': 10}]}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.order_id = response.data['id']
+        self.beer_line, self.soda_line = [line['id'] for line in response.data['lines']]
+
+    def receive(self, lines=None):
+        return self.api.post(f'/api/purchase-orders/{self.order_id}/receive/',
+                             {} if lines is None else {'lines': {str(pk): quantity for pk, quantity in lines.items()}},
+                             format='json')
+
+    def test_receiving_moves_stock_crates_and_history(self):
+        response = self.receive({self.beer_line: 20, self.soda_line: 10})
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(PurchaseOrder.objects.get(pk=self.order_id).state, 'partial')
+        self.reload(self.beer, self.soda, self.packaging)
+        self.assertEqual((self.beer.quantity, self.soda.quantity), (70, 50))
+        self.assertEqual((self.packaging.full_quantity, self.packaging.empty_quantity), (70, 30))
+        self.assertEqual(list(PackagingHistory.objects.filter(action='purchase').values_list(
+            'full_quantity_before', 'full_quantity_after', 'empty_quantity_before', 'empty_quantity_after')),
+            [(50, 70, 50, 30)])
+
+        self.assertEqual(self.receive().status_code, 201)
+        self.assertEqual(PurchaseOrder.objects.get(pk=self.order_id).state, 'received')
+        self.beer.refresh_from_db()
+        self.assertEqual(self.beer.quantity, 80)
+
+    def test_refuses_to_receive_more_than_ordered(self):
+        response = self.receive({self.beer_line: 31})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(PurchaseOrder.objects.get(pk=self.order_id).state, 'open')
+        self.assertFalse(GoodsReceipt.objects.exists())
+
+        def draft(quantity):
+            return self.api.post('/api/goods-receipts/', {
+                'sales_point': self.sales_point.id, 'supplier': self.supplier.id, 'purchase_order': self.order_id,
+                'lines': [{'product': self.soda.id, 'order_line': self.soda_line, 'quantity': quantity}]}, format='json')
+        self.assertEqual(draft(12).status_code, 400)
+        # Two drafts that each fit, but not together
+        first, second = draft(6), draft(6)
+        self.assertEqual(self.api.post(f"/api/goods-receipts/{first.data['id']}/receive/").status_code, 200)
+        response = self.api.post(f"/api/goods-receipts/{second.data['id']}/receive/")
+        self.assertEqual(response.status_code, 400)
+        self.soda.refresh_from_db()
+        self.assertEqual(self.soda.quantity, 46)
+
+
+class ReportTests(InventoryTestCase):
+
+    def test_statement_carries_a_running_balance(self):
+        self.create_bill([(self.beer, self.beer_price, 5, 2), (self.soda, self.soda_price, 4, 0)],
+                         customer=self.customer.id)
+        self.create_bill([(self.soda, self.soda_price, 2, 0)], customer=self.customer.id)
+        rows = self.stream(self.api.get(f'/api/clients/{self.customer.id}/statement/'))
+        # Five beers and four sodas, two crates kept, then two sodas
+        self.assertEqual([(row['entry_type'], row['debit'], row['balance']) for row in rows],
+                         [('bill', '95.00', '95.00'), ('packaging_deposit', '10.00', '105.00'),
+                          ('bill', '10.00', '115.00')])
+        self.assertEqual(self.stream(self.api.get(f'/api/clients/{self.customer.id}/statement/',
+                                                  {'start_date': '2999-01-01'})), [])
+
+    def test_invalid_dates_are_rejected(self):
+        for url in (f'/api/clients/{self.customer.id}/statement/', f'/api/clients/{self.customer.id}/ledger/',
+                    '/api/deliverer-report/'):
+            response = self.api.get(url, {'start_date': '2024-13-45'})
+            self.assertEqual(response.status_code, 400, url)
+            self.assertIn('start_date', response.data)
+            response = self.api.get(url, {'end_date': 'yesterday'})
+            self.assertEqual(response.status_code, 400, url)
+            self.assertIn('end_date', response.data)
+
+
+class StocktakeTests(InventoryTestCase):
+
+    def test_counts_reconcile_and_apply(self):
+        stocktake_id = self.api.post('/api/stocktakes/', {'sales_point': self.sales_point.id}, format='json').data['id']
+        counts = ('product_code,variant,packaging,quantity,empty_quantity\n'
+                  'Lager,,,30,\nLager,,,5,\nSoda,,,45,\n,,Crate,40,70\nNope,,,1,\nSoda,,,x,\n')
+        response = self.api.post(f'/api/stocktakes/{stocktake_id}/counts/',
+                                 {'file': SimpleUploadedFile('counts.csv', counts.encode())}, format='multipart')
+        self.assertEqual((response.data['counted'], response.data['error_count']), (4, 2))
+
+        response = self.api.post(f'/api/stocktakes/{stocktake_id}/reconcile/', {}, format='json')
+        self.assertEqual((response.data['state'], response.data['summary']['surplus'],
+                          response.data['summary']['shortage']), ('open', 5, 15))
+        # Variances are taken again against the stock of the moment they are applied
+        self.create_bill([(self.soda, self.soda_price, 2, 0)])
+        response = self.api.post(f'/api/stocktakes/{stocktake_id}/reconcile/', {'apply': True}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual((response.data['state'], response.data['summary']['surplus']), ('applied', 7))
+        self.reload(self.beer, self.soda, self.packaging)
+        self.assertEqual((self.beer.quantity, self.soda.quantity), (35, 45))
+        self.assertEqual((self.packaging.full_quantity, self.packaging.empty_quantity), (40, 70))
+        self.assertEqual(list(PackagingHistory.objects.filter(action='stocktake').values_list(
+            'full_quantity_before', 'full_quantity_after', 'empty_quantity_before', 'empty_quantity_after')),
+            [(50, 40, 50, 70)])
+        self.assertEqual(self.api.post(f'/api/stocktakes/{stocktake_id}/reconcile/', {'apply': True},
+                                       format='json').status_code, 400)
+
+
+class InventoryValuationTests(InventoryTestCase):
+
+    def valuation(self, **params):
+        response = self.api.get('/api/inventory-valuation/', {'sales_point': self.sales_point.id, **params})
+        return {row['kind']: (row['quantity'], Decimal(str(row['value']))) for row in self.stream(response)}
+
+    def test_live_and_past_valuation(self):
+        self.create_bill([(self.beer, self.beer_price, 5, 2), (self.soda, self.soda_price, 4, 0)])
+        # 45 beers at 10 and 36 sodas at 3, 45 full crates at 5
+        self.assertEqual(self.valuation(), {'product': (81, Decimal('558')), 'packaging': (45, Decimal('225'))})
+
+        # Replayed back from the live stock: the day before the sale, and
+        # before anything was stocked
+        StockMovement.objects.filter(bill__isnull=True).update(created_at=timezone.now() - timedelta(days=2))
+        day_ago = (timezone.now() - timedelta(days=1)).isoformat()
+        self.assertEqual(self.valuation(date=day_ago),
+                         {'product': (90, Decimal('620')), 'packaging': (50, Decimal('250'))})
+        self.assertEqual(self.valuation(date=(timezone.now() - timedelta(days=3)).date().isoformat()),
+                         {'product': (0, Decimal('0')), 'packaging': (0, Decimal('0'))})
+        self.assertEqual(self.api.get('/api/inventory-valuation/', {'date': 'soon'}).status_code, 400)
+
+    def test_packaging_created_after_the_date_is_not_valued(self):
+        StockMovement.objects.update(created_at=timezone.now() - timedelta(days=2))
+        response = self.api.post('/api/packagings/', {
+            'name': 'Keg', 'price': '2', 'supplier': self.supplier.id, 'full_quantity': 20, 'empty_quantity': 5,
+            'sales_point': self.sales_point.id}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(StockMovement.objects.get(packaging=response.data['id']).reason, 'create')
+
+        # Only the 50 full crates stocked with the beer existed a day ago
+        day_ago = (timezone.now() - timedelta(days=1)).isoformat()
+        self.assertEqual(self.valuation(date=day_ago)['packaging'], (50, Decimal('250')))
+        self.assertEqual(self.valuation()['packaging'], (70, Decimal('290')))
+
+
+class ReceivablesAgingTests(InventoryTestCase):
+
+    def test_outstanding_amounts_by_age(self):
+        for days, customer in [(5, self.customer.id), (40, self.customer.id), (100, None), (70, self.customer.id)]:
+            bill_id = self.create_bill([(self.soda, self.soda_price, 2, 0)], customer=customer).data['id']
+            Bill.objects.filter(pk=bill_id).update(created_at=timezone.now() - timedelta(days=days))
+        Bill.objects.filter(pk=bill_id).update(paid=4)
+
+        rows = self.api.get('/api/receivables-aging/', {'sales_point': self.sales_point.id}).data
+        by_client = {row['customer']: [row[bucket] for bucket in ('bills', 'total', '0_30', '31_60', '61_90', '90_plus')]
+                     for row in rows}
+        self.assertEqual(by_client, {None: [1, 10, 0, 0, 0, 10], self.customer.id: [3, 26, 10, 10, 6, 0]})
+        rows = self.api.get('/api/receivables-aging/', {'group_by': 'sales_point'}).data
+        self.assertEqual([(row['bills'], row['total']) for row in rows], [(4, 36)])
+
+
+class DelivererReportTests(InventoryTestCase):
+
+    def test_workload_per_deliverer(self):
+        deliverer = Employee.objects.create(name='Dan', salary=100, role='driver', is_deliverer=True,
+                                            sales_point=self.sales_point, enterprise=self.enterprise)
+        ids = [self.create_bill([(self.soda, self.soda_price, 2, 0)], customer=self.customer.id).data['id']
+               for _ in range(3)]
+        Bill.objects.filter(pk=ids[2]).update(delivery_date=timezone.now() - timedelta(days=1))
+        for bill_id in ids[:2]:
+            self.api.put(f'/api/bills/{bill_id}/update-deliverer/', {'state': 'pending', 'deliverer': deliverer.id},
+                         format='json')
+        self.api.put(f'/api/bills/{ids[0]}/update-delivered/', {'amount': '5'}, format='json')
+
+        rows = {row['deliverer']: row for row in self.api.get('/api/deliverer-report/').data}
+        counts = {key: [rows[key][name] for name in ('created', 'pending', 'success', 'overdue')] for key in rows}
+        self.assertEqual(counts, {None: [1, 0, 0, 1], deliverer.id: [0, 1, 1, 1]})
+        self.assertIsNotNone(rows[deliverer.id]['avg_to_delivered'])
+
+
+class SalesHeatmapTests(InventoryTestCase):
+
+    def cells(self):
+        totals = SalesHeatmapCell.objects.aggregate(bills=Sum('bills'), revenue=Sum('revenue'))
+        return [(totals['bills'], totals['revenue'])]
+
+    def test_cells_follow_bills(self):
+        bill_ids = [self.create_bill([(self.soda, self.soda_price, 2, 0)]).data['id'] for _ in range(3)]
+        self.assertEqual(self.cells(), [(3, Decimal('30'))])
+        Bill.objects.get(pk=bill_ids[0]).delete()
+        self.assertEqual(self.cells(), [(2, Decimal('20'))])
+
+        SalesHeatmapCell.objects.update(bills=99)
+        call_command('rebuild_sales_heatmap', stdout=io.StringIO())
+        self.assertEqual(self.cells(), [(2, Decimal('20'))])
+        data = self.api.get('/api/sales-heatmap/', {'sales_point': self.sales_point.id}).data
+        self.assertEqual(sum(count for row in data[0]['bills'] for count in row), 2)
+
+
+class StreamingExportTests(InventoryTestCase):
+
+    def test_bill_and_product_exports(self):
+        for _ in range(3):
+            self.create_bill([(self.soda, self.soda_price, 1, 0), (self.beer, self.beer_price, 1, 1)],
+                             customer=self.customer.id)
+        response = self.api.get('/api/bills/export/')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=bills.csv')
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([(row['bill_number'], row['lines'], row['total_amount'], row['package_amount'])
+                          for row in rows], [(f'BILL-000{n}', '2', '20.00', '5.00') for n in (1, 2, 3)])
+
+        rows = self.stream(self.api.get('/api/products-list/export/',
+                                        {'sales_point': self.sales_point.id, 'output': 'ndjson'}))
+        self.assertEqual({row['product_code']: row['quantity'] for row in rows}, {'Lager': 47, 'Soda': 37})
+        self.assertEqual(self.api.get('/api/bills/export/', {'output': 'xml'}).status_code, 400)
+
+
+class IdempotencyTests(InventoryTestCase):
+
+    def test_replays_bill_creation(self):
+        payload = self.bill_payload([(self.soda, self.soda_price, 2, 0)], customer=self.customer.id)
+        first = self.api.post('/api/create-bill/', payload, format='json', HTTP_IDEMPOTENCY_KEY='shift-1')
+        again = self.api.post('/api/create-bill/', payload, format='json', HTTP_IDEMPOTENCY_KEY='shift-1')
+        self.assertEqual((first.status_code, again.status_code), (201, 201))
+        self.assertEqual(again['Idempotent-Replayed'], 'true')
+        self.assertEqual(again.data['id'], first.data['id'])
+        self.assertEqual(Bill.objects.count(), 1)
+        self.soda.refresh_from_db()
+        self.assertEqual(self.soda.quantity, 38)
+
+        other = self.bill_payload([(self.soda, self.soda_price, 1, 0)], customer=self.customer.id)
+        self.assertEqual(self.api.post('/api/create-bill/', other, format='json',
+                                       HTTP_IDEMPOTENCY_KEY='shift-1').status_code, 422)
+
+    def test_failed_requests_can_be_retried(self):
+        response = self.api.post('/api/create-bill/', {'product_bills': []}, format='json', HTTP_IDEMPOTENCY_KEY='k')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(IdempotencyKey.objects.filter(status_code__isnull=True).exists())
+
+    def test_replays_payment(self):
+        bill_id = self.create_bill([(self.soda, self.soda_price, 2, 0)], customer=self.customer.id).data['id']
+        Bill.objects.filter(pk=bill_id).update(state='pending')
+        for _ in range(2):
+            response = self.api.put(f'/api/bills/{bill_id}/update-delivered/', {'amount': '10', 'reduce_from_balance': True},
+                                    format='json', HTTP_IDEMPOTENCY_KEY='pay-1')
+            self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(Bill.objects.get(pk=bill_id).paid, Decimal('10'))
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.balance, Decimal('990'))
+        self.assertEqual(ClientLedgerEntry.objects.filter(client=self.customer).exclude(kind='opening').count(), 1)
+
+
+class RepriceTests(InventoryTestCase):
+
+    def reprice(self, **data):
+        response = self.api.post('/api/sell-prices-reprice/', data, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.data
+
+    def prices(self):
+        return [SellPrice.objects.get(pk=sell_price.pk).price for sell_price in (self.beer_price, self.soda_price)]
+
+    def test_rules_and_dry_run(self):
+        result = self.reprice(rule='percent', value='10', dry_run=True)
+        self.assertEqual([row['new_price'] for row in result['sample']], [Decimal('16.5'), Decimal('5.5')])
+        self.assertEqual(self.prices(), [Decimal('15'), Decimal('5')])
+
+        self.assertEqual(self.reprice(rule='percent', value='10', rounding='0.25')['count'], 2)
+        self.assertEqual(self.prices(), [Decimal('16.5'), Decimal('5.5')])
+        # Never below zero
+        self.reprice(rule='delta', value='-20', supplier=[self.supplier.id])
+        self.assertEqual(self.prices(), [Decimal('0'), Decimal('0')])
+        # A third over the product price, rounded to the unit
+        self.reprice(rule='margin', value='33.33', rounding='1')
+        self.assertEqual(self.prices(), [Decimal('13'), Decimal('4')])
+        self.assertEqual(self.reprice(rule='margin', value='5', category=[self.category.id + 1000])['count'], 0)
+        self.assertEqual(self.api.post('/api/sell-prices-reprice/', {'rule': 'percent', 'value': '-100'},
+                                       format='json').status_code, 400)
+
+
+class ClientCategoryPriceTests(InventoryTestCase):
+
+    def test_category_prices_override_sell_prices(self):
+        response = self.api.post('/api/client-category-prices/', {
+            'client_category': self.client_category.id, 'sell_price': self.beer_price.id, 'price': '12.50'},
+            format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        price_id = response.data['id']
+        self.assertEqual(self.api.post('/api/client-category-prices/', {
+            'client_category': self.client_category.id, 'sell_price': self.beer_price.id, 'price': '11'},
+            format='json').status_code, 400)
+
+        lines = [(self.soda, self.soda_price, 1, 0), (self.beer, self.beer_price, 2, 0)]
+        self.assertEqual(Decimal(self.create_bill(lines, customer=self.customer.id).data['total_amount']),
+                         Decimal('30'))
+        self.assertEqual(Decimal(self.create_bill(lines).data['total_amount']), Decimal('35'))
+
+        self.api.patch(f'/api/client-category-prices/{price_id}/', {'price': '10'}, format='json')
+        batch = self.bill_payload([(self.beer, self.beer_price, 1, 0)], customer=self.customer.id)
+        response = self.api.post('/api/bills/batch/', {'bills': [batch]}, format='json')
+        self.assertEqual(Bill.objects.get(pk=response.data['results'][0]['id']).total_amount, Decimal('10'))
+
+        self.assertEqual(self.api.delete(f'/api/client-category-prices/{price_id}/').status_code, 204)
+        response = self.create_bill([(self.beer, self.beer_price, 1, 0)], customer=self.customer.id)
+        self.assertEqual(Decimal(response.data['total_amount']), Decimal('15'))
+
+
+class StockTransferTests(InventoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.other = SalesPoint.objects.create(name='Annex', address='Side street', enterprise=self.enterprise)
+        category = Category.objects.create(name='Drinks', enterprise=self.enterprise, sales_point=self.other)
+        supplier = Supplier.objects.create(name='Brew', enterprise=self.enterprise, sales_point=self.other)
+        self.other_packaging = Packaging.objects.create(name='Crate', price=Decimal('5'), supplier=supplier,
+                                                        full_quantity=0, empty_quantity=100, sales_point=self.other,
+                                                        enterprise=self.enterprise)
+        fields = {'category': category, 'supplier': supplier, 'sales_point': self.other, 'enterprise': self.enterprise}
+        self.other_beer = Product.objects.create(name='Lager', product_code='Lager', quantity=0, price=10,
+                                                 is_beer=True, package=self.other_packaging, **fields)
+        self.other_soda = Product.objects.create(name='Soda', product_code='Soda', quantity=5, price=3, **fields)
+
+    def transfer(self, lines):
+        response = self.api.post('/api/stock-transfers/', {
+            'source': self.sales_point.id, 'destination': self.other.id,
+            'lines': [{'product': product.id, 'quantity': quantity} for product, quantity in lines]}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return self.api.post(f"/api/stock-transfers/{response.data['id']}/execute/")
+
+    def test_moves_stock_and_crates(self):
+        response = self.transfer([(self.beer, 20), (self.soda, 10)])
+        self.assertEqual((response.status_code, response.data['state']), (200, 'done'))
+        self.reload(self.beer, self.soda, self.other_beer, self.other_soda, self.packaging, self.other_packaging)
+        self.assertEqual((self.beer.quantity, self.soda.quantity), (30, 30))
+        self.assertEqual((self.other_beer.quantity, self.other_soda.quantity), (20, 15))
+        self.assertEqual((self.packaging.full_quantity, self.packaging.empty_quantity), (30, 50))
+        self.assertEqual((self.other_packaging.full_quantity, self.other_packaging.empty_quantity), (20, 100))
+        self.assertEqual(sorted(PackagingHistory.objects.filter(action__startswith='transfer').values_list(
+            'action', 'full_quantity_before', 'full_quantity_after')),
+            [('transfer_in', 0, 20), ('transfer_out', 50, 30)])
+        self.assertEqual(self.api.post(f"/api/stock-transfers/{response.data['id']}/execute/").status_code, 400)
+
+    def test_short_source_moves_nothing(self):
+        response = self.transfer([(self.beer, 5), (self.soda, 100)])
+        self.assertEqual(response.status_code, 400)
+        self.reload(self.beer, self.soda, self.other_beer)
+        self.assertEqual((self.beer.quantity, self.soda.quantity, self.other_beer.quantity), (50, 40, 0))
+
+
+class BillReturnTests(InventoryTestCase):
+
+    def test_partial_returns_and_refund(self):
+        bill_id = self.create_bill([(self.beer, self.beer_price, 10, 4), (self.soda, self.soda_price, 6, 0)],
+                                   customer=self.customer.id).data['id']
+        bill = Bill.objects.get(pk=bill_id)
+        lines = {line.product_id: line.pk for line in bill.product_bills.all()}
+        url = f'/api/bills/{bill_id}/returns/'
+
+        response = self.api.post(url, {'lines': [{'product_bill': lines[self.beer.id], 'quantity': 2, 'crates': 1},
+                                                 {'product_bill': lines[self.soda.id], 'quantity': 1}]}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual((response.data['amount'], response.data['package_amount'], response.data['refund']),
+                         ('35.00', '15.00', '0.00'))
+        bill.refresh_from_db()
+        self.assertEqual((bill.total_amount, bill.package_amount), (Decimal('145'), Decimal('5')))
+        self.reload(self.beer, self.soda, self.packaging)
+        self.assertEqual((self.beer.quantity, self.soda.quantity), (42, 35))
+        self.assertEqual((self.packaging.full_quantity, self.packaging.empty_quantity), (42, 57))
+        self.assertEqual(list(PackageProductBill.objects.values_list('quantity', 'record')), [(8, 1)])
+
+        # Once paid, what comes back is refunded to the client balance
+        Bill.objects.filter(pk=bill_id).update(paid=bill.amount_due, state='success')
+        response = self.api.post(url, {'lines': [{'product_bill': lines[self.beer.id], 'quantity': 5}]},
+                                 format='json')
+        self.assertEqual(response.data['refund'], '80.00')
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.balance, Decimal('1080'))
+
+        response = self.api.post(url, {'lines': [{'product_bill': lines[self.beer.id], 'quantity': 50}]},
+                                 format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.api.get(url).data), 2)
+
+
+class BillUpdateTests(InventoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bill_id = self.create_bill([(self.beer, self.beer_price, 10, 4), (self.soda, self.soda_price, 6, 0)],
+                                        customer=self.customer.id).data['id']
+        self.lines = {line['product']: line
+                      for line in self.api.get(f'/api/bills/{self.bill_id}/').data['product_bills']}
+
+    def line(self, product, **changes):
+        line = self.lines[product.id]
+        return {'id': line['id'], 'product': product.id, 'sell_price': line['sell_price'], 'quantity': line['quantity'],
+                'is_variant': False, 'variant_id': None,
+                'record_package': line['package_product_bill']['record'] if line['package_product_bill'] else 0,
+                **changes}
+
+    def update(self, *lines):
+        return self.api.put(f'/api/bills/{self.bill_id}/', {
+            'customer': self.customer.id, 'sales_point': self.sales_point.id, 'product_bills': list(lines)},
+            format='json')
+
+    def stock(self):
+        self.reload(self.beer, self.soda, self.packaging)
+        return (self.beer.quantity, self.soda.quantity, self.packaging.full_quantity, self.packaging.empty_quantity)
+
+    def test_unchanged_lines_leave_stock_alone(self):
+        self.assertEqual(self.stock(), (40, 34, 40, 56))
+        response = self.update(self.line(self.beer), self.line(self.soda))
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.stock(), (40, 34, 40, 56))
+        self.assertFalse(StockMovement.objects.filter(reason='sale_update').exists())
+
+    def test_only_the_differences_move_stock(self):
+        wine = Product.objects.create(name='Wine', product_code='W', quantity=0, price=1, category=self.category,
+                                      supplier=self.supplier, sales_point=self.sales_point,
+                                      enterprise=self.enterprise, with_variant=True)
+        red = Variant.objects.create(product=wine, name='Red', quantity=20)
+        wine_price = SellPrice.objects.create(product=wine, price=Decimal('7'))
+
+        response = self.update(self.line(self.beer, quantity=12, record_package=2),
+                               {'product': wine.id, 'variant_id': red.id, 'is_variant': True,
+                                'sell_price': wine_price.id, 'quantity': 3})
+        self.assertEqual(response.status_code, 200, response.content)
+        red.refresh_from_db()
+        self.assertEqual(self.stock(), (38, 40, 38, 60))
+        self.assertEqual(red.quantity, 17)
+        bill = Bill.objects.get(pk=self.bill_id)
+        self.assertEqual((bill.total_amount, bill.package_amount), (Decimal('201'), Decimal('10')))
+        self.assertEqual(list(PackageProductBill.objects.values_list('quantity', 'record')), [(12, 2)])
+        self.assertCountEqual(
+            StockMovement.objects.filter(reason='sale_update', product__isnull=False)
+            .values_list('product_id', 'variant_id', 'quantity'),
+            [(self.beer.id, None, -2), (self.soda.id, None, 6), (wine.id, red.id, -3)])
+
+    def test_oversell_is_rejected_without_moving_stock(self):
+        response = self.update(self.line(self.beer, quantity=500), self.line(self.soda))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Insufficient quantity for Lager', str(response.data))
+        self.assertEqual(self.stock(), (40, 34, 40, 56))
+
+    def test_guarded_update_raises_stock_conflict(self):
+        with self.assertRaises(StockConflict):
+            with transaction.atomic():
+                apply_quantity_deltas(Product, {self.beer.id: -41, self.soda.id: -1})
+        self.assertEqual(self.stock()[:2], (40, 34))
+        apply_quantity_deltas(Product, {self.beer.id: -40, self.soda.id: 2})
+        self.assertEqual(self.stock()[:2], (0, 36))
+
+
+class BillDeleteTests(InventoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.wine = Product.objects.create(name='Wine', product_code='W', quantity=0, price=1, category=self.category,
+                                           supplier=self.supplier, sales_point=self.sales_point,
+                                           enterprise=self.enterprise, with_variant=True)
+        self.red = Variant.objects.create(product=self.wine, name='Red', quantity=20)
+        wine_price = SellPrice.objects.create(product=self.wine, price=Decimal('7'))
+        self.bill_ids = []
+        for _ in range(5):
+            payload = self.bill_payload([(self.beer, self.beer_price, 3, 1), (self.soda, self.soda_price, 2, 0)])
+            payload['product_bills'].append({'product': self.wine.id, 'variant_id': self.red.id, 'is_variant': True,
+                                             'sell_price': wine_price.id, 'quantity': 1})
+            response = self.api.post('/api/create-bill/', payload, format='json')
+            self.assertEqual(response.status_code, 201, response.content)
+            self.bill_ids.append(response.data['id'])
+
+    def state(self):
+        self.reload(self.beer, self.soda, self.red, self.packaging)
+        return (self.beer.quantity, self.soda.quantity, self.red.quantity, self.packaging.full_quantity,
+                self.packaging.empty_quantity, Bill.objects.count(), ProductBill.objects.count(),
+                SalesHeatmapCell.objects.aggregate(bills=Sum('bills'))['bills'])
+
+    def test_delete_restores_stock_and_crates(self):
+        self.assertEqual(self.state(), (35, 30, 15, 35, 60, 5, 15, 5))
+        self.assertEqual(self.api.delete(f'/api/bills/{self.bill_ids[0]}/').status_code, 204)
+        self.assertEqual(self.state(), (38, 32, 16, 38, 58, 4, 12, 4))
+
+        ProductBill.objects.get(bill=self.bill_ids[1], product=self.beer).delete()
+        self.assertEqual(self.state(), (41, 32, 16, 41, 56, 4, 11, 4))
+        self.assertEqual(Bill.objects.get(pk=self.bill_ids[1]).total_amount, Decimal('17'))
+
+    def test_bulk_delete(self):
+        url = '/api/bills/bulk-delete/'
+        self.assertEqual(self.api.post(url, {}, format='json').status_code, 400)
+        response = self.api.post(url, {'sales_point': self.sales_point.id, 'dry_run': True}, format='json')
+        self.assertEqual(response.data, {'count': 5})
+        self.assertEqual(Bill.objects.count(), 5)
+
+        response = self.api.post(url, {'ids': self.bill_ids[:2]}, format='json')
+        self.assertEqual(response.data, {'deleted': 2})
+        self.assertEqual(self.state(), (41, 34, 17, 41, 56, 3, 9, 3))
+        response = self.api.post(url, {'sales_point': self.sales_point.id}, format='json')
+        self.assertEqual(response.data, {'deleted': 3})
+        self.assertEqual(self.state(), (50, 40, 20, 50, 50, 0, 0, 0))
+
+
+class ClientLedgerTests(InventoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        ClientLedgerEntry.objects.create(client=self.customer, kind='opening', amount=1000)
+
+    def ledger_total(self):
+        return ClientLedgerEntry.objects.filter(client=self.customer).aggregate(total=Sum('amount'))['total']
+
+    def test_rebuild_matches_live_balances(self):
+        bill_id = self.create_bill([(self.beer, self.beer_price, 2, 1)], customer=self.customer.id).data['id']
+        Bill.objects.filter(pk=bill_id).update(state='pending')
+        bill = Bill.objects.get(pk=bill_id)
+        self.assertEqual((bill.total_amount, bill.package_amount), (Decimal('30'), Decimal('5')))
+        response = self.api.put(f'/api/bills/{bill_id}/update-delivered/',
+                                {'amount': str(bill.amount_due), 'reduce_from_balance': True}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        line = ProductBill.objects.get(bill=bill_id)
+        response = self.api.post(f'/api/bills/{bill_id}/returns/',
+                                 {'lines': [{'product_bill': line.pk, 'quantity': 1}]}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        response = self.api.patch(f'/api/clients/{self.customer.id}/', {'balance': '990.00'}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.balance, self.ledger_total())
+        self.assertEqual(rebuild_client_balances(self.sales_point), [])
+        self.assertEqual(list(ClientLedgerEntry.objects.values_list('kind', flat=True).order_by('pk')),
+                         ['opening', 'charge', 'deposit', 'refund', 'payment'])
+
+    def test_rebuild_fixes_drift(self):
+        Client.objects.filter(pk=self.customer.pk).update(balance=7)
+        self.assertEqual(rebuild_client_balances(self.sales_point, fix=False),
+                         [(self.customer.id, Decimal('7'), Decimal('1000'))])
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.balance, Decimal('7'))
+
+        rebuild_client_balances(self.sales_point)
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.balance, Decimal('1000'))
+        self.assertEqual(rebuild_client_balances(self.sales_point), [])
+
+    def test_ledger_endpoint(self):
+        bill_id = self.create_bill([(self.soda, self.soda_price, 2, 0)], customer=self.customer.id).data['id']
+        Bill.objects.filter(pk=bill_id).update(state='pending')
+        response = self.api.put(f'/api/bills/{bill_id}/update-delivered/',
+                                {'amount': '10', 'reduce_from_balance': True}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        rows = self.stream(self.api.get(f'/api/clients/{self.customer.id}/ledger/'))
+        self.assertEqual([(row['kind'], row['amount'], row['bill_number']) for row in rows],
+                         [('opening', '1000.00', None), ('charge', '-10.00', 'BILL-0001')])
+
+
+class BillSettlementTests(InventoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        ClientLedgerEntry.objects.create(client=self.customer, kind='opening', amount=1000)
+        self.bill_ids = [self.create_bill([(self.beer, self.beer_price, 2, 1)], customer=customer).data['id']
+                         for customer in (self.customer.id, self.customer.id, self.customer.id, None)]
+        Bill.objects.filter(pk__in=self.bill_ids).update(state='pending')
+
+    def test_settles_bills_in_one_request(self):
+        start = SalesPoint.objects.get(pk=self.sales_point.pk).current_balance
+        payload = {'bills': [{'bill': self.bill_ids[0], 'amount': '35.00', 'reduce_from_balance': True},
+                             {'bill': self.bill_ids[1], 'amount': '20.00', 'reduce_from_balance': True},
+                             {'bill': self.bill_ids[2], 'amount': '35.00', 'reduce_from_balance': False},
+                             {'bill': self.bill_ids[3], 'amount': '35.00', 'reduce_from_balance': True}]}
+        response = self.api.post('/api/bills/settle/', payload, format='json')
+        self.assertEqual(response.data, {'settled': 4})
+
+        self.assertEqual(list(Bill.objects.filter(pk__in=self.bill_ids).order_by('pk').values_list('state', 'paid')),
+                         [('success', Decimal('35')), ('success', Decimal('20')), ('success', Decimal('35')),
+                          ('success', Decimal('35'))])
+        self.assertEqual(SalesPoint.objects.get(pk=self.sales_point.pk).current_balance - start, Decimal('90'))
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.balance, Decimal('945'))
+        self.assertEqual(rebuild_client_balances(self.sales_point, fix=False), [])
+
+        # Settled bills are no longer pending
+        response = self.api.post('/api/bills/settle/', payload, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_the_whole_batch(self):
+        response = self.api.post('/api/bills/settle/', {'bills': [
+            {'bill': self.bill_ids[0], 'amount': '35.00'}, {'bill': self.bill_ids[0], 'amount': '1'},
+            {'bill': 99999, 'amount': '1'}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(response.data['bills']), 2)
+        self.assertEqual(self.api.post('/api/bills/settle/', {'bills': []}, format='json').status_code, 400)
+        self.assertFalse(Bill.objects.filter(state='success').exists())
+
+
+class PackagingHistoryTests(InventoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        PackagingHistory.objects.all().delete()
+
+    def history(self):
+        # Every entry starts where the previous one ended and the last one matches the packaging
+        rows = list(PackagingHistory.objects.order_by('pk').values_list(
+            'action', 'quantity_changed', 'full_quantity_before', 'empty_quantity_before', 'full_quantity_after',
+            'empty_quantity_after'))
+        for previous, row in zip(rows, rows[1:]):
+            self.assertEqual(previous[4:], row[2:4])
+        self.packaging.refresh_from_db()
+        self.assertEqual(rows[-1][4:], (self.packaging.full_quantity, self.packaging.empty_quantity))
+        PackagingHistory.objects.all().delete()
+        return [row[:2] for row in rows]
+
+    def test_history_follows_bill_lifecycle(self):
+        stout = Product.objects.create(name='Stout', product_code='ST', quantity=0, price=1, category=self.category,
+                                       supplier=self.supplier, sales_point=self.sales_point,
+                                       enterprise=self.enterprise, with_variant=True, is_beer=True,
+                                       package=self.packaging)
+        big = Variant.objects.create(product=stout, name='Big', quantity=20)
+        stout_price = SellPrice.objects.create(product=stout, price=Decimal('7'))
+        payload = self.bill_payload([(self.beer, self.beer_price, 3, 1), (self.soda, self.soda_price, 1, 0)])
+        payload['product_bills'].append({'product': stout.id, 'variant_id': big.id, 'is_variant': True,
+                                         'sell_price': stout_price.id, 'quantity': 4, 'record_package': 1})
+        response = self.api.post('/api/create-bill/', payload, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(self.history(), [('sale', 3), ('sale', 4)])
+        self.assertEqual((self.packaging.full_quantity, self.packaging.empty_quantity), (43, 55))
+
+        bill_id, lines = response.data['id'], response.data['product_bills']
+        response = self.api.put(f'/api/bills/{bill_id}/', {
+            'customer': None, 'customer_name': 'Walk in', 'sales_point': self.sales_point.id, 'product_bills': [
+                {'id': lines[0]['id'], 'product': self.beer.id, 'sell_price': self.beer_price.id, 'quantity': 5,
+                 'is_variant': False, 'record_package': 1},
+                {'id': lines[1]['id'], 'product': self.soda.id, 'sell_price': self.soda_price.id, 'quantity': 1,
+                 'is_variant': False},
+                {'id': lines[2]['id'], 'product': stout.id, 'variant_id': big.id, 'is_variant': True,
+                 'sell_price': stout_price.id, 'quantity': 4, 'record_package': 1}]}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.history(), [('sale_update', 4)])
+
+        self.assertEqual(self.api.delete(f'/api/bills/{bill_id}/').status_code, 204)
+        self.assertEqual(self.history(), [('sale_delete', 5), ('sale_delete', 4)])
+        self.assertEqual((self.packaging.full_quantity, self.packaging.empty_quantity), (50, 50))
+
+    def test_history_of_batch_bills(self):
+        response = self.api.post('/api/bills/batch/', {'bills': [
+            self.bill_payload([(self.beer, self.beer_price, 2, 1)]),
+            self.bill_payload([(self.beer, self.beer_price, 1, 0)])]}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(sorted(PackagingHistory.objects.values_list('bill_id', flat=True)),
+                         sorted(result['id'] for result in response.data['results']))
+        self.assertEqual(self.history(), [('sale', 2), ('sale', 1)])
+        Bill.objects.order_by('pk').first().delete()
+        self.assertEqual(self.history(), [('sale_delete', 2)])
+
+
+class ClientPackagingTests(InventoryTestCase):
+
+    def assertRebuildMatches(self, crates):
+        live = sorted(ClientPackagingBalance.objects.exclude(crates=0).values_list('client_id', 'packaging_id', 'crates'))
+        self.assertEqual(live, [(self.customer.id, self.packaging.id, crates)] if crates else [])
+        rebuild_client_packaging()
+        self.assertEqual(sorted(ClientPackagingBalance.objects.exclude(crates=0).values_list(
+            'client_id', 'packaging_id', 'crates')), live)
+
+    def test_rebuild_matches_live_balances(self):
+        self.assertRebuildMatches(0)
+        response = self.create_bill([(self.beer, self.beer_price, 3, 2), (self.beer, self.beer_price, 2, 1)],
+                                    customer=self.customer.id)
+        bill_id, lines = response.data['id'], response.data['product_bills']
+        self.assertRebuildMatches(3)
+
+        response = self.api.post('/api/bills/batch/', {'bills': [
+            self.bill_payload([(self.beer, self.beer_price, 4, 3)], customer=self.customer.id),
+            self.bill_payload([(self.beer, self.beer_price, 1, 1)])]}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertRebuildMatches(6)
+
+        response = self.api.put(f'/api/bills/{bill_id}/', {
+            'customer': self.customer.id, 'sales_point': self.sales_point.id, 'product_bills': [
+                {'id': lines[0]['id'], 'product': self.beer.id, 'sell_price': self.beer_price.id, 'quantity': 3,
+                 'is_variant': False, 'record_package': 0}]}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertRebuildMatches(3)
+
+        batch_bill = Bill.objects.exclude(pk=bill_id).get(customer=self.customer)
+        response = self.api.post(f'/api/bills/{batch_bill.pk}/returns/', {'lines': [
+            {'product_bill': batch_bill.product_bills.get().pk, 'quantity': 1, 'crates': 1}]}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertRebuildMatches(1)
+
+        response = self.api.post('/api/recorded-packagings/', {
+            'customer': self.customer.id, 'quantity': 1, 'bill': batch_bill.pk, 'packaging': self.packaging.id},
+            format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertRebuildMatches(0)
+        self.assertEqual(self.api.delete(f"/api/recorded-packagings/{response.data['id']}/").status_code, 204)
+        self.assertRebuildMatches(1)
+
+        response = self.api.get(f'/api/clients/{self.customer.id}/packaging/')
+        self.assertEqual([(row['packaging'], row['crates']) for row in response.data], [(self.packaging.id, 1)])
+
+        self.assertEqual(self.api.delete(f'/api/bills/{batch_bill.pk}/').status_code, 204)
+        self.assertRebuildMatches(0)
+
+    def test_rebuild_fixes_drift(self):
+        self.create_bill([(self.beer, self.beer_price, 3, 2)], customer=self.customer.id)
+        ClientPackagingBalance.objects.update(crates=40)
+        rebuild_client_packaging()
+        self.assertRebuildMatches(2)
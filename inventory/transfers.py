@@ -0,0 +1,104 @@
+from collections import defaultdict
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import serializers
+from .billing import StockConflict, apply_quantity_deltas
+from .models import Product, Variant, Packaging, PackagingHistory, StockMovement, StockTransfer
+
+
+def _destination_lines(transfer, lines):
+    # Matches every line with the product (and variant) of the destination:
+    # same product_code, variants by name. Raises on anything unmatched.
+    codes = {line.product.product_code for line in lines}
+    products = {product.product_code: product for product in
+                Product.objects.filter(sales_point=transfer.destination, product_code__in=codes)}
+    variants = {(variant.product_id, variant.name.casefold()): variant for variant in
+                Variant.objects.filter(product__in=products.values())}
+    errors = []
+    matched = []
+    for line in lines:
+        product = products.get(line.product.product_code)
+        variant = None
+        if product is None:
+            errors.append(f"{line.product.name}: no product with code '{line.product.product_code}' at {transfer.destination}.")
+            continue
+        if line.variant:
+            variant = variants.get((product.pk, line.variant.name.casefold()))
+            if variant is None:
+                errors.append(f"{line.variant.name}: no such variant of {product.name} at {transfer.destination}.")
+                continue
+        if line.product.is_beer and line.product.package_id and not product.package_id:
+            errors.append(f"{product.name}: no packaging at {transfer.destination}.")
+            continue
+        matched.append((line, product, variant))
+    if errors:
+        raise serializers.ValidationError({'lines': errors})
+    return matched
+
+def execute_stock_transfer(transfer, user):
+    """Moves the stock of a draft transfer from its source to its destination.
+
+    Runs in one transaction with one conditional UPDATE per table: the source
+    rows are only decremented where enough is left, the destination rows are
+    incremented, and beer crates travel full from the source packaging to
+    the destination one. Movements and packaging history are bulk inserted.
+    """
+    with transaction.atomic():
+        transfer = StockTransfer.objects.select_for_update().select_related('source', 'destination').get(pk=transfer.pk)
+        if transfer.state != 'draft':
+            raise serializers.ValidationError({'state': 'Only draft transfers can be executed.'})
+        lines = list(transfer.lines.select_related('product', 'variant'))
+        if not lines:
+            raise serializers.ValidationError({'lines': 'The transfer has no lines.'})
+        matched = _destination_lines(transfer, lines)
+
+        product_deltas = defaultdict(int)
+        variant_deltas = defaultdict(int)
+        crate_moves = []
+        movements = []
+        for line, product, variant in matched:
+            if line.variant:
+                variant_deltas[line.variant_id] -= line.quantity
+                variant_deltas[variant.pk] += line.quantity
+            else:
+                product_deltas[line.product_id] -= line.quantity
+                product_deltas[product.pk] += line.quantity
+            movements.append(StockMovement(sales_point=transfer.source, product=line.product, variant=line.variant,
+                                           quantity=-line.quantity, reason='transfer_out'))
+            movements.append(StockMovement(sales_point=transfer.destination, product=product, variant=variant,
+                                           quantity=line.quantity, reason='transfer_in'))
+            if line.product.is_beer and line.product.package_id:
+                crate_moves.append((line.product, line.product.package_id, -line.quantity, transfer.source))
+                crate_moves.append((product, product.package_id, line.quantity, transfer.destination))
+
+        # Locked so that the history below records exact before/after values
+        packagings = Packaging.objects.select_for_update().in_bulk({package_id for _, package_id, _, _ in crate_moves})
+        crate_deltas = defaultdict(int)
+        history = []
+        for product, package_id, delta, sales_point in crate_moves:
+            packaging = packagings[package_id]
+            if packaging.full_quantity + delta < 0:
+                raise serializers.ValidationError({'lines': [f"Not enough full {packaging.name} crates at {sales_point}."]})
+            crate_deltas[package_id] += delta
+            history.append(PackagingHistory(
+                packaging=packaging, product=product, action='transfer_out' if delta < 0 else 'transfer_in',
+                quantity_changed=abs(delta), full_quantity_before=packaging.full_quantity,
+                empty_quantity_before=packaging.empty_quantity, full_quantity_after=packaging.full_quantity + delta,
+                empty_quantity_after=packaging.empty_quantity, performed_by=user, sales_point=sales_point))
+            packaging.full_quantity += delta
+            movements.append(StockMovement(sales_point=sales_point, packaging=packaging, quantity=delta,
+                                           reason='transfer_out' if delta < 0 else 'transfer_in'))
+
+        try:
+            apply_quantity_deltas(Product, product_deltas)
+            apply_quantity_deltas(Variant, variant_deltas)
+            apply_quantity_deltas(Packaging, crate_deltas, field='full_quantity')
+        except StockConflict:
+            raise serializers.ValidationError({'lines': [f"Not enough stock at {transfer.source} for this transfer."]})
+        StockMovement.objects.bulk_create(movements)
+        PackagingHistory.objects.bulk_create(history)
+
+        transfer.state = 'done'
+        transfer.executed_at = timezone.now()
+        transfer.save(update_fields=['state', 'executed_at'])
+    return transfer
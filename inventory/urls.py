@@ -7,7 +7,15 @@ from .views import (ProductViewSet, CategoryViewSet, SupplierViewSet, ClientCate
                     BillDetailView,SalesPointCreateView, SalesPointUpdateView, SalesPointDeleteView,EmployeeViewSet,
                     DelivererUpdateViewSet,UpdateDeliveredBillView,EmployeeDebtViewSet,PayDebtView,SalesPointListView,
                     CustomerBillListView,generate_pdf,RecordedPackagingViewSet,PackagingViewSet,TokenVerifyView,
-                    ProductListView,ProductBillListView,PackagingHistoryListView
+                    ProductListView,ProductBillListView,PackagingHistoryListView,InventoryValuationView,
+                    ClientStatementView,ClientLedgerView,ClientPackagingView,ReceivablesAgingView,DelivererReportView,SalesHeatmapView,
+                    ColumnarExportView,BillExportView,UserCustomersExportView,ProductExportView,
+                    PackagingHistoryExportView,BatchBillCreateView,ProductImportView,SellPriceRepriceView,
+                    ProductPriceHistoryView,ClientCategoryPriceViewSet,StockTransferViewSet,
+                    StockTransferExecuteView,StocktakeViewSet,StocktakeCountView,StocktakeReconcileView,
+                    StocktakeVarianceExportView,PurchaseOrderViewSet,GoodsReceiptViewSet,GoodsReceiptReceiveView,
+                    PurchaseOrderReceiveView,BillReturnView,BillBulkDeleteView,BulkSettleBillsView,
+                    BillDispatchView
                     )
 
 router = DefaultRouter()
@@ -15,6 +23,7 @@ router.register(r'products', ProductViewSet)
 router.register(r'categories', CategoryViewSet)
 router.register(r'suppliers', SupplierViewSet)
 router.register(r'client-categories', ClientCategoryViewSet)
+router.register(r'client-category-prices', ClientCategoryPriceViewSet, basename='client-category-price')
 router.register(r'clients', ClientViewSet)
 router.register(r'enterprises', EnterpriseViewSet)  
 router.register(r'payment-info', PaymentInfoViewSet)
@@ -28,6 +37,10 @@ router.register(r'employees', EmployeeViewSet)
 router.register(r'employeedebts', EmployeeDebtViewSet)
 router.register(r'recorded-packagings', RecordedPackagingViewSet)
 router.register(r'packagings', PackagingViewSet)
+router.register(r'stock-transfers', StockTransferViewSet, basename='stock-transfer')
+router.register(r'stocktakes', StocktakeViewSet, basename='stocktake')
+router.register(r'purchase-orders', PurchaseOrderViewSet, basename='purchase-order')
+router.register(r'goods-receipts', GoodsReceiptViewSet, basename='goods-receipt')
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -40,6 +53,10 @@ urlpatterns = [
     path('user-products/', UserProductsView.as_view(), name='user-products'),
     path('user-customers/', UserCustomersView.as_view(), name='user-customers'),
     path('create-bill/', BillCreateView.as_view(), name='create-bill'),
+    path('bills/batch/', BatchBillCreateView.as_view(), name='bill-batch'),
+    path('bills/bulk-delete/', BillBulkDeleteView.as_view(), name='bill-bulk-delete'),
+    path('bills/settle/', BulkSettleBillsView.as_view(), name='bill-settle'),
+    path('bills/dispatch/', BillDispatchView.as_view(), name='bill-dispatch'),
     path('bills/', BillListView.as_view(), name='bill-list'),
     path('bills/<int:pk>/', BillDetailView.as_view(), name='bill-detail'),
     path('sales-points/', SalesPointCreateView.as_view(), name='sales-point-create'),
@@ -47,14 +64,36 @@ urlpatterns = [
     path('sales-points/<int:pk>/delete/', SalesPointDeleteView.as_view(), name='sales-point-delete'),
     path('bills/<int:pk>/update-deliverer/', DelivererUpdateViewSet.as_view({'put': 'update_deliverer'}), name='update-deliverer'),
     path('bills/<int:pk>/update-delivered/', UpdateDeliveredBillView.as_view(), name='update-delivered-bill'),
+    path('bills/<int:pk>/returns/', BillReturnView.as_view(), name='bill-returns'),
     path('employeedebts/<int:pk>/pay/', PayDebtView.as_view(), name='pay-debt'),
     path('sales-points-list/', SalesPointListView.as_view(), name='sales-point-list'),
     path('bills/customer/', CustomerBillListView.as_view(), name='customer-bill-list'),
     path('api/bills/<int:bill_id>/generate-pdf/', generate_pdf, name='generate_pdf'),
     path('verify-token/', TokenVerifyView.as_view(), name='verify_token'),
     path('products-list/', ProductListView.as_view(), name='product-list'),
+    path('products-import/', ProductImportView.as_view(), name='product-import'),
+    path('sell-prices-reprice/', SellPriceRepriceView.as_view(), name='sell-price-reprice'),
+    path('products/<int:pk>/price-history/', ProductPriceHistoryView.as_view(), name='product-price-history'),
+    path('stock-transfers/<int:pk>/execute/', StockTransferExecuteView.as_view(), name='stock-transfer-execute'),
+    path('stocktakes/<int:pk>/counts/', StocktakeCountView.as_view(), name='stocktake-counts'),
+    path('stocktakes/<int:pk>/reconcile/', StocktakeReconcileView.as_view(), name='stocktake-reconcile'),
+    path('stocktakes/<int:pk>/variances/', StocktakeVarianceExportView.as_view(), name='stocktake-variances'),
+    path('purchase-orders/<int:pk>/receive/', PurchaseOrderReceiveView.as_view(), name='purchase-order-receive'),
+    path('goods-receipts/<int:pk>/receive/', GoodsReceiptReceiveView.as_view(), name='goods-receipt-receive'),
     path('product-bills/', ProductBillListView.as_view(), name='product_bill_list'),
     path('packaging-history/', PackagingHistoryListView.as_view(), name='packaging-history-list'),
+    path('inventory-valuation/', InventoryValuationView.as_view(), name='inventory-valuation'),
+    path('clients/<int:pk>/statement/', ClientStatementView.as_view(), name='client-statement'),
+    path('clients/<int:pk>/ledger/', ClientLedgerView.as_view(), name='client-ledger'),
+    path('clients/<int:pk>/packaging/', ClientPackagingView.as_view(), name='client-packaging'),
+    path('receivables-aging/', ReceivablesAgingView.as_view(), name='receivables-aging'),
+    path('deliverer-report/', DelivererReportView.as_view(), name='deliverer-report'),
+    path('sales-heatmap/', SalesHeatmapView.as_view(), name='sales-heatmap'),
+    path('exports/<str:dataset>.arrows', ColumnarExportView.as_view(), name='columnar-export'),
+    path('bills/export/', BillExportView.as_view(), name='bill-export'),
+    path('user-customers/export/', UserCustomersExportView.as_view(), name='user-customers-export'),
+    path('products-list/export/', ProductExportView.as_view(), name='product-export'),
+    path('packaging-history/export/', PackagingHistoryExportView.as_view(), name='packaging-history-export'),
 
 
 ]    
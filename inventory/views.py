@@ -2,13 +2,17 @@ from rest_framework import viewsets
 from .models import (Product, Category, Supplier,ClientCategory, Client,
                      Enterprise,PaymentInfo,Plan,User,SellPrice,Bill,Variant,
                      SalesPoint,Employee,EmployeeDebt,Packaging,RecordedPackaging,ProductBill,
-                     PackagingHistory
+                     PackagingHistory,IdempotencyKey,SellPriceHistory,ClientCategoryPrice,StockTransfer,
+                     Stocktake,StocktakeLine,PurchaseOrder,GoodsReceipt,ClientLedgerEntry,ClientPackagingBalance
                      )
 from .serializers import (ProductSerializer, CategorySerializer, SupplierSerializer, ClientCategorySerializer, ClientSerializer,
                           EnterpriseSerializer, PaymentInfoSerializer,PlanSerializer,UserSerializer,CustomTokenObtainPairSerializer,SellPriceSerializer,BillSerializer,ProductVariantSerializer,
                           SalesPointSerializer,EmployeeSerializer,DelivererUpdateSerializer,UpdateDeliveredBillSerializer,EmployeeDebtSerializer,PayDebtSerializer,
                           PackagingSerializer,RecordedPackagingSerializer,ProductBillSerializer,
-                          PackagingHistorySerializer
+                          PackagingHistorySerializer,RepriceSerializer,SellPriceHistorySerializer,
+                          ClientCategoryPriceSerializer,StockTransferSerializer,StocktakeSerializer,
+                          PurchaseOrderSerializer,GoodsReceiptSerializer,BillReturnSerializer,BulkSettlementSerializer,
+                          BillDispatchSerializer
                           )
 from rest_framework import generics, status
 from rest_framework.response import Response
@@ -18,7 +22,7 @@ from rest_framework_simplejwt.views import TokenRefreshView,TokenObtainPairView
 from rest_framework.permissions import IsAuthenticated,AllowAny
 from rest_framework.views import APIView
 from django_filters import rest_framework as filters
-from django.db.models import F
+from django.db.models import F, Q
 from rest_framework import serializers
 from django.core.exceptions import PermissionDenied,ValidationError
 from django.shortcuts import get_object_or_404
@@ -30,9 +34,69 @@ import pdfkit
 from django.http import HttpResponse,JsonResponse
 from django.template.loader import get_template
 from django.utils.dateparse import parse_datetime
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from .functions import (stream_ndjson, get_report_sales_points, parse_report_datetime, report_date_range,
+                        stock_valuation, client_statement, receivables_aging, deliverer_report, sales_heatmap,
+                        reprice_sell_prices, invalidate_catalogue_cache)
+from django.core.cache import cache
+from . import exports, imports, stocktakes
+from .billing import submit_bill_batch, delete_bills, settle_bills, dispatch_bills
+from .transfers import execute_stock_transfer
+from .purchasing import receive_goods, receipt_from_order
+from .returns import return_bill_lines
+from rest_framework.parsers import MultiPartParser, FormParser
+from functools import wraps
+from django.db import IntegrityError
+import hashlib
+from collections import defaultdict
 
 User = get_user_model()
 
+def idempotent(handler):
+    # Handlers wrapped with this answer a retry carrying the same
+    # Idempotency-Key header with the stored response of the first request.
+    @wraps(handler)
+    def wrapper(self, request, *args, **kwargs):
+        client_key = request.headers.get('Idempotency-Key')
+        if not client_key:
+            return handler(self, request, *args, **kwargs)
+        if len(client_key) > 255:
+            return Response({'detail': 'Idempotency-Key is too long.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        key = hashlib.sha256(f"{request.user.pk}:{request.method}:{request.path}:{client_key}".encode()).hexdigest()
+        request_hash = hashlib.sha256(request.body).hexdigest()
+        now = timezone.now()
+        IdempotencyKey.objects.filter(key=key, expires_at__lte=now).delete()
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(key=key, request_hash=request_hash,
+                                                       expires_at=now + IdempotencyKey.TTL)
+        except IntegrityError:
+            record = IdempotencyKey.objects.filter(key=key).first()
+            if record is None or record.status_code is None:
+                return Response({'detail': 'A request with this Idempotency-Key is still being processed.'},
+                                status=status.HTTP_409_CONFLICT)
+            if record.request_hash != request_hash:
+                return Response({'detail': 'This Idempotency-Key was already used for a different request.'},
+                                status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            response = Response(record.response, status=record.status_code)
+            response['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = handler(self, request, *args, **kwargs)
+        except Exception:
+            # Errors raised by the view are not stored, the request can be retried
+            record.delete()
+            raise
+        if response.status_code >= 500:
+            record.delete()
+        else:
+            IdempotencyKey.objects.filter(pk=record.pk).update(status_code=response.status_code, response=response.data)
+        return response
+    return wrapper
+
 class IsAdminOrManager(IsAuthenticated):
     def has_permission(self, request, view):
         return super().has_permission(request, view) and (
@@ -139,6 +203,27 @@ class ClientCategoryViewSet(viewsets.ModelViewSet):
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
+class ClientCategoryPriceViewSet(viewsets.ModelViewSet):
+    # Price lists of the client categories, overriding SellPrice on the bills
+    # of their clients
+    serializer_class = ClientCategoryPriceSerializer
+    permission_classes = [IsAdminOrManager]
+
+    def get_queryset(self):
+        user = self.request.user
+        queryset = ClientCategoryPrice.objects.filter(client_category__enterprise=user.enterprise)
+        if user.user_type != 'admin':
+            queryset = queryset.filter(sell_price__product__sales_point=user.sales_point)
+        client_category = self.request.query_params.get('client_category')
+        if client_category:
+            queryset = queryset.filter(client_category=client_category)
+        return queryset
+
+    def perform_destroy(self, instance):
+        sales_point_id = instance.sell_price.product.sales_point_id
+        instance.delete()
+        invalidate_catalogue_cache([sales_point_id])
+
 class ClientViewSet(viewsets.ModelViewSet):
     queryset = Client.objects.all()
     serializer_class = ClientSerializer
@@ -202,10 +287,16 @@ class UserCustomersView(APIView):
         if not enterprise:
             return Response({'detail': 'User does not belong to any enterprise.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        client = Client.objects.filter(enterprise=enterprise)
+        client = self.get_queryset()
         serializer = ClientSerializer(client, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    def get_queryset(self):
+        enterprise = self.request.user.enterprise
+        if not enterprise:
+            return Client.objects.none()
+        return Client.objects.filter(enterprise=enterprise)
+
 class RegisterUserView(generics.CreateAPIView):
     permission_classes = [AllowAny]
 
@@ -330,17 +421,85 @@ class SellPriceDetailView(viewsets.ModelViewSet):
     queryset = SellPrice.objects.all()
     serializer_class = SellPriceSerializer
 
+class ProductPriceHistoryView(generics.ListAPIView):
+    # Price history of the sell prices of a product. With ?at=<date> only the
+    # rows in effect at that date are returned.
+    serializer_class = SellPriceHistorySerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        queryset = SellPriceHistory.objects.filter(product_id=self.kwargs['pk'],
+                                                   product__enterprise=self.request.user.enterprise)
+        at = self.request.query_params.get('at')
+        if at:
+            at = parse_report_datetime(at, end_of_day=True)
+            if at is None:
+                raise serializers.ValidationError({'at': 'Invalid date.'})
+            queryset = queryset.filter(effective_from__lte=at).filter(
+                Q(effective_to__isnull=True) | Q(effective_to__gt=at))
+        return queryset.order_by('sell_price_id', 'effective_from')
+
+class SellPriceRepriceView(APIView):
+    # Applies a percentage, a fixed delta or a margin over Product.price to
+    # every SellPrice of the selected sales points, categories and suppliers.
+    permission_classes = [IsAdminOrManager]
+
+    def post(self, request):
+        serializer = RepriceSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        sales_points = get_report_sales_points(request.user, data['sales_point'])
+        sell_prices = SellPrice.objects.filter(product__enterprise=request.user.enterprise,
+                                               product__sales_point__in=sales_points)
+        if data['category']:
+            sell_prices = sell_prices.filter(product__category__in=data['category'])
+        if data['supplier']:
+            sell_prices = sell_prices.filter(product__supplier__in=data['supplier'])
+
+        result = reprice_sell_prices(sell_prices, data['rule'], data['value'], data.get('rounding'), data['dry_run'])
+        result['dry_run'] = data['dry_run']
+        return Response(result, status=status.HTTP_200_OK)
+
 class BillCreateView(generics.CreateAPIView):
     queryset = Bill.objects.all()
     serializer_class = BillSerializer
     permission_classes = [IsAuthenticated]
 
+    @idempotent
+    def post(self, request, *args, **kwargs):
+        return super().post(request, *args, **kwargs)
+
     def perform_create(self, serializer):
         user = self.request.user
         enterprise = user.enterprise
        
         serializer.save(enterprise=enterprise)
 
+class BatchBillCreateView(APIView):
+    # End-of-shift upload of bills collected offline. Every bill is validated
+    # against one catalogue loaded for the whole batch; the valid ones are
+    # committed in chunks and the response has one result per bill.
+    permission_classes = [IsAuthenticated]
+    max_batch_size = 1000
+    chunk_size = 50
+
+    @idempotent
+    def post(self, request):
+        bills_data = request.data.get('bills') if isinstance(request.data, dict) else request.data
+        if not isinstance(bills_data, list) or not bills_data:
+            return Response({'bills': 'Expected a non-empty list of bills.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(bills_data) > self.max_batch_size:
+            return Response({'bills': f'At most {self.max_batch_size} bills can be sent at once.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not request.user.enterprise:
+            return Response({'detail': 'User does not belong to any enterprise.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = submit_bill_batch(request.user, bills_data, self.chunk_size)
+        created = sum(1 for result in results if result['status'] == 'created')
+        return Response({'created': created, 'failed': len(results) - created, 'results': results},
+                        status=status.HTTP_201_CREATED if created == len(results) else status.HTTP_207_MULTI_STATUS)
+
 class VariantCreateView(viewsets.ModelViewSet):
     queryset = Variant.objects.all()
     permission_classes = [AllowAny]
@@ -376,19 +535,10 @@ class BillListView(generics.ListCreateAPIView):
             serializer.save(enterprise=user.enterprise, sales_point=sales_point)
     
     def destroy(self, request, *args, **kwargs):
+        # delete_bills() gives the stock and crates back
         instance = self.get_object()
-        
-        # Iterate through all associated product bills
-        for product_bill in instance.product_bills.all():
-            if product_bill.is_variant:
-                # If the product bill is a variant, increase the variant's quantity
-                Variant.objects.filter(pk=product_bill.variant.id).update(quantity=F('quantity') + product_bill.quantity)
-            else:
-                # If the product bill is a standard product, increase the product's quantity
-                Product.objects.filter(pk=product_bill.product.id).update(quantity=F('quantity') + product_bill.quantity)
-
-        # Perform the deletion
-        self.perform_destroy(instance)
+        with transaction.atomic():
+            delete_bills(Bill.objects.filter(pk=instance.pk), request.user)
         return Response(status=status.HTTP_204_NO_CONTENT)
     
     def get_queryset(self):
@@ -396,7 +546,7 @@ class BillListView(generics.ListCreateAPIView):
         if user.user_type == 'admin':
             return Bill.objects.filter(enterprise=user.enterprise)
         else:
-            sales_point = user.enterprise.sales_point
+            sales_point = user.sales_point
             return Bill.objects.filter(enterprise=user.enterprise,sales_point=sales_point)
         
     def update(self, request, *args, **kwargs):
@@ -404,26 +554,41 @@ class BillListView(generics.ListCreateAPIView):
         instance = self.get_object()
         serializer = self.get_serializer(instance, data=request.data, partial=partial)
         serializer.is_valid(raise_exception=True)
+        # The serializer already moves the stock of the changed lines
         self.perform_update(serializer)
-        
-        # Update stock quantities
-        for product_bill_data in request.data.get('product_bills', []):
-            product = product_bill_data['product']
-            quantity = product_bill_data['quantity']
-            is_variant = product_bill_data['is_variant']
-            variant_id = product_bill_data.get('variant_id')
-
-            if is_variant:
-                variant = Variant.objects.get(pk=variant_id)
-                variant.quantity = F('quantity') - quantity
-                variant.save()
-            else:
-                product_instance = Product.objects.get(pk=product)
-                product_instance.quantity = F('quantity') - quantity
-                product_instance.save()
-
         return Response(serializer.data)
 
+class BillBulkDeleteView(APIView):
+    # Deletes the bills matching BillFilter fields (and/or "ids") given in
+    # the body, giving their stock back; {"dry_run": true} only counts them.
+    permission_classes = [IsAdminOrManager]
+    chunk_size = 500
+
+    def post(self, request):
+        user = request.user
+        bills = Bill.objects.filter(enterprise=user.enterprise)
+        if user.user_type != 'admin':
+            bills = bills.filter(sales_point=user.sales_point)
+        filterset = BillFilter(data=request.data, queryset=bills)
+        if not filterset.is_valid():
+            return Response(filterset.errors, status=status.HTTP_400_BAD_REQUEST)
+        ids = request.data.get('ids')
+        if not ids and not any(request.data.get(name) not in (None, '') for name in filterset.filters):
+            return Response({'detail': 'At least one filter or a list of ids is required.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        bills = filterset.qs
+        if ids:
+            bills = bills.filter(pk__in=ids)
+
+        bill_ids = list(bills.order_by('pk').values_list('pk', flat=True))
+        if str(request.data.get('dry_run', '')).lower() in ('1', 'true'):
+            return Response({'count': len(bill_ids)}, status=status.HTTP_200_OK)
+        deleted = 0
+        for start in range(0, len(bill_ids), self.chunk_size):
+            with transaction.atomic():
+                deleted += delete_bills(Bill.objects.filter(pk__in=bill_ids[start:start + self.chunk_size]), user)
+        return Response({'deleted': deleted}, status=status.HTTP_200_OK)
+
 class BillDetailView(generics.RetrieveUpdateDestroyAPIView):
     queryset = Bill.objects.all()
     serializer_class = BillSerializer
@@ -431,8 +596,9 @@ class BillDetailView(generics.RetrieveUpdateDestroyAPIView):
 
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
-        # Perform the deletion
-        self.perform_destroy(instance)
+        # Gives the stock and crates back, recording who did it
+        with transaction.atomic():
+            delete_bills(Bill.objects.filter(pk=instance.pk), request.user)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 class SalesPointCreateView(generics.CreateAPIView):
@@ -532,8 +698,9 @@ class DelivererUpdateViewSet(viewsets.ViewSet):
             state = serializer.validated_data.get('state')
             deliverer = serializer.validated_data.get('deliverer')
 
-            if state == 'pending':
+            if state == 'pending' and bill.state != 'pending':
                 bill.state = 'pending'
+                bill.pending_at = timezone.now()
             if deliverer is not None:
                 bill.deliverer = deliverer
             elif 'deliverer' in request.data and request.data['deliverer'] is None:
@@ -544,17 +711,41 @@ class DelivererUpdateViewSet(viewsets.ViewSet):
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class BillDispatchView(APIView):
+    # Morning dispatch: assigns a deliverer to and/or moves created bills to
+    # pending for a whole set of bills, see dispatch_bills()
+    permission_classes = [IsAdminOrManager]
+
+    def post(self, request):
+        serializer = BillDispatchSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        user = request.user
+        bills = Bill.objects.filter(enterprise=user.enterprise)
+        if user.user_type != 'admin':
+            bills = bills.filter(sales_point=user.sales_point)
+        if 'ids' in data:
+            bills = bills.filter(pk__in=data['ids'])
+        if 'sales_point' in data:
+            bills = bills.filter(sales_point=data['sales_point'])
+        if 'delivery_date' in data:
+            bills = bills.filter(delivery_date__date=data['delivery_date'])
+        if 'state' in data:
+            bills = bills.filter(state=data['state'])
+
+        changes = {}
+        if 'deliverer' in data:
+            changes['deliverer'] = data['deliverer']
+        if 'to_state' in data:
+            changes['state'] = data['to_state']
+        updated = dispatch_bills(bills, changes)
+        return Response({'updated': updated}, status=status.HTTP_200_OK)
+
 class UpdateDeliveredBillView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @idempotent
     def put(self, request, *args, **kwargs):
-        bill_id = kwargs.get('pk')
-        bill = get_object_or_404(Bill, pk=bill_id)
-
-        # Ensure the bill is in 'pending' state before updating
-        if bill.state != 'pending':
-            return Response({"detail": "Bill must be in 'pending' state to update."}, status=status.HTTP_400_BAD_REQUEST)
-
         # Validate and update the amount
         serializer = UpdateDeliveredBillSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -562,47 +753,61 @@ class UpdateDeliveredBillView(APIView):
         reduce_from_balance = serializer.validated_data['reduce_from_balance']
         use_balance_as_paid = serializer.validated_data['use_balance_as_paid']
 
-        # Calculate total_amount dynamically if not stored
-        total_amount = sum(pb.quantity * pb.price for pb in bill.product_bills.all())
-
         if amount < 0:
             return Response({"detail": "Amount cannot be less than 0."}, status=status.HTTP_400_BAD_REQUEST)
 
-        if amount > total_amount:
-            return Response({"detail": "Amount cannot be greater than the total amount."}, status=status.HTTP_400_BAD_REQUEST)
+        # Balances are changed with atomic increments; only the bill is locked,
+        # so that it cannot be settled twice.
+        with transaction.atomic():
+            bill = get_object_or_404(Bill.objects.select_for_update().select_related('sales_point'), pk=kwargs.get('pk'))
 
-        sales_point = bill.sales_point
-        if sales_point:
-            # Use transaction.atomic to ensure balance is updated correctly
-            with transaction.atomic():
+            # Ensure the bill is in 'pending' state before updating
+            if bill.state != 'pending':
+                return Response({"detail": "Bill must be in 'pending' state to update."}, status=status.HTTP_400_BAD_REQUEST)
+
+            if amount > bill.amount_due:
+                return Response({"detail": "Amount cannot be greater than the total amount."}, status=status.HTTP_400_BAD_REQUEST)
+
+            sales_point = bill.sales_point
+            if sales_point:
                 # Update sales point balance if required
                 if reduce_from_balance:
-                    sales_point.balance += amount
-                    sales_point.save()
+                    sales_point.add_to_balance(amount)
 
                 # Update client's balance if applicable
-                client = bill.client
-                if reduce_from_balance and client.balance < amount:
+                bill.paid = amount
+                if bill.customer_id is not None and reduce_from_balance:
                     if use_balance_as_paid:
-                        bill.paid = client.balance
-                        client.balance = 0
-                    else:
-                        bill.paid = amount
-                        client.balance -= amount
-                elif reduce_from_balance:
-                    bill.paid = amount
-                    client.balance -= amount
-                else:
-                    bill.paid = amount
-
-                client.save()
+                        balance = Client.objects.select_for_update().values_list('balance', flat=True).get(
+                            pk=bill.customer_id)
+                        if balance < amount:
+                            # The balance does not cover the amount: what is left of it is paid
+                            bill.paid = balance
+                    ClientLedgerEntry.post(ClientLedgerEntry.bill_payment(bill, bill.paid, request.user))
 
                 # Update the bill's state
-                bill.state = 'delivered'  # Update to the correct state
-                bill.save()
+                bill.state = 'success'
+                bill.paid_at = bill.delivered_at = timezone.now()
+                bill.save(update_fields=['paid', 'state', 'paid_at', 'delivered_at'])
 
         return Response({"detail": "Bill updated and sales point balance adjusted."}, status=status.HTTP_200_OK)
 
+class BulkSettleBillsView(APIView):
+    # Settles every bill a deliverer brings back in one request, see
+    # settle_bills(); same rules as UpdateDeliveredBillView.
+    permission_classes = [IsAuthenticated]
+
+    @idempotent
+    def post(self, request):
+        serializer = BulkSettlementSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user = request.user
+        bills = Bill.objects.filter(enterprise=user.enterprise)
+        if user.user_type != 'admin':
+            bills = bills.filter(sales_point=user.sales_point)
+        settled = settle_bills(bills, serializer.validated_data['bills'], user)
+        return Response({'settled': settled}, status=status.HTTP_200_OK)
+
 class EmployeeDebtViewSet(viewsets.ModelViewSet):
     queryset = EmployeeDebt.objects.none()
     serializer_class = EmployeeDebtSerializer
@@ -660,6 +865,7 @@ class EmployeeDebtViewSet(viewsets.ModelViewSet):
 class PayDebtView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @idempotent
     def post(self, request, *args, **kwargs):
         debt_id = kwargs.get('pk')
         debt = get_object_or_404(EmployeeDebt, pk=debt_id)
@@ -733,6 +939,39 @@ class RecordedPackagingViewSet(viewsets.ModelViewSet):
     serializer_class = RecordedPackagingSerializer
     permission_classes = [IsAuthenticated]
 
+    # Crates brought back come off what the client owes
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            recorded = serializer.save()
+            ClientPackagingBalance.apply({(recorded.customer_id, recorded.packaging_id): -recorded.quantity})
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            before = (serializer.instance.customer_id, serializer.instance.packaging_id)
+            deltas = defaultdict(int, {before: serializer.instance.quantity})
+            recorded = serializer.save()
+            deltas[(recorded.customer_id, recorded.packaging_id)] -= recorded.quantity
+            ClientPackagingBalance.apply(deltas)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            ClientPackagingBalance.apply({(instance.customer_id, instance.packaging_id): instance.quantity})
+            instance.delete()
+
+class ClientPackagingView(APIView):
+    # Crates the client still has, per packaging
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        user = request.user
+        clients = Client.objects.filter(enterprise=user.enterprise)
+        if user.user_type != 'admin':
+            clients = clients.filter(sales_point=user.sales_point)
+        client = get_object_or_404(clients, pk=pk)
+        balances = client.packaging_balances.exclude(crates=0).order_by('packaging__name').values(
+            'packaging', 'crates', packaging_name=F('packaging__name'), price=F('packaging__price'))
+        return Response(list(balances), status=status.HTTP_200_OK)
+
 class TokenVerifyView(generics.GenericAPIView):
     permission_classes = [AllowAny]
     
@@ -753,6 +992,31 @@ class ProductListView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
     filter_backends = [SalesPointCategorySupplierFilterBackend]
 
+class ProductImportView(APIView):
+    # Upserts the products of a sales point from a supplier catalogue
+    # (.csv or .xlsx), keyed by product_code. See imports.ProductImport.
+    permission_classes = [IsAdminOrManager]
+    parser_classes = [MultiPartParser, FormParser]
+
+    def post(self, request):
+        uploaded_file = request.FILES.get('file')
+        if not uploaded_file:
+            return Response({'file': 'This field is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        if uploaded_file.name.lower().endswith('.xlsx') and imports.openpyxl is None:
+            return Response({'file': 'Excel imports are not available, upload a CSV file.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        user = request.user
+        if user.user_type == 'admin':
+            sales_point = SalesPoint.objects.filter(enterprise=user.enterprise, pk=request.data.get('sales_point')).first()
+            if sales_point is None:
+                return Response({'sales_point': 'This field is required for admin users.'}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            sales_point = user.sales_point
+
+        summary = imports.ProductImport(user, sales_point).run(imports.read_import_rows(uploaded_file))
+        return Response(summary, status=status.HTTP_200_OK)
+
 class ProductBillListView(generics.ListAPIView):
     queryset = ProductBill.objects.all()
     serializer_class = ProductBillSerializer
@@ -786,4 +1050,467 @@ class PackagingHistoryListView(generics.ListAPIView):
             end_date = parse_datetime(end_date)
             queryset = queryset.filter(timestamp__lte=end_date)
 
-        return queryset.order_by('-timestamp')
\ No newline at end of file
+        return queryset.order_by('-timestamp')
+
+class InventoryValuationView(APIView):
+    permission_classes = [IsAdminOrManager]
+
+    def get(self, request):
+        group_by = request.query_params.get('group_by')
+        if group_by not in (None, 'category', 'supplier'):
+            return Response({'detail': "group_by must be 'category' or 'supplier'."}, status=status.HTTP_400_BAD_REQUEST)
+
+        at = request.query_params.get('date')
+        if at:
+            # A bare date means the stock at the end of that day
+            at = parse_report_datetime(at, end_of_day=True)
+            if at is None:
+                return Response({'detail': 'Invalid date.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        sales_points = get_report_sales_points(request.user, request.query_params.getlist('sales_point'))
+        rows = (row for sales_point in sales_points for row in stock_valuation(sales_point, at, group_by))
+        return StreamingHttpResponse(stream_ndjson(rows), content_type='application/x-ndjson')
+
+class ClientStatementView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        user = request.user
+        clients = Client.objects.filter(enterprise=user.enterprise)
+        if user.user_type != 'admin':
+            clients = clients.filter(sales_point=user.sales_point)
+        client = get_object_or_404(clients, pk=pk)
+
+        start_date, end_date = report_date_range(request.query_params)
+
+        entries = client_statement(client, start_date, end_date)
+        response = StreamingHttpResponse(stream_ndjson(entries), content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename=statement_{client.code}.ndjson'
+        return response
+
+class ClientLedgerView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        user = request.user
+        clients = Client.objects.filter(enterprise=user.enterprise)
+        if user.user_type != 'admin':
+            clients = clients.filter(sales_point=user.sales_point)
+        client = get_object_or_404(clients, pk=pk)
+
+        entries = client.ledger_entries.order_by('created_at', 'id')
+        start_date, end_date = report_date_range(request.query_params)
+        if start_date:
+            entries = entries.filter(created_at__gte=start_date)
+        if end_date:
+            entries = entries.filter(created_at__lte=end_date)
+
+        rows = entries.values('id', 'created_at', 'kind', 'amount', 'bill', 'created_by',
+                              bill_number=F('bill__bill_number')).iterator(chunk_size=2000)
+        response = StreamingHttpResponse(stream_ndjson(rows), content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename=ledger_{client.code}.ndjson'
+        return response
+
+class ReceivablesAgingView(APIView):
+    permission_classes = [IsAdminOrManager]
+
+    def get(self, request):
+        group_by = request.query_params.get('group_by', 'client')
+        if group_by not in ('client', 'sales_point'):
+            return Response({'detail': "group_by must be 'client' or 'sales_point'."}, status=status.HTTP_400_BAD_REQUEST)
+
+        as_of = request.query_params.get('as_of')
+        if as_of:
+            as_of = parse_report_datetime(as_of, end_of_day=True)
+            if as_of is None:
+                return Response({'detail': 'Invalid as_of date.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        sales_points = get_report_sales_points(request.user, request.query_params.getlist('sales_point'))
+        bills = Bill.objects.filter(enterprise=request.user.enterprise, sales_point__in=sales_points)
+        return Response(list(receivables_aging(bills, group_by, as_of)), status=status.HTTP_200_OK)
+
+class DelivererReportView(APIView):
+    permission_classes = [IsAdminOrManager]
+    # The delivery board polls this every few seconds
+    cache_timeout = 5
+
+    def get(self, request):
+        start_date, end_date = report_date_range(request.query_params)
+
+        sales_point_ids = sorted(get_report_sales_points(
+            request.user, request.query_params.getlist('sales_point')).values_list('id', flat=True))
+        cache_key = f"deliverer-report:{request.user.enterprise_id}:{sales_point_ids}:{start_date}:{end_date}"
+        data = cache.get(cache_key)
+        if data is None:
+            bills = Bill.objects.filter(enterprise=request.user.enterprise, sales_point__in=sales_point_ids)
+            if start_date:
+                bills = bills.filter(delivery_date__gte=start_date)
+            if end_date:
+                bills = bills.filter(delivery_date__lte=end_date)
+            data = list(deliverer_report(bills))
+            cache.set(cache_key, data, self.cache_timeout)
+        return Response(data, status=status.HTTP_200_OK)
+
+class SalesHeatmapView(APIView):
+    permission_classes = [IsAdminOrManager]
+
+    def get(self, request):
+        sales_points = get_report_sales_points(request.user, request.query_params.getlist('sales_point'))
+        return Response([sales_heatmap(sales_point) for sales_point in sales_points], status=status.HTTP_200_OK)
+
+class ColumnarExportView(APIView):
+    permission_classes = [IsAdminOrManager]
+
+    def get(self, request, dataset):
+        if dataset not in exports.COLUMNAR_DATASETS:
+            return Response({'detail': 'Unknown dataset.'}, status=status.HTTP_404_NOT_FOUND)
+        if exports.pa is None:
+            return Response({'detail': 'Columnar exports are not available.'}, status=status.HTTP_501_NOT_IMPLEMENTED)
+
+        start_date, end_date = report_date_range(request.query_params)
+        sales_point_ids = get_report_sales_points(
+            request.user, request.query_params.getlist('sales_point')).values_list('id', flat=True)
+
+        rows = exports.columnar_rows(dataset, request.user.enterprise, list(sales_point_ids), start_date, end_date)
+        response = StreamingHttpResponse(exports.stream_arrow(dataset, rows),
+                                         content_type='application/vnd.apache.arrow.stream')
+        response['Content-Disposition'] = f'attachment; filename={dataset}.arrows'
+        return response
+
+
+class StreamingExportMixin:
+    # Streams the filtered list of the view as CSV (default) or NDJSON
+    # (?output=ndjson), reading the queryset chunk by chunk.
+    export_name = None
+    export_columns = []
+    export_chunk_size = 2000
+    http_method_names = ['get', 'head', 'options']
+
+    def get_export_queryset(self):
+        return self.filter_queryset(self.get_queryset())
+
+    def get(self, request, *args, **kwargs):
+        output = request.query_params.get('output', 'csv')
+        if output not in ('csv', 'ndjson'):
+            return Response({'output': 'Expected csv or ndjson.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        columns = self.export_columns
+        rows = exports.export_rows(self.get_export_queryset(), columns, self.export_chunk_size)
+        if output == 'csv':
+            response = StreamingHttpResponse(exports.stream_csv(columns, rows), content_type='text/csv')
+        else:
+            response = StreamingHttpResponse(stream_ndjson(exports.stream_records(columns, rows)),
+                                             content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename={self.export_name}.{output}'
+        return response
+
+class BillExportView(StreamingExportMixin, BillListView):
+    export_name = 'bills'
+    export_columns = [
+        ('id', 'id'),
+        ('bill_number', 'bill_number'),
+        ('created_at', 'created_at'),
+        ('delivery_date', 'delivery_date'),
+        ('state', 'state'),
+        ('sales_point', 'sales_point.name'),
+        ('customer_id', 'customer_id'),
+        ('customer_name', 'customer_name'),
+        ('deliverer', 'deliverer.name'),
+        ('lines', lambda bill: len(bill.product_bills.all())),
+        ('total_amount', 'total_amount'),
+        ('package_amount', 'package_amount'),
+        ('paid', 'paid'),
+        ('paid_at', 'paid_at'),
+    ]
+
+    def get_export_queryset(self):
+        return (super().get_export_queryset()
+                .select_related('sales_point', 'deliverer')
+                .prefetch_related('product_bills')
+                .order_by('created_at', 'id'))
+
+class UserCustomersExportView(StreamingExportMixin, UserCustomersView, generics.GenericAPIView):
+    filter_backends = (filters.DjangoFilterBackend,)
+    filterset_class = ClientFilter
+    export_name = 'customers'
+    export_columns = [
+        ('id', 'id'),
+        ('code', 'code'),
+        ('name', 'name'),
+        ('surname', 'surname'),
+        ('number', 'number'),
+        ('email', 'email'),
+        ('address', 'address'),
+        ('client_category', 'client_category.name'),
+        ('sales_point', 'sales_point.name'),
+        ('balance', 'balance'),
+        ('created_at', 'created_at'),
+    ]
+
+    def get_export_queryset(self):
+        return (super().get_export_queryset()
+                .select_related('client_category', 'sales_point')
+                .order_by('id'))
+
+class ProductExportView(StreamingExportMixin, ProductListView):
+    export_name = 'products'
+    export_columns = [
+        ('id', 'id'),
+        ('product_code', 'product_code'),
+        ('name', 'name'),
+        ('category', 'category.name'),
+        ('supplier', 'supplier.name'),
+        ('sales_point', 'sales_point.name'),
+        ('package', 'package.name'),
+        ('price', 'price'),
+        ('sell_prices', lambda product: '|'.join(str(sell_price.price) for sell_price in product.sell_prices.all())),
+        ('is_beer', 'is_beer'),
+        ('with_variant', 'with_variant'),
+        ('quantity', 'total_quantity'),
+        ('variants', lambda product: '|'.join(f"{variant.name}:{variant.quantity}" for variant in product.variants.all())),
+    ]
+
+    def get_queryset(self):
+        return Product.objects.filter(enterprise=self.request.user.enterprise)
+
+    def get_export_queryset(self):
+        return (super().get_export_queryset()
+                .select_related('category', 'supplier', 'sales_point', 'package')
+                .prefetch_related('sell_prices', 'variants')
+                .order_by('id'))
+
+class PackagingHistoryExportView(StreamingExportMixin, PackagingHistoryListView):
+    export_name = 'packaging-history'
+    export_columns = [
+        ('id', 'id'),
+        ('timestamp', 'timestamp'),
+        ('action', 'action'),
+        ('packaging', 'packaging.name'),
+        ('product', 'product.name'),
+        ('quantity_changed', 'quantity_changed'),
+        ('full_quantity_before', 'full_quantity_before'),
+        ('empty_quantity_before', 'empty_quantity_before'),
+        ('full_quantity_after', 'full_quantity_after'),
+        ('empty_quantity_after', 'empty_quantity_after'),
+        ('performed_by', 'performed_by.username'),
+        ('sales_point', 'sales_point.name'),
+        ('bill_id', 'bill_id'),
+    ]
+
+    def get_export_queryset(self):
+        return (super().get_export_queryset()
+                .select_related('packaging', 'product', 'performed_by', 'sales_point'))
+
+
+class StockTransferViewSet(viewsets.ModelViewSet):
+    # Transfer documents are created as drafts and moved by
+    # StockTransferExecuteView; executed transfers are kept as they are.
+    serializer_class = StockTransferSerializer
+    permission_classes = [IsAdminOrManager]
+    http_method_names = ['get', 'post', 'delete', 'head', 'options']
+
+    def get_queryset(self):
+        user = self.request.user
+        queryset = StockTransfer.objects.filter(enterprise=user.enterprise).prefetch_related('lines')
+        if user.user_type != 'admin':
+            queryset = queryset.filter(Q(source=user.sales_point) | Q(destination=user.sales_point))
+        return queryset.order_by('-created_at')
+
+    def perform_create(self, serializer):
+        serializer.save(enterprise=self.request.user.enterprise, created_by=self.request.user)
+
+    def perform_destroy(self, instance):
+        if instance.state != 'draft':
+            raise serializers.ValidationError({'state': 'Executed transfers cannot be deleted.'})
+        instance.delete()
+
+class StockTransferExecuteView(APIView):
+    permission_classes = [IsAdminOrManager]
+
+    @idempotent
+    def post(self, request, pk):
+        user = request.user
+        transfer = get_object_or_404(StockTransfer, pk=pk, enterprise=user.enterprise)
+        if user.user_type != 'admin' and transfer.source_id != user.sales_point_id:
+            return Response({'detail': 'Only the source sales point can execute this transfer.'}, status=status.HTTP_403_FORBIDDEN)
+        transfer = execute_stock_transfer(transfer, user)
+        return Response(StockTransferSerializer(transfer).data, status=status.HTTP_200_OK)
+
+
+class StocktakeQuerysetMixin:
+    permission_classes = [IsAdminOrManager]
+
+    def get_stocktakes(self):
+        user = self.request.user
+        queryset = Stocktake.objects.filter(enterprise=user.enterprise)
+        if user.user_type != 'admin':
+            queryset = queryset.filter(sales_point=user.sales_point)
+        return queryset
+
+class StocktakeViewSet(StocktakeQuerysetMixin, viewsets.ModelViewSet):
+    # Counts are uploaded with StocktakeCountView and booked with
+    # StocktakeReconcileView; applied stocktakes are kept as they are.
+    serializer_class = StocktakeSerializer
+    http_method_names = ['get', 'post', 'delete', 'head', 'options']
+
+    def get_queryset(self):
+        return self.get_stocktakes().order_by('-created_at')
+
+    def perform_create(self, serializer):
+        serializer.save(enterprise=self.request.user.enterprise, created_by=self.request.user)
+
+    def perform_destroy(self, instance):
+        if instance.state != 'open':
+            raise serializers.ValidationError({'state': 'Applied stocktakes cannot be deleted.'})
+        instance.delete()
+
+class StocktakeCountView(StocktakeQuerysetMixin, APIView):
+    # Adds the counts of a .csv or .xlsx file (product_code, variant,
+    # packaging, quantity, empty_quantity) to an open stocktake.
+    parser_classes = [MultiPartParser, FormParser]
+
+    def post(self, request, pk):
+        stocktake = get_object_or_404(self.get_stocktakes(), pk=pk)
+        uploaded_file = request.FILES.get('file')
+        if not uploaded_file:
+            return Response({'file': 'This field is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        if uploaded_file.name.lower().endswith('.xlsx') and imports.openpyxl is None:
+            return Response({'file': 'Excel imports are not available, upload a CSV file.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if stocktake.state != 'open':
+            return Response({'state': 'Counts can only be added to an open stocktake.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        summary = stocktakes.StocktakeCountImport(stocktake).run(imports.read_import_rows(uploaded_file))
+        return Response(summary, status=status.HTTP_200_OK)
+
+class StocktakeReconcileView(StocktakeQuerysetMixin, APIView):
+    # Fills the variance report of a stocktake; with {"apply": true} the
+    # variances are booked on the stock and the stocktake is closed.
+    def post(self, request, pk):
+        stocktake = get_object_or_404(self.get_stocktakes(), pk=pk)
+        apply = str(request.data.get('apply', '')).lower() in ('1', 'true')
+        stocktake = stocktakes.reconcile_stocktake(stocktake, request.user, apply=apply)
+        return Response(StocktakeSerializer(stocktake).data, status=status.HTTP_200_OK)
+
+class StocktakeVarianceExportView(StocktakeQuerysetMixin, StreamingExportMixin, generics.GenericAPIView):
+    # Variance report of a reconciled stocktake. ?variances_only=true leaves
+    # out the lines that matched the stock.
+    export_columns = [
+        ('product_code', 'product.product_code'),
+        ('product', 'product.name'),
+        ('variant', 'variant.name'),
+        ('packaging', 'packaging.name'),
+        ('counted', 'counted'),
+        ('expected', 'expected'),
+        ('variance', 'variance'),
+        ('counted_empty', lambda line: line.counted_empty if line.packaging_id else None),
+        ('expected_empty', 'expected_empty'),
+        ('empty_variance', 'empty_variance'),
+        ('unit_price', lambda line: line.packaging.price if line.packaging_id else line.product.price),
+    ]
+
+    @property
+    def export_name(self):
+        return f"stocktake-{self.kwargs['pk']}-variances"
+
+    def get_queryset(self):
+        stocktake = get_object_or_404(self.get_stocktakes(), pk=self.kwargs['pk'])
+        queryset = StocktakeLine.objects.filter(stocktake=stocktake).select_related('product', 'variant', 'packaging')
+        if self.request.query_params.get('variances_only', '').lower() in ('1', 'true'):
+            queryset = queryset.filter(~Q(counted=F('expected')) |
+                                       Q(packaging__isnull=False) & ~Q(counted_empty=F('expected_empty')))
+        return queryset.order_by('packaging_id', 'product__product_code', 'variant__name', 'id')
+
+
+class PurchaseDocumentMixin:
+    # Purchase orders and goods receipts of the enterprise; managers only see
+    # those of their sales point.
+    permission_classes = [IsAdminOrManager]
+    http_method_names = ['get', 'post', 'delete', 'head', 'options']
+    document_model = None
+
+    def get_documents(self):
+        user = self.request.user
+        queryset = self.document_model.objects.filter(enterprise=user.enterprise)
+        if user.user_type != 'admin':
+            queryset = queryset.filter(sales_point=user.sales_point)
+        return queryset
+
+    def get_queryset(self):
+        return self.get_documents().prefetch_related('lines').order_by('-created_at')
+
+    def perform_create(self, serializer):
+        serializer.save(enterprise=self.request.user.enterprise, created_by=self.request.user)
+
+class PurchaseOrderViewSet(PurchaseDocumentMixin, viewsets.ModelViewSet):
+    serializer_class = PurchaseOrderSerializer
+    document_model = PurchaseOrder
+
+    def perform_destroy(self, instance):
+        if instance.state != 'open' or instance.receipts.exists():
+            raise serializers.ValidationError({'state': 'Orders with goods received cannot be deleted.'})
+        instance.delete()
+
+class GoodsReceiptViewSet(PurchaseDocumentMixin, viewsets.ModelViewSet):
+    serializer_class = GoodsReceiptSerializer
+    document_model = GoodsReceipt
+
+    def perform_destroy(self, instance):
+        if instance.state != 'draft':
+            raise serializers.ValidationError({'state': 'Received goods receipts cannot be deleted.'})
+        instance.delete()
+
+class GoodsReceiptReceiveView(PurchaseDocumentMixin, APIView):
+    document_model = GoodsReceipt
+
+    @idempotent
+    def post(self, request, pk):
+        receipt = receive_goods(get_object_or_404(self.get_documents(), pk=pk), request.user)
+        return Response(GoodsReceiptSerializer(receipt).data, status=status.HTTP_200_OK)
+
+class PurchaseOrderReceiveView(PurchaseDocumentMixin, APIView):
+    # Receives the outstanding quantities of an order, or only
+    # {"lines": {"<order line id>": quantity}}, as one goods receipt.
+    document_model = PurchaseOrder
+
+    @idempotent
+    def post(self, request, pk):
+        order = get_object_or_404(self.get_documents(), pk=pk)
+        quantities = request.data.get('lines')
+        if quantities is not None:
+            try:
+                quantities = {int(line_id): int(quantity) for line_id, quantity in quantities.items()}
+            except (AttributeError, TypeError, ValueError):
+                return Response({'lines': 'Expected {order line id: quantity}.'}, status=status.HTTP_400_BAD_REQUEST)
+            line_ids = set(order.lines.values_list('id', flat=True))
+            if set(quantities) - line_ids or any(quantity < 0 for quantity in quantities.values()):
+                return Response({'lines': 'Unknown order lines or negative quantities.'},
+                                status=status.HTTP_400_BAD_REQUEST)
+        with transaction.atomic():
+            receipt = receive_goods(receipt_from_order(order, request.user, quantities), request.user)
+        return Response(GoodsReceiptSerializer(receipt).data, status=status.HTTP_201_CREATED)
+
+
+class BillReturnView(APIView):
+    # Partial returns of a bill: GET lists them, POST takes back
+    # {"lines": [{"product_bill", "quantity", "crates"}]} only.
+    permission_classes = [IsAuthenticated]
+
+    def get_bill(self, request, pk):
+        bills = Bill.objects.filter(enterprise=request.user.enterprise)
+        if request.user.user_type != 'admin':
+            bills = bills.filter(sales_point=request.user.sales_point)
+        return get_object_or_404(bills, pk=pk)
+
+    def get(self, request, pk):
+        bill_returns = self.get_bill(request, pk).returns.prefetch_related('lines').order_by('created_at')
+        return Response(BillReturnSerializer(bill_returns, many=True).data)
+
+    @idempotent
+    def post(self, request, pk):
+        bill = self.get_bill(request, pk)
+        serializer = BillReturnSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        bill_return = return_bill_lines(bill, serializer.validated_data['lines'], request.user,
+                                        note=serializer.validated_data.get('note', ''))
+        return Response(BillReturnSerializer(bill_return).data, status=status.HTTP_201_CREATED)
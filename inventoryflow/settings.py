@@ -90,6 +90,7 @@ CORS_ALLOW_CREDENTIALS = True
 
 CORS_ALLOW_HEADERS = list(default_headers) + [
     'content-type',
+    'idempotency-key',
 ]
 
 CORS_ALLOW_METHODS = list(default_methods) + [
@@ -131,6 +132,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # The admin migrations need the custom user model before
+        # inventory.0008 creates it, so test databases are built from the
+        # models instead of the migration history
+        'TEST': {'MIGRATE': False},
     }
 }
 